@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""Ingest daemon: reads the packets from the serial link, decrypts them and
+stores the measures, in a single process replacing receive.py and process.py.
+"""
+
+import asyncio
+import functools
+import time
+
+from libcitizenwatt import engines
+from libcitizenwatt import invalidation
+from libcitizenwatt import metrics
+from libcitizenwatt import migrations
+from libcitizenwatt import radio
+from libcitizenwatt import tools
+from libcitizenwatt import tsstore
+from libcitizenwatt.packets import PacketDecoder
+from libcitizenwatt.pipeline import IngestService
+from libcitizenwatt.registry import BaseAddress
+from libcitizenwatt.registry import SensorRegistry
+from libcitizenwatt.retention import RetentionPolicy
+from libcitizenwatt.spool import Spool
+from libcitizenwatt.tariff import TariffSchedule
+from libcitizenwatt.writer import MeasuresWriter
+from libcitizenwatt.config import Config
+
+
+# Configuration
+config = Config()
+
+# DB initialization
+# A single connection is shared by the session and the measures writer
+engine, create_session = engines.create_session_factory(config, writer=True)
+# If the database is unavailable, the ingest starts from the snapshots of the
+# sensors and of the night rate schedule, and spools the measures
+upgrade = migrations.upgrade_or_defer(engine)
+
+registry = SensorRegistry(create_session)
+store = None
+if config.get("storage_backend") == "tsstore":
+    store = tsstore.get_store(config.get("tsstore_directory"))
+# Cached results are invalidated once measures are written
+publisher = invalidation.get_publisher(config)
+# Prometheus metrics, on http://localhost:<metrics_port>/metrics
+if config.get("metrics_port"):
+    metrics.serve(config.get("metrics_port"))
+
+while not registry.is_ready():
+    tools.warning("Install is not complete ! " +
+                  "Visit http://citizenwatt.local first.")
+    time.sleep(1)
+
+service = IngestService(
+    radio.SerialReceiver(config.get("serial_port"),
+                         config.get("serial_baudrate"),
+                         pipe_header=config.get("serial_pipe_header")),
+    BaseAddress(),
+    registry,
+    PacketDecoder(),
+    TariffSchedule(create_session),
+    MeasuresWriter(engine,
+                   max_rows=config.get("ingest_batch_size"),
+                   max_latency=config.get("ingest_batch_latency"),
+                   checkpoint_interval=config.get("last_timer_checkpoint"),
+                   spool=Spool(config.get("spool_directory")),
+                   store=store,
+                   invalidation=publisher,
+                   upgrade=upgrade),
+    queue_size=config.get("ingest_queue_size"),
+    batch_size=config.get("ingest_batch_size"),
+    stats_interval=config.get("ingest_stats_interval"),
+    maintenance=functools.partial(migrations.maintain, engine,
+                                  RetentionPolicy.from_config(config),
+                                  store, publisher),
+    maintenance_interval=config.get("maintenance_interval"))
+
+try:
+    asyncio.run(service.run())
+except KeyboardInterrupt:
+    pass
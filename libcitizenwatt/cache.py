@@ -1,18 +1,581 @@
 #!/usr/bin/env python3
+"""Computation and caching of the API results.
 
+Results are cached by the backend set by the cache_backend setting:
+
+* "redis": RedisCache, shared by all the processes, through a connection
+  pool, behind a MemoryCache of the process (TieredCache) holding the hot
+  results for at most memory_cache_ttl seconds, so that clients polling the
+  same results are answered without any network hop nor JSON decoding. Redis
+  errors are cache misses, so that the API keeps answering without Redis;
+* "memory": MemoryCache only, for small bases without Redis;
+* "none": NullCache, nothing is cached.
+
+Backends return MISS if a result is not cached. Results are shared by the
+threads, and must not be modified.
+"""
 import bisect
-import datetime
+import collections
 import json
 import numpy
-import redis
+import threading
+import time
 
-from libcitizenwatt import database
+from libcitizenwatt import invalidation
+from libcitizenwatt import rollups
 from libcitizenwatt import tools
-from sqlalchemy import asc, desc
 from libcitizenwatt.config import Config
+from libcitizenwatt.retention import RetentionPolicy
+from libcitizenwatt.storage import decode_cursor, encode_cursor, get_storage
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+# Returned by the backends for a result which is not cached (None being a
+# valid result)
+MISS = object()
+
+
+class NullCache():
+    """Caches nothing."""
+    invalidated = False
+
+    def get(self, key):
+        return MISS
+
+    def get_many(self, keys):
+        return [MISS] * len(keys)
+
+    def generation(self, sensor):
+        return None
+
+    def set(self, key, value, ttl, time_range=None, generation=None):
+        pass
+
+    def set_many(self, items, ttl, ranges=None, generations=None):
+        pass
+
+    def stats(self):
+        return {}
+
+
+class MemoryCache():
+    """LRU cache of at most <max_entries> results in the process, each
+    expiring after its own TTL, safe to share between threads.
+
+    Results cached with their time range are dropped by invalidate() (see
+    libcitizenwatt.invalidation), which increments the generation of their
+    sensor.
+    """
+    invalidated = False
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        # sensor => {key: (time1, time2)}
+        self.ranges = {}
+        # sensor => number of invalidations
+        self.generations = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        return self.get_many([key])[0]
+
+    def get_many(self, keys):
+        now = time.monotonic()
+        values = []
+        with self.lock:
+            for key in keys:
+                entry = self.entries.get(key)
+                if entry is None:
+                    self.misses += 1
+                    values.append(MISS)
+                elif entry[1] <= now:
+                    self.forget(key)
+                    self.expirations += 1
+                    self.misses += 1
+                    values.append(MISS)
+                else:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    values.append(entry[0])
+        return values
+
+    def forget(self, key):
+        """Drops the result at <key>, the lock being held."""
+        value, expires, sensor = self.entries.pop(key)
+        if sensor is not None:
+            del self.ranges[sensor][key]
+
+    def generation(self, sensor):
+        with self.lock:
+            return self.generations.get(sensor, 0)
+
+    def set(self, key, value, ttl, time_range=None, generation=None):
+        self.set_many({key: value}, ttl,
+                      {key: time_range} if time_range else None,
+                      {time_range[0]: generation}
+                      if time_range and generation is not None else None)
+
+    def set_many(self, items, ttl, ranges=None, generations=None):
+        """Caches the results of <items> for <ttl> seconds, with the
+        (sensor, time1, time2) of their <ranges> if any. Results of the
+        sensors whose generation is no longer the one in <generations> are
+        skipped.
+        """
+        expires = time.monotonic() + ttl
+        ranges = ranges or {}
+        with self.lock:
+            for key, value in items.items():
+                if key in self.entries:
+                    self.forget(key)
+                sensor = None
+                if key in ranges:
+                    sensor, time1, time2 = ranges[key]
+                    if (generations and sensor in generations and
+                            generations[sensor] !=
+                            self.generations.get(sensor, 0)):
+                        continue
+                    self.ranges.setdefault(sensor, {})[key] = (time1, time2)
+                self.entries[key] = (value, expires, sensor)
+            while len(self.entries) > self.max_entries:
+                self.forget(next(iter(self.entries)))
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.ranges.clear()
+
+    def invalidate(self, ranges):
+        """Drops the results overlapping the time range of their sensor in
+        <ranges>.
+        """
+        with self.lock:
+            for sensor, (time1, time2) in ranges.items():
+                self.generations[sensor] = self.generations.get(sensor, 0) + 1
+                stale = [key for key, time_range in
+                         self.ranges.get(sensor, {}).items()
+                         if invalidation.overlaps(time_range, time1, time2)]
+                for key in stale:
+                    self.forget(key)
+                self.invalidations += len(stale)
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries),
+                    "max_entries": self.max_entries,
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions,
+                    "expirations": self.expirations,
+                    "invalidations": self.invalidations}
+
+
+class RedisCache():
+    """Cache in Redis, as JSON, through a connection pool shared by the
+    threads of the process. Several keys are read or written in a single
+    round trip. Redis errors are reported once, and are cache misses.
+
+    Results cached with their time range are registered in the index of
+    their sensor, and deleted by the ingest when measures are written in
+    that range (see libcitizenwatt.invalidation). Those computed while the
+    ingest was invalidating their sensor are deleted once cached, their
+    generation having changed.
+    """
+    invalidated = True
+
+    def __init__(self, host="localhost", port=6379, db=0, timeout=1):
+        self.redis = redis.Redis(connection_pool=redis.ConnectionPool(
+            host=host, port=port, db=db, decode_responses=True,
+            socket_timeout=timeout, socket_connect_timeout=timeout))
+        self.available = True
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    def count(self, counter, amount=1):
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + amount)
+
+    def failed(self, error):
+        self.count("errors")
+        if self.available:
+            tools.warning("Redis unavailable, results are not cached : " +
+                          str(error))
+        self.available = False
+
+    def get_many_with_ttl(self, keys):
+        """Returns the result at each of <keys> and its remaining TTL (in s),
+        or (MISS, None).
+        """
+        try:
+            pipeline = self.redis.pipeline(transaction=False)
+            for key in keys:
+                pipeline.get(key)
+                pipeline.pttl(key)
+            replies = pipeline.execute()
+        except redis.RedisError as e:
+            self.failed(e)
+            return [(MISS, None)] * len(keys)
+        self.available = True
+        results = []
+        for value, ttl in zip(replies[::2], replies[1::2]):
+            if value is None:
+                results.append((MISS, None))
+            else:
+                results.append((json.loads(value),
+                                ttl / 1000 if ttl > 0 else None))
+        hits = sum(1 for value, ttl in results if value is not MISS)
+        self.count("hits", hits)
+        self.count("misses", len(results) - hits)
+        return results
+
+    def get_with_ttl(self, key):
+        return self.get_many_with_ttl([key])[0]
+
+    def get(self, key):
+        return self.get_with_ttl(key)[0]
+
+    def get_many(self, keys):
+        return [value for value, ttl in self.get_many_with_ttl(keys)]
+
+    def generation(self, sensor):
+        """Returns the generation of <sensor>, or None if Redis is
+        unavailable.
+        """
+        try:
+            generation = self.redis.get(invalidation.GENERATION % sensor)
+        except redis.RedisError as e:
+            self.failed(e)
+            return None
+        self.available = True
+        return int(generation or 0)
+
+    def set(self, key, value, ttl, time_range=None, generation=None):
+        self.set_many({key: value}, ttl,
+                      {key: time_range} if time_range else None,
+                      {time_range[0]: generation}
+                      if time_range and generation is not None else None)
+
+    def set_many(self, items, ttl, ranges=None, generations=None):
+        """Caches the results of <items> for <ttl> seconds, with the
+        (sensor, time1, time2) of their <ranges> if any. Results of the
+        sensors whose generation is no longer the one in <generations> are
+        deleted right after.
+
+        Returns the keys of the deleted results.
+        """
+        ranges = ranges or {}
+        generations = generations or {}
+        sensors = sorted(generations)
+        try:
+            pipeline = self.redis.pipeline(transaction=False)
+            for key, value in items.items():
+                pipeline.set(key, json.dumps(value), ex=ttl)
+                if key in ranges:
+                    sensor, time1, time2 = ranges[key]
+                    pipeline.zadd(invalidation.INDEX % sensor,
+                                  {invalidation.index_member(key, time1):
+                                   time2})
+            # Read after the results are set: if the ingest incremented the
+            # generation later, it also finds them in the index
+            for sensor in sensors:
+                pipeline.get(invalidation.GENERATION % sensor)
+            replies = pipeline.execute()
+            changed = {sensor for sensor, generation in
+                       zip(sensors, replies[len(replies) - len(sensors):])
+                       if generations[sensor] is None or
+                       int(generation or 0) != generations[sensor]}
+            stale = [key for key in items
+                     if key in ranges and ranges[key][0] in changed]
+            if stale:
+                self.redis.delete(*stale)
+        except redis.RedisError as e:
+            self.failed(e)
+            return set()
+        self.available = True
+        return set(stale)
+
+    def stats(self):
+        with self.lock:
+            return {"available": self.available,
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "errors": self.errors}
+
+
+class TieredCache():
+    """<remote> cache (RedisCache) behind a <local> MemoryCache, whose
+    entries last at most <max_local_ttl> seconds, so that results written by
+    other processes are seen after that.
+
+    Once listen() is called, the results of the local cache are invalidated
+    along with the remote ones, when measures are written. Results read from
+    the remote cache come without their time range, and are only kept
+    locally for <max_local_ttl> seconds.
+    """
+    invalidated = True
+
+    def __init__(self, local, remote, max_local_ttl):
+        self.local = local
+        self.remote = remote
+        self.max_local_ttl = max_local_ttl
+
+    def get(self, key):
+        return self.get_many([key])[0]
+
+    def get_many(self, keys):
+        values = self.local.get_many(keys)
+        missing = [i for i, value in enumerate(values) if value is MISS]
+        if not missing:
+            return values
+        results = self.remote.get_many_with_ttl([keys[i] for i in missing])
+        for i, (value, ttl) in zip(missing, results):
+            if value is not MISS:
+                self.local.set(keys[i], value,
+                               min(ttl or self.max_local_ttl,
+                                   self.max_local_ttl))
+                values[i] = value
+        return values
+
+    def generation(self, sensor):
+        return self.remote.generation(sensor)
+
+    def set(self, key, value, ttl, time_range=None, generation=None):
+        self.set_many({key: value}, ttl,
+                      {key: time_range} if time_range else None,
+                      {time_range[0]: generation}
+                      if time_range and generation is not None else None)
+
+    def set_many(self, items, ttl, ranges=None, generations=None):
+        stale = self.remote.set_many(items, ttl, ranges, generations)
+        if stale:
+            # Computed without the last measures
+            items = {key: value for key, value in items.items()
+                     if key not in stale}
+        if ranges:
+            # Invalidated as soon as measures are written, as in Redis
+            indexed = {key: value for key, value in items.items()
+                       if key in ranges}
+            self.local.set_many(indexed, ttl, ranges)
+            items = {key: value for key, value in items.items()
+                     if key not in ranges}
+        if items:
+            self.local.set_many(items, min(ttl, self.max_local_ttl))
+
+    def listen(self, retry_interval=5):
+        """Starts a thread dropping the local results invalidated by the
+        ingest. On Redis errors, it subscribes again after <retry_interval>
+        seconds, having dropped the local results which could have missed
+        their invalidation.
+        """
+        def run():
+            while True:
+                try:
+                    pubsub = self.remote.redis.pubsub(
+                        ignore_subscribe_messages=True)
+                    pubsub.subscribe(invalidation.CHANNEL)
+                    while True:
+                        message = pubsub.get_message(timeout=retry_interval)
+                        if message is not None:
+                            self.local.invalidate(
+                                invalidation.decode_ranges(message["data"]))
+                except redis.RedisError as e:
+                    self.remote.failed(e)
+                    time.sleep(retry_interval)
+                    self.local.clear()
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+    def stats(self):
+        return {"memory": self.local.stats(), "redis": self.remote.stats()}
+
+
+def get_backend(config):
+    """Returns the cache backend set in <config>."""
+    backend = config.get("cache_backend")
+    if backend == "memory":
+        return MemoryCache(config.get("memory_cache_entries"))
+    elif backend == "redis":
+        if redis is None:
+            tools.warning("The redis module is missing, " +
+                          "results are not cached.")
+            return NullCache()
+        remote = RedisCache(config.get("redis_host"),
+                            config.get("redis_port"),
+                            config.get("redis_db"))
+        if not config.get("memory_cache_ttl"):
+            return remote
+        tiered = TieredCache(MemoryCache(config.get("memory_cache_entries")),
+                             remote, config.get("memory_cache_ttl"))
+        tiered.listen()
+        return tiered
+    return NullCache()
 
 
 config = Config()
+retention_policy = RetentionPolicy.from_config(config)
+backend = get_backend(config)
+
+
+def cache_set(key, data, ttl, time_range=None, generation=None):
+    """Caches the result <data> at <key> for <ttl> seconds, invalidated by
+    the measures written in its <time_range> ((sensor, time1, time2)) if
+    set. The result is not kept if the <generation> of its sensor, read
+    before computing it, changed meanwhile (see backend.generation()).
+    """
+    ttl = int(ttl)
+    if ttl > 0:
+        backend.set(key, data, ttl, time_range, generation)
+
+
+def closed_before():
+    """Returns the time before which no more measures are expected, the
+    ingest writing them within ingest_batch_latency, after a timestep or two
+    of delay of the sensor.
+    """
+    return (time.time() - config.get("ingest_batch_latency") -
+            2 * config.get("default_timestep"))
+
+
+def closed_ttl():
+    """Returns the lifetime of the results of closed time ranges:
+    closed_cache_ttl, or at most uninvalidated_cache_ttl if late measures,
+    rebuilt rollups or the retention could not drop them, the backend not
+    being invalidated or invalidations being pending (see
+    invalidation.pending()).
+    """
+    if backend.invalidated and not invalidation.pending():
+        return config.get("closed_cache_ttl")
+    return min(config.get("closed_cache_ttl"),
+               config.get("uninvalidated_cache_ttl"))
+
+
+def range_ttl(time2, timestep, closed=None):
+    """Returns the lifetime of a result computed from the measures before
+    <time2>, cached with its time range: <closed> (default to closed_ttl())
+    if no more measures are expected before <time2>, live_cache_ttl if the
+    backend drops it when new measures are written, a <timestep> otherwise.
+    """
+    if time2 <= closed_before():
+        return closed if closed is not None else closed_ttl()
+    elif backend.invalidated:
+        return config.get("live_cache_ttl")
+    return timestep
+
+
+def cached_buckets(keys, ttls, compute, force_refresh=False, ranges=None):
+    """Returns the results of consecutive buckets, read from the cache for
+    the buckets of <keys> with a <ttls>, and computed otherwise.
+
+    <compute>(first, last) returns the results of the buckets from <first> to
+    <last> (included), and is called once per run of consecutive missing
+    buckets. Computed buckets with a TTL are then cached for that many
+    seconds, along with their time range ((sensor, time1, time2)) in
+    <ranges> if set, unless measures were written in their sensor meanwhile
+    (see cache_set()).
+    """
+    data = [MISS] * len(keys)
+    if not force_refresh:
+        indexes = [i for i in range(len(keys)) if ttls[i]]
+        values = backend.get_many([keys[i] for i in indexes])
+        for i, value in zip(indexes, values):
+            data[i] = value
+
+    generations = None
+    if ranges and any(value is MISS for value in data):
+        generations = {sensor: backend.generation(sensor)
+                       for sensor in set(time_range[0]
+                                         for time_range in ranges)}
+
+    # ttl => {key: result}
+    computed = {}
+    first = 0
+    while first < len(keys):
+        if data[first] is not MISS:
+            first += 1
+            continue
+        last = first
+        while last + 1 < len(keys) and data[last + 1] is MISS:
+            last += 1
+        for i, value in enumerate(compute(first, last), first):
+            data[i] = value
+            if ttls[i]:
+                computed.setdefault(int(ttls[i]), {})[keys[i]] = value
+        first = last + 1
+
+    for ttl, items in computed.items():
+        if ttl > 0:
+            backend.set_many(items, ttl,
+                             {keys[i]: ranges[i] for i in range(len(keys))
+                              if keys[i] in items} if ranges else None,
+                             generations)
+    return data
+
+
+def key_prefix(watt_euros):
+    """Returns the prefix of the cache keys of the results in <watt_euros>.
+
+    Costs depend on the prices of the current provider and on the night rate
+    schedule: their keys carry the "costs" version (see tools.bump_version),
+    bumped when any of them changes, so that all the cached costs are dropped
+    at once. It is read before computing a cost, so that a cost computed
+    from the previous prices is never cached under the new version.
+    """
+    if watt_euros == "euros":
+        return "euros_" + str(tools.get_version("costs")) + "_"
+    return watt_euros + "_"
+
+
+def add_energies(energies):
+    """Returns the sum of <energies> (as returned by tools.energy), skipping
+    the None ones, or None if there is none.
+    """
+    energies = [energy for energy in energies if energy is not None]
+    if not energies:
+        return None
+    return {rate: sum(energy[rate] for energy in energies)
+            for rate in ("day_rate", "night_rate", "value")}
+
+
+def convert_energy(energy, watt_euros, duration, db):
+    """Converts an <energy> (as returned by tools.energy) to the unit
+    <watt_euros>, <duration> (in s) being used for the mean power.
+    """
+    if watt_euros == "watts":
+        return {"value": energy["value"] / duration * 1000 * 3600,
+                "day_rate": energy["day_rate"] / duration * 1000 * 3600,
+                "night_rate": energy["night_rate"] / duration * 1000 * 3600}
+    elif watt_euros == 'kwatthours':
+        return energy
+    elif watt_euros == 'euros':
+        if energy["night_rate"] != 0:
+            night_rate = tools.watt_euros(0,
+                                          'night',
+                                          energy['night_rate'],
+                                          db)
+        else:
+            night_rate = 0
+        if energy["day_rate"] != 0:
+            day_rate = tools.watt_euros(0,
+                                        'day',
+                                        energy['day_rate'],
+                                        db)
+        else:
+            day_rate = 0
+        return {"value": night_rate + day_rate}
 
 
 def do_cache_ids(sensor, watt_euros, id1, id2, db, force_refresh=False):
@@ -22,62 +585,33 @@ def do_cache_ids(sensor, watt_euros, id1, id2, db, force_refresh=False):
 
     Returns the stored (or computed) data or None if parameters are invalid.
     """
-    r = redis.Redis(decode_responses=True)
+    key = (key_prefix(watt_euros) + str(sensor) + "_" + "by_id" + "_" +
+           str(id1) + "_" + str(id2))
     if not force_refresh:
-        data = r.get(watt_euros + "_" + str(sensor) + "_" + "by_id" + "_" +
-                     str(id1) + "_" + str(id2))
-        if data:
+        data = backend.get(key)
+        if data is not MISS:
             # If found in cache, return it
-            return json.loads(data)
-
-    if id1 >= 0 and id2 >= 0 and id2 >= id1:
-        data = (db.query(database.Measures)
-                .filter(database.Measures.sensor_id == sensor,
-                        database.Measures.id >= id1,
-                        database.Measures.id < id2)
-                .order_by(asc(database.Measures.timestamp))
-                .all())
-    elif id1 <= 0 and id2 <= 0 and id2 >= id1:
-        data = (db.query(database.Measures)
-                .filter_by(sensor_id=sensor)
-                .order_by(desc(database.Measures.timestamp))
-                .slice(-id2, -id1)
-                .all())
-        data.reverse()
-    else:
+            return data
+
+    try:
+        data = get_storage(db, config).by_ids(sensor, id1, id2)
+    except ValueError:
         return None
 
     if not data:
-        data = None
+        # Nothing to cache, the measures may be written later
+        return None
+
+    time1 = data[0].timestamp
+    time2 = data[-1].timestamp
+    if watt_euros == 'kwatthours' or watt_euros == 'euros':
+        data = convert_energy(tools.energy(data), watt_euros, time2 - time1,
+                              db)
     else:
-        time1 = data[0].timestamp
-        time2 = data[-1].timestamp
-        if watt_euros == 'kwatthours' or watt_euros == 'euros':
-            data = tools.energy(data)
-            if watt_euros == 'euros':
-                if data["night_rate"] != 0:
-                    night_rate = tools.watt_euros(0,
-                                                  'night',
-                                                  data['night_rate'],
-                                                  db)
-                else:
-                    night_rate = 0
-                if data["day_rate"] != 0:
-                    day_rate = tools.watt_euros(0,
-                                                'day',
-                                                data['day_rate'],
-                                                db)
-                else:
-                    day_rate = 0
-                data = {"value": night_rate + day_rate}
-        else:
-            data = tools.to_dict(data)
+        data = tools.to_dict(data)
 
     # Store in cache
-    r.set(watt_euros + "_" + str(sensor) + "_" + "by_id" + "_" +
-          str(id1) + "_" + str(id2),
-          json.dumps(data),
-          time2 - time1)
+    cache_set(key, data, time2 - time1)
 
     return data
 
@@ -89,228 +623,258 @@ def do_cache_group_id(sensor, watt_euros, id1, id2, step, db,
     Computes the cache (if needed) for the API call
     /api/<sensor:int>/get/<watt_euros:re:watts|kwatthours|euros>/by_id/<id1:int>/<id2:int>/<step:int>
 
+    With positive ids, each group is a bucket of ids, cached by its first id
+    and <step> once a later measure exists, so that overlapping requests only
+    compute their new buckets. Negative ids move with each new measure, their
+    result is cached for a timestep.
+
     Returns the stored (or computed) data.
     """
-    r = redis.Redis(decode_responses=True)
-    if not force_refresh:
-        data = r.get(watt_euros + "_" + str(sensor) + "_" + "by_id" + "_" +
-                     str(id1) + "_" + str(id2) + "_" +
-                     str(step) + "_" + str(timestep))
-        if data:
+    prefix = key_prefix(watt_euros) + str(sensor) + "_"
+    key = (prefix + "by_id" + "_" + str(id1) + "_" + str(id2) + "_" +
+           str(step) + "_" + str(timestep))
+    if id1 < 0 and not force_refresh:
+        data = backend.get(key)
+        if data is not MISS:
             # If found in cache, return it
-            return json.loads(data)
+            return data
 
     steps = [i for i in range(id1, id2, step)]
     steps.append(id2)
+    storage = get_storage(db, config)
 
-    if id1 >= 0 and id2 >= 0 and id2 >= id1:
-        data = (db.query(database.Measures)
-                .filter(database.Measures.sensor_id == sensor,
-                        database.Measures.id >= id1,
-                        database.Measures.id < id2)
-                .order_by(asc(database.Measures.timestamp))
-                .all())
-    elif id1 <= 0 and id2 <= 0 and id2 >= id1:
-        data = (db.query(database.Measures)
-                .filter_by(sensor_id=sensor)
-                .order_by(desc(database.Measures.timestamp))
-                .slice(-id2, -id1)
-                .all())
-        data.reverse()
+    def compute(first, last):
+        data = storage.by_ids(sensor, steps[first], steps[last + 1])
+        if id1 < 0:
+            # Negative ids count from the end of the measures
+            ids = range(steps[last + 1] - len(data), steps[last + 1])
+        else:
+            ids = [i.id for i in data]
+        groups = [[] for i in range(first, last + 1)]
+        for measure_id, measure in zip(ids, data):
+            groups[bisect.bisect_right(steps, measure_id) - 1 - first].append(
+                measure)
+        return [convert_energy(tools.energy(group), watt_euros,
+                               step * timestep, db)
+                if group else None
+                for group in groups]
+
+    if id1 < 0:
+        ttls = [None] * (len(steps) - 1)
     else:
-        raise ValueError
+        # Ids only grow, no measure will come in a bucket ending before the
+        # last measure
+        last_measure = storage.get_id(sensor, -1)
+        last_id = last_measure.id if last_measure is not None else -1
+        ttls = [config.get("closed_cache_ttl")
+                if steps[i + 1] - steps[i] == step and steps[i + 1] <= last_id
+                else None
+                for i in range(len(steps) - 1)]
+    data = cached_buckets(
+        [prefix + "id_bucket" + "_" +
+         str(step) + "_" + str(timestep) + "_" + str(start)
+         for start in steps[:-1]],
+        ttls, compute, force_refresh)
 
-    time2 = None
-    if not data:
-        data = [None for i in range(len(steps) - 1)]
-    else:
-        time1 = data[0].timestamp
-        time2 = data[-1].timestamp
-        data_dict = tools.to_dict(data)
-        tmp = [[] for i in range(len(steps) - 1)]
-        for i in data_dict:
-            tmp[bisect.bisect_left(steps, i["id"]) - 1].append(i)
-
-        data = []
-        for i in tmp:
-            if len(i) == 0:
-                data.append(None)
-                continue
-
-            energy = tools.energy(i)
-            if watt_euros == "watts":
-                tmp_data = {"value": energy["value"] / (step * timestep) * 1000 * 3600,
-                            "day_rate": energy["day_rate"] / (step * timestep) * 1000 * 3600,
-                            "night_rate": energy["night_rate"] / (step * timestep) * 1000 * 3600}
-            elif watt_euros == 'kwatthours':
-                tmp_data = energy
-            elif watt_euros == 'euros':
-                if energy["night_rate"] != 0:
-                    night_rate = tools.watt_euros(0,
-                                                  'night',
-                                                  energy['night_rate'],
-                                                  db)
-                else:
-                    night_rate = 0
-                if energy["day_rate"] != 0:
-                    day_rate = tools.watt_euros(0,
-                                                'day',
-                                                energy['day_rate'],
-                                                db)
-                else:
-                    day_rate = 0
-                tmp_data = {"value": night_rate + day_rate}
-            data.append(tmp_data)
     if len(data) == 0:
         data = None
-    if time2 is not None:
-        # Store in cache
-        if time2 < datetime.datetime.now().timestamp():
-            # If new measures are to come, short lifetime (basically timestep)
-            r.set(watt_euros + "_" + str(sensor) + "_" + "by_id" + "_" +
-                str(id1) + "_" + str(id2) + "_" +
-                str(step) + "_" + str(timestep),
-                json.dumps(data),
-                timestep)
-        else:
-            # Else, store for a greater lifetime (basically time2 - time1)
-            r.set(watt_euros + "_" + str(sensor) + "_" + "by_id" + "_" +
-                str(id1) + "_" + str(id2) + "_" +
-                str(step) + "_" + str(timestep),
-                json.dumps(data),
-                time2 - time1)
+    if id1 < 0:
+        # New measures are to come, short lifetime (basically timestep)
+        cache_set(key, data, timestep)
 
     return data
 
 
+def do_cache_cursor(sensor, watt_euros, count, cursor, db, step=None,
+                    timestep=config.get("default_timestep"),
+                    force_refresh=False):
+    """
+    Computes the cache (if needed) for the API calls
+    /api/<sensor:int>/get/<watt_euros:re:watts|kwatthours|euros>/by_cursor/<count:int>
+    /api/<sensor:int>/get/<watt_euros:re:watts|kwatthours|euros>/by_cursor/<count:int>/<step:int>
+
+    Reads the <count> measures before (or after) <cursor>, or the last ones if
+    <cursor> is None, grouped by <step> measures if set.
+
+    Returns the stored (or computed) data, with the cursors of the previous
+    and next pages, as a tuple. Raises ValueError if <cursor> is invalid.
+    """
+    key = (key_prefix(watt_euros) + str(sensor) + "_" + "by_cursor" + "_" +
+           str(cursor) + "_" + str(count) + "_" + str(step) + "_" +
+           str(timestep))
+    if not force_refresh:
+        data = backend.get(key)
+        if data is not MISS:
+            # If found in cache, return it
+            return tuple(data)
+
+    direction, position = "previous", None
+    if cursor is not None:
+        direction, timestamp, id1 = decode_cursor(cursor)
+        position = (timestamp, id1)
+    data = get_storage(db, config).by_cursor(sensor, count, position,
+                                             direction == "previous")
+
+    if not data:
+        # Nothing older, or no newer measure yet: poll the same page again
+        previous = None
+        next_ = cursor if direction == "next" else None
+        result = (None, previous, next_)
+        cache_set(key, result, timestep)
+        return result
+
+    previous = None
+    if direction == "next" or len(data) == count:
+        previous = encode_cursor(data[0], "previous")
+    next_ = encode_cursor(data[-1], "next")
+    time1 = data[0].timestamp
+    time2 = data[-1].timestamp
+
+    if step is not None:
+        data = [convert_energy(tools.energy(data[i:i + step]), watt_euros,
+                               step * timestep, db)
+                for i in range(0, len(data), step)]
+    elif watt_euros == 'kwatthours' or watt_euros == 'euros':
+        data = convert_energy(tools.energy(data), watt_euros, None, db)
+    else:
+        data = tools.to_dict(data)
+
+    result = (data, previous, next_)
+    # Store in cache
+    if direction == "previous" and position is not None:
+        # Older measures do not change, store for a greater lifetime
+        # (basically time2 - time1)
+        cache_set(key, result, max(time2 - time1, timestep))
+    else:
+        # The last measures, or new ones to come, short lifetime (basically
+        # timestep)
+        cache_set(key, result, timestep)
+
+    return result
+
+
 def do_cache_times(sensor, watt_euros, time1, time2, db, force_refresh=False):
     """
     Computes the cache (if needed) for the API call
     /api/<sensor:int>/get/<watt_euros:re:watts|kwatthours|euros>/by_time/<time1:float>/<time2:float>
     Returns the stored (or computed) data.
     """
-    r = redis.Redis(decode_responses=True)
+    key = (key_prefix(watt_euros) + str(sensor) + "_" + "by_time" + "_" +
+           str(time1) + "_" + str(time2))
     if not force_refresh:
-        data = r.get(watt_euros + "_" + str(sensor) + "_" + "by_time" + "_" +
-                     str(time1) + "_" + str(time2))
-        if data:
+        data = backend.get(key)
+        if data is not MISS:
             # If found in cache, return it
-            return json.loads(data)
-
-    data = (db.query(database.Measures)
-            .filter(database.Measures.sensor_id == sensor,
-                    database.Measures.timestamp >= time1,
-                    database.Measures.timestamp < time2)
-            .order_by(asc(database.Measures.timestamp))
-            .all())
+            return data
+
+    generation = backend.generation(sensor)
+    if watt_euros == "kwatthours" or watt_euros == "euros":
+        # Raw measures (or minute rollups) may have been deleted from the
+        # beginning of the range, which is then answered from the rollups
+        energies = []
+        for start, end, resolution in retention_policy.resolution_ranges(
+                time1, time2):
+            if resolution is None:
+                # Difference of the cumulative energies, no need for all the
+                # measures
+                energies.append(get_storage(db, config).range_energy(
+                    sensor, start, end, config.get("default_timestep")))
+            else:
+                energies.append(rollups.grouped_energy(
+                    db, sensor, [start, end], resolution,
+                    config.get("default_timestep"))[0])
+        data = add_energies(energies)
+    else:
+        data = get_storage(db, config).by_time(sensor, time1, time2)
 
     if not data:
         data = None
-    else:
-        if watt_euros == "kwatthours" or watt_euros == "euros":
-            data = tools.energy(data)
-            if watt_euros == "euros":
-                data = {"value": (tools.watt_euros(0,
-                                                   'night',
-                                                   data['night_rate'],
-                                                   db) +
-                                  tools.watt_euros(0,
-                                                   'day',
-                                                   data['day_rate'],
-                                                   db))}
-
-        else:
-            data = tools.to_dict(data)
-
-    # Store in cache
-    r.set(watt_euros + "_" + str(sensor) + "_" + "by_id" + "_" +
-          str(time1) + "_" + str(time2),
-          json.dumps(data),
-          int(time2) - int(time1))
+    elif watt_euros == "euros":
+        data = {"value": (tools.watt_euros(0,
+                                           'night',
+                                           data['night_rate'],
+                                           db) +
+                          tools.watt_euros(0,
+                                           'day',
+                                           data['day_rate'],
+                                           db))}
+    elif watt_euros == "watts":
+        data = tools.to_dict(data)
+
+    # Store in cache, until measures are written in the range
+    cache_set(key,
+              data,
+              range_ttl(time2, config.get("default_timestep")),
+              (sensor, time1, time2),
+              generation)
 
     return data
 
 
 def do_cache_group_timestamp(sensor, watt_euros, time1, time2, step, db,
-                             force_refresh=True):
+                             force_refresh=False):
     """
     Computes the cache (if needed) for the API call
     /api/<sensor:int>/get/<watt_euros:re:watts|kwatthours|euros>/by_time/<time1:float>/<time2:float>/<step:float>
 
+    Each group is a bucket, cached by its start and <step> (see
+    range_ttl()), so that overlapping or sliding windows on the same steps
+    only compute their new buckets, or those in which measures were
+    written.
+
     Returns the stored (or computed) data.
     """
-    r = redis.Redis(decode_responses=True)
-    if not force_refresh:
-        data = r.get(watt_euros + "_" + str(sensor) + "_" + "by_time" + "_" +
-                     str(time1) + "_" + str(time2) + "_" + str(step))
-        if data:
-            # If found in cache, return it
-            return json.loads(data)
-
-    steps = [i for i in numpy.arange(time1, time2, step)]
+    timestep = config.get("default_timestep")
+    prefix = key_prefix(watt_euros) + str(sensor) + "_"
+    steps = [float(i) for i in numpy.arange(time1, time2, step)]
     steps.append(time2)
 
-    data = (db.query(database.Measures)
-            .filter(database.Measures.sensor_id == sensor,
-                    database.Measures.timestamp
-                    .between(time1, time2))
-            .order_by(asc(database.Measures.timestamp))
-            .all())
+    # Aligned requests (whole minutes, hours or days) are answered from the
+    # rollups
+    aligned = rollups.coarsest_resolution(steps)
+    resolutions = []
+    for start in steps[:-1]:
+        finest = retention_policy.finest_resolution(start)
+        if finest is not None and (aligned is None or aligned < finest):
+            # Raw measures (or minute rollups) of the group were deleted, use
+            # the finest rollups left
+            resolutions.append(finest)
+        else:
+            resolutions.append(aligned)
+
+    def grouped_energy(first, last):
+        resolution = resolutions[first]
+        if resolution is None:
+            return get_storage(db, config).grouped_energy(
+                sensor, steps[first:last + 2], timestep)
+        return rollups.grouped_energy(db, sensor, steps[first:last + 2],
+                                      resolution, timestep)
+
+    def compute(first, last):
+        energies = []
+        # Consecutive groups of the same resolution at once
+        start = first
+        for i in range(first, last + 1):
+            if i == last or resolutions[i + 1] != resolutions[start]:
+                energies.extend(grouped_energy(start, i))
+                start = i + 1
+        return [convert_energy(energy, watt_euros, step, db)
+                if energy is not None else None
+                for energy in energies]
+
+    closed = closed_ttl()
+    ttls = [range_ttl(steps[i + 1], timestep, closed)
+            if abs(steps[i + 1] - steps[i] - step) < 1e-6
+            else None
+            for i in range(len(steps) - 1)]
+    data = cached_buckets(
+        [prefix + "time_bucket" + "_" +
+         ("raw" if resolution is None else str(resolution)) +
+         "_" + str(step) + "_" + str(start)
+         for start, resolution in zip(steps[:-1], resolutions)],
+        ttls, compute, force_refresh,
+        [(sensor, steps[i], steps[i + 1]) for i in range(len(steps) - 1)])
 
-    if not data:
-        data = [None for i in range(len(steps) - 1)]
-    else:
-        tmp = [[] for i in range(len(steps) - 1)]
-        for i in data:
-            index = bisect.bisect_left(steps, i.timestamp)
-            if index > 0:
-                index -= 1
-            tmp[index].append(i)
-
-        data = []
-        for i in tmp:
-            if len(i) == 0:
-                data.append(None)
-                continue
-
-            energy = tools.energy(i)
-            if watt_euros == "watts":
-                tmp_data = {"value": energy["value"] / step * 1000 * 3600,
-                            "day_rate": energy["day_rate"] / step * 1000 * 3600,
-                            "night_rate": energy["night_rate"] / step * 1000 * 3600}
-            elif watt_euros == 'kwatthours':
-                tmp_data = energy
-            elif watt_euros == 'euros':
-                if energy["night_rate"] != 0:
-                    night_rate = tools.watt_euros(0,
-                                                  'night',
-                                                  energy['night_rate'],
-                                                  db)
-                else:
-                    night_rate = 0
-                if energy["day_rate"] != 0:
-                    day_rate = tools.watt_euros(0,
-                                                'day',
-                                                energy['day_rate'],
-                                                db)
-                else:
-                    day_rate = 0
-                tmp_data = {"value": night_rate + day_rate}
-            data.append(tmp_data)
     if len(data) == 0:
         data = None
-    # Store in cache
-    if time2 < datetime.datetime.now().timestamp():
-        # If new measures are to come, short lifetime (basically timestep)
-        r.setex(watt_euros + "_" + str(sensor) + "_" + "by_time" + "_" +
-                str(time1) + "_" + str(time2) + "_" + str(step),
-                json.dumps(data),
-                int(step))
-    else:
-        # Else, store for a greater lifetime (basically time2 - time1)
-        r.setex(watt_euros + "_" + str(sensor) + "_" + "by_time" + "_" +
-                str(time1) + "_" + str(time2) + "_" + str(step),
-                json.dumps(data),
-                int(time2 - time1))
-
     return data
@@ -18,6 +18,58 @@ def make_sure_path_exists(path):
             return True
 
 
+# Settings introduced after the first release, also filled in when loading the
+# config file of an existing install.
+defaults = {
+    "ingest_batch_size": 100,
+    "ingest_batch_latency": 5,
+    "last_timer_checkpoint": 60,
+    "serial_port": "/dev/ttyACM0",
+    "serial_baudrate": 57600,
+    "serial_buffer_size": 256,
+    # Whether the Arduino sends the nRF24L01+ pipe number before each packet,
+    # required to receive several sensors, see libcitizenwatt.radio
+    "serial_pipe_header": False,
+    "ingest_queue_size": 256,
+    "ingest_stats_interval": 60,
+    "spool_directory": "~/.config/citizenwatt/spool/",
+    "metrics_port": 9101,
+    "maintenance_interval": 3600,
+    # 0 to keep forever, hour and day rollups are always kept
+    "raw_retention_days": 0,
+    "minute_rollups_retention_days": 0,
+    # "sql" or "tsstore", see libcitizenwatt.storage
+    "storage_backend": "sql",
+    "tsstore_directory": "~/.config/citizenwatt/tsstore/",
+    # Database file when database_type is "sqlite", see libcitizenwatt.sqlite
+    "sqlite_path": "~/.config/citizenwatt/citizenwatt.sqlite",
+    # Database engines, see libcitizenwatt.engines
+    "server_threads": 10,
+    "database_pool_size": 10,
+    "database_max_overflow": 2,
+    "database_pool_pre_ping": True,
+    # In s, 0 for none
+    "database_statement_timeout": 30,
+    "database_echo": False,
+    # "redis", "memory" or "none", see libcitizenwatt.cache
+    "cache_backend": "redis",
+    "redis_host": "localhost",
+    "redis_port": 6379,
+    "redis_db": 0,
+    "memory_cache_entries": 10000,
+    # In s, 0 to only use Redis
+    "memory_cache_ttl": 10,
+    # In s, lifetime of the cached API results of closed time ranges, and of
+    # those still open, which are also invalidated when measures are written
+    # (see libcitizenwatt.invalidation)
+    "closed_cache_ttl": 30 * 86400,
+    "live_cache_ttl": 60,
+    # In s, lifetime of the results of closed time ranges when they cannot be
+    # invalidated: without Redis, or while invalidations are pending
+    "uninvalidated_cache_ttl": 3600,
+}
+
+
 class Config():
     def __init__(self, base_config_path="~/.config/citizenwatt/"):
         self.config_path = os.path.expanduser(base_config_path)
@@ -48,6 +100,8 @@ class Config():
         self.set("default_timestep", 8)
         self.set("port", 8080)
         self.set("autoreload", False)
+        for param, value in defaults.items():
+            self.set(param, value)
         self.save()
 
     def load(self):
@@ -70,6 +124,11 @@ class Config():
             except (ValueError, IOError):
                 tools.warning("Config file could not be read.")
                 sys.exit(1)
+            missing = [param for param in defaults if param not in self.config]
+            if missing:
+                for param in missing:
+                    self.set(param, defaults[param])
+                self.save()
 
     def save(self):
         try:
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 from sqlalchemy import Column, Float
-from sqlalchemy import ForeignKey, Integer, Text, VARCHAR
+from sqlalchemy import ForeignKey, Index, Integer, Text, UniqueConstraint
+from sqlalchemy import VARCHAR
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 
@@ -19,11 +20,23 @@ class Sensor(Base):
     last_timer = Column(Integer)
     type = relationship("MeasureType", lazy="joined")
     aes_key = Column(VARCHAR(255))
+    # Address of the base the sensor is paired with, and nRF24L01+ pipe of the
+    # base on which it sends (NULL if it is the only sensor of the base)
     base_address = Column(VARCHAR(30))
+    pipe = Column(Integer)
 
 
 class Measures(Base):
+    """Raw measures.
+
+    On PostgreSQL, the table may be partitioned by month, see
+    libcitizenwatt.partitions. Its primary key is then (id, timestamp), ids
+    still being unique.
+    """
     __tablename__ = "measures"
+    # Every query filters on the sensor, then on (or orders by) the timestamp
+    __table_args__ = (Index("ix_measures_sensor_id_timestamp",
+                            "sensor_id", "timestamp"),)
     id = Column(Integer, primary_key=True)
     sensor_id = Column(Integer,
                        ForeignKey("sensors.id", ondelete="CASCADE"),
@@ -31,6 +44,37 @@ class Measures(Base):
     value = Column(Float)
     timestamp = Column(Integer, index=True)
     night_rate = Column(Integer)  # Boolean, 1 if night_rate
+    # Energy (in kWh) integrated since the first measure of the sensor
+    cumulative_day_rate = Column(Float)
+    cumulative_night_rate = Column(Float)
+
+
+class Rollup(Base):
+    """Aggregates of the measures of a sensor over a time bucket of
+    <resolution> seconds, starting at <start>.
+
+    Energies (in kWh) only integrate the measures inside the bucket. First and
+    last measures are stored, so that consecutive buckets can be joined.
+    """
+    __tablename__ = "rollups"
+    __table_args__ = (UniqueConstraint("sensor_id", "resolution", "start"),)
+    id = Column(Integer, primary_key=True)
+    sensor_id = Column(Integer,
+                       ForeignKey("sensors.id", ondelete="CASCADE"),
+                       nullable=False)
+    resolution = Column(Integer, nullable=False)
+    start = Column(Integer, nullable=False)
+    day_rate = Column(Float)
+    night_rate = Column(Float)
+    count = Column(Integer)
+    min_value = Column(Float)
+    max_value = Column(Float)
+    first_timestamp = Column(Float)
+    first_value = Column(Float)
+    first_night_rate = Column(Integer)
+    last_timestamp = Column(Float)
+    last_value = Column(Float)
+    last_night_rate = Column(Integer)
 
 
 class Provider(Base):
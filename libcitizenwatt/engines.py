@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""Database engines of the CitizenWatt processes, built from the config.
+
+Two kinds of engines are used:
+
+* the web interface uses a pool of database_pool_size connections (plus
+  database_max_overflow ones under load), matching the server_threads of
+  CherryPy, so that requests do not wait for a connection. Its statements are
+  cancelled after database_statement_timeout seconds on PostgreSQL, so that
+  a single costly request does not hold a connection (and the measures it
+  reads) forever;
+* the ingest daemons and manage.py use a writer engine, holding a single
+  connection shared by the sessions and the measures writer, without
+  statement timeout since migrations and maintenance may take long.
+
+SQL statements are only logged if database_echo is set.
+"""
+import sqlalchemy
+
+from libcitizenwatt import sqlite
+from sqlalchemy.orm import sessionmaker
+
+
+def database_url(config):
+    if config.get("database_type") == "sqlite":
+        return sqlite.database_url(config.get("sqlite_path"))
+    return (config.get("database_type") + "://" + config.get("username") +
+            ":" + config.get("password") + "@" + config.get("host") + "/" +
+            config.get("database"))
+
+
+def create_engine(config, writer=False):
+    """Returns an engine on the database of <config>, for a writer process if
+    <writer>, for the web interface otherwise.
+    """
+    echo = config.get("database_echo")
+    if config.get("database_type") == "sqlite":
+        return sqlite.create_engine(config.get("sqlite_path"), writer=writer,
+                                    pool_size=config.get("database_pool_size"),
+                                    echo=echo)
+
+    options = {"echo": echo,
+               "pool_pre_ping": config.get("database_pool_pre_ping")}
+    if writer:
+        options["pool_size"] = 1
+        options["max_overflow"] = 0
+    else:
+        options["pool_size"] = config.get("database_pool_size")
+        options["max_overflow"] = config.get("database_max_overflow")
+        timeout = config.get("database_statement_timeout")
+        if timeout and config.get("database_type").startswith("postgresql"):
+            options["connect_args"] = {
+                "options": "-c statement_timeout=%d" % (timeout * 1000)}
+    return sqlalchemy.create_engine(database_url(config), **options)
+
+
+def create_session_factory(config, writer=False):
+    """Returns an (engine, session factory) tuple, see create_engine()."""
+    engine = create_engine(config, writer)
+    return engine, sessionmaker(bind=engine)
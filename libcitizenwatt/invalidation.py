@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""Invalidation of the cached API results when measures are written.
+
+Cached results computed from the measures of a time range of a sensor are
+registered in the index of the sensor (INDEX, a Redis sorted set of
+"<time1> <key>" members, scored by time2), see cache.RedisCache. Once the
+ingest has committed measures, its Publisher deletes the cached results
+whose range overlaps the time range of the written measures, and publishes
+the written ranges on CHANNEL, so that the web processes drop them from
+their memory cache too (see cache.TieredCache.listen()). Rebuilt rollups and
+data deleted by the retention are invalidated the same way.
+
+The publisher also increments the generation of each sensor (GENERATION)
+before reading its index. The web processes read it before computing a
+result, and drop the result once cached if it changed meanwhile, as it may
+have been computed without the written measures (see cache.RedisCache).
+
+While Redis is unavailable, the ranges to invalidate are kept in the PENDING
+snapshot (see tools.save_snapshot()), and published with the next ones. The
+results of closed ranges are meanwhile cached for a shorter time, see
+pending().
+
+Results of closed time ranges can then be kept for long, and those of the
+ranges still open are computed again as soon as new measures are written.
+"""
+import json
+import os
+import threading
+import time
+
+from libcitizenwatt import tools
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+CHANNEL = "citizenwatt_invalidations"
+INDEX = "citizenwatt_index_%d"
+GENERATION = "citizenwatt_generation_%d"
+PENDING = "pending_invalidations"
+
+
+def index_member(key, time1):
+    return "%r %s" % (float(time1), key)
+
+
+def parse_member(member):
+    """Returns the (key, time1) of an index member."""
+    time1, key = member.split(" ", 1)
+    return key, float(time1)
+
+
+def overlaps(time_range, time1, time2):
+    """Returns whether <time_range> (a (time1, time2) tuple) overlaps the
+    range from <time1> to <time2>, bounds included.
+    """
+    return time_range[0] <= time2 and time_range[1] >= time1
+
+
+def written_ranges(rows):
+    """Returns the time range of the measures <rows> (as dicts, see
+    writer.MeasuresWriter) of each sensor, as a dict of (time1, time2)
+    tuples.
+    """
+    ranges = {}
+    for row in rows:
+        sensor, timestamp = row["sensor_id"], row["timestamp"]
+        if sensor in ranges:
+            time1, time2 = ranges[sensor]
+            ranges[sensor] = (min(time1, timestamp), max(time2, timestamp))
+        else:
+            ranges[sensor] = (timestamp, timestamp)
+    return ranges
+
+
+def merge_ranges(ranges, others):
+    """Returns the union of the time ranges of each sensor in <ranges> and
+    <others>, as a dict of (time1, time2) tuples.
+    """
+    merged = dict(ranges)
+    for sensor, (time1, time2) in others.items():
+        if sensor in merged:
+            merged[sensor] = (min(merged[sensor][0], time1),
+                              max(merged[sensor][1], time2))
+        else:
+            merged[sensor] = (time1, time2)
+    return merged
+
+
+def pending():
+    """Returns whether invalidations could not be published, so that the
+    results cached meanwhile may miss theirs.
+    """
+    return os.path.exists(tools.snapshot_path(PENDING))
+
+
+def encode_ranges(ranges):
+    return json.dumps([[sensor, time1, time2]
+                       for sensor, (time1, time2) in sorted(ranges.items())])
+
+
+def decode_ranges(message):
+    return {sensor: (time1, time2)
+            for sensor, time1, time2 in json.loads(message)}
+
+
+class Publisher():
+    """Invalidates the cached results overlapping the measures written by
+    the ingest, in the Redis database of the cache.
+
+    Index members of ranges ending more than <max_age> seconds ago are
+    dropped, their results not being invalidated by measures older than
+    that. Redis errors are reported once, the ranges are then kept in the
+    PENDING snapshot until they are published.
+    """
+    def __init__(self, host="localhost", port=6379, db=0, max_age=None,
+                 timeout=1):
+        self.redis = redis.Redis(host=host, port=port, db=db,
+                                 decode_responses=True,
+                                 socket_timeout=timeout,
+                                 socket_connect_timeout=timeout)
+        self.max_age = max_age
+        self.available = True
+        self.lock = threading.Lock()
+        self.pending = {sensor: (time1, time2) for sensor, time1, time2
+                        in tools.load_snapshot(PENDING) or []}
+
+    def written(self, rows):
+        """Invalidates the results overlapping the committed measures
+        <rows>.
+        """
+        if rows:
+            self.publish(written_ranges(rows))
+
+    def publish(self, ranges):
+        """Deletes the cached results overlapping the time range of their
+        sensor in <ranges>, along with the pending ones, then publishes
+        them.
+        """
+        with self.lock:
+            ranges = merge_ranges(self.pending, ranges)
+            if self.publish_now(ranges):
+                if self.pending:
+                    self.pending = {}
+                    tools.drop_snapshot(PENDING)
+            else:
+                self.pending = ranges
+                try:
+                    tools.save_snapshot(PENDING,
+                                        [[sensor, time1, time2]
+                                         for sensor, (time1, time2)
+                                         in sorted(ranges.items())])
+                except OSError as e:
+                    tools.warning("Pending invalidations not saved : " +
+                                  str(e))
+
+    def publish_now(self, ranges):
+        """Publishes <ranges>, returns False on Redis errors."""
+        try:
+            pipeline = self.redis.pipeline(transaction=False)
+            for sensor, (time1, time2) in ranges.items():
+                # Before reading the index, so that the results cached
+                # after it are dropped by the web processes
+                pipeline.incr(GENERATION % sensor)
+                pipeline.zrangebyscore(INDEX % sensor, time1, "+inf")
+            indexes = pipeline.execute()[1::2]
+
+            pipeline = self.redis.pipeline(transaction=False)
+            for (sensor, (time1, time2)), members in zip(ranges.items(),
+                                                         indexes):
+                stale = [member for member in members
+                         if parse_member(member)[1] <= time2]
+                if stale:
+                    pipeline.delete(*[parse_member(member)[0]
+                                      for member in stale])
+                    pipeline.zrem(INDEX % sensor, *stale)
+                if self.max_age:
+                    pipeline.zremrangebyscore(INDEX % sensor, "-inf",
+                                              "(%r" % (time.time() -
+                                                       self.max_age))
+            pipeline.publish(CHANNEL, encode_ranges(ranges))
+            pipeline.execute()
+        except redis.RedisError as e:
+            if self.available:
+                tools.warning("Redis unavailable, cached results are not " +
+                              "invalidated : " + str(e))
+            self.available = False
+            return False
+        self.available = True
+        return True
+
+
+def get_publisher(config):
+    """Returns the Publisher of the cache set in <config>, or None if the
+    results are not cached in Redis.
+    """
+    if config.get("cache_backend") != "redis" or redis is None:
+        return None
+    return Publisher(config.get("redis_host"),
+                     config.get("redis_port"),
+                     config.get("redis_db"),
+                     config.get("closed_cache_ttl"))
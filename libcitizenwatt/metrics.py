@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""Ingest metrics, exposed in the Prometheus text format."""
+import http.server
+import socketserver
+import threading
+
+from libcitizenwatt import tools
+
+
+class Metric():
+    """Base class for metrics, optionally split by label values."""
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.lock = threading.Lock()
+        self.values = {}
+        metrics.append(self)
+
+    def key(self, labels):
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def format_labels(self, key, extra=None):
+        pairs = list(zip(self.labels, key))
+        if extra:
+            pairs.append(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join('%s="%s"' % pair for pair in pairs) + "}"
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help),
+                 "# TYPE %s %s" % (self.name, self.type)]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.extend(self.render_value(key, value))
+        return lines
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        if not labels:
+            self.values[()] = 0
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render_value(self, key, value):
+        return ["%s%s %s" % (self.name, self.format_labels(key), value)]
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, buckets, labels=()):
+        super().__init__(name, help, labels)
+        self.buckets = sorted(buckets)
+        if not labels:
+            self.values[()] = ([0] * len(self.buckets), 0, 0)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts, total, count = self.values.get(
+                key, ([0] * len(self.buckets), 0, 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self.values[key] = (counts, total + value, count + 1)
+
+    def render_value(self, key, value):
+        counts, total, count = value
+        lines = ["%s_bucket%s %d" % (self.name,
+                                     self.format_labels(key, ("le", bound)),
+                                     bucket_count)
+                 for bound, bucket_count in zip(self.buckets, counts)]
+        lines.append("%s_bucket%s %d" % (self.name,
+                                         self.format_labels(key,
+                                                            ("le", "+Inf")),
+                                         count))
+        lines.append("%s_sum%s %s" % (self.name, self.format_labels(key),
+                                      total))
+        lines.append("%s_count%s %d" % (self.name, self.format_labels(key),
+                                        count))
+        return lines
+
+
+metrics = []
+
+packets_received = Counter("citizenwatt_packets_received_total",
+                           "Packets received from the radio.")
+packets_decrypted = Counter("citizenwatt_packets_decrypted_total",
+                            "Packets decrypted with their sensor's key.")
+packets_rejected = Counter("citizenwatt_packets_rejected_total",
+                           "Packets skipped, by reason.",
+                           labels=("reason",))
+measures_inserted = Counter("citizenwatt_measures_inserted_total",
+                            "Measures committed to the database.")
+db_commit_seconds = Histogram("citizenwatt_db_commit_seconds",
+                              "Duration of the database commits.",
+                              (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1,
+                               2.5, 5, 10))
+timer_lag_seconds = Histogram("citizenwatt_timer_lag_seconds",
+                              "Drift between the sensor timer and the wall " +
+                              "clock, since the timer was first seen.",
+                              (0.1, 0.5, 1, 2, 5, 10, 30, 60, 300),
+                              labels=("sensor",))
+
+
+def render():
+    """Returns all the metrics in the Prometheus text format."""
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+def serve(port, host="127.0.0.1"):
+    """Serves the metrics on http://<host>:<port>/metrics, in a background
+    thread.
+
+    Returns the server, or None if the port cannot be bound (the metrics are
+    then only kept in memory).
+    """
+    try:
+        server = MetricsServer((host, port), MetricsHandler)
+    except OSError as e:
+        tools.warning("Unable to serve the metrics on port " + str(port) +
+                      " : " + str(e))
+        return None
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+"""Schema upgrades of existing databases.
+
+Base.metadata.create_all() only creates the missing tables. The upgrades here
+bring the tables of an existing database to the current models, and fill in
+the data derived from the raw measures.
+"""
+import functools
+
+from libcitizenwatt import database
+from libcitizenwatt import partitions
+from libcitizenwatt import retention
+from libcitizenwatt import rollups
+from libcitizenwatt import tools
+from libcitizenwatt.rollups import segment_energy
+from sqlalchemy import and_, asc, bindparam, inspect, or_, select, text
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.schema import CreateIndex
+
+
+# Block range index on the timestamps, see create_brin_index()
+BRIN_INDEX = "ix_measures_timestamp_brin"
+
+
+def add_missing_columns(engine):
+    """Adds the columns of the models which are missing from their (existing)
+    table. Returns the list of added "table.column".
+    """
+    quote = engine.dialect.identifier_preparer.quote
+    added = []
+    with engine.begin() as conn:
+        # Through <conn>, engines of the ingest hold a single connection
+        inspector = inspect(conn)
+        tables = inspector.get_table_names()
+        for table in database.Base.metadata.sorted_tables:
+            if table.name not in tables:
+                continue
+            existing = {column["name"]
+                        for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                conn.execute("ALTER TABLE %s ADD COLUMN %s %s" % (
+                    quote(table.name),
+                    quote(column.name),
+                    column.type.compile(dialect=engine.dialect)))
+                added.append(table.name + "." + column.name)
+    return added
+
+
+def invalid_indexes(conn):
+    """Returns the names of the PostgreSQL indexes left invalid by an
+    interrupted CREATE INDEX CONCURRENTLY.
+    """
+    return {row[0] for row in conn.execute(
+        "SELECT c.relname FROM pg_index i " +
+        "JOIN pg_class c ON c.oid = i.indexrelid " +
+        "WHERE NOT i.indisvalid")}
+
+
+def execute_index_ddl(engine, statements):
+    """Runs index DDL <statements> outside of any transaction, as required by
+    the CONCURRENTLY variants on PostgreSQL.
+    """
+    with engine.connect() as conn:
+        conn = conn.execution_options(isolation_level="AUTOCOMMIT")
+        for statement in statements:
+            conn.execute(statement)
+
+
+def create_indexes(engine):
+    """Creates the indexes of the models which are missing from their
+    (existing) table. Returns the list of created index names.
+
+    On PostgreSQL, indexes are built CONCURRENTLY, so that the measures keep
+    being written meanwhile on a large database, and invalid indexes left by
+    an interrupted build are built again. Indexes of partitioned tables, which
+    cannot be built concurrently, are built on each partition.
+    """
+    postgresql = engine.dialect.name == "postgresql"
+    inspector = inspect(engine)
+    tables = inspector.get_table_names()
+    invalid = set()
+    if postgresql:
+        with engine.connect() as conn:
+            invalid = invalid_indexes(conn)
+    created = []
+    for table in database.Base.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        partitioned = False
+        if postgresql:
+            with engine.connect() as conn:
+                partitioned = partitions.is_partitioned(conn, table.name)
+                # Also lists the indexes of partitioned tables
+                existing = {row[0] for row in conn.execute(
+                    text("SELECT indexname FROM pg_indexes " +
+                         "WHERE tablename = :table"),
+                    table=table.name)}
+        else:
+            existing = {index["name"]
+                        for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name in existing and index.name not in invalid:
+                continue
+            statements = []
+            create = str(CreateIndex(index).compile(dialect=engine.dialect))
+            if postgresql and not partitioned:
+                if index.name in invalid:
+                    statements.append("DROP INDEX CONCURRENTLY IF EXISTS " +
+                                      index.name)
+                create = create.replace("INDEX", "INDEX CONCURRENTLY", 1)
+            statements.append(create)
+            execute_index_ddl(engine, statements)
+            created.append(index.name)
+    return created
+
+
+def create_brin_index(engine, pages_per_range=32):
+    """Creates a BRIN index on the timestamps of the measures (PostgreSQL
+    only).
+
+    Measures are appended in timestamp order, so a block range index is a
+    fraction of the size of a B-tree for time range scans, at the cost of
+    reading <pages_per_range> pages per matching range. See
+    tests/bench_indexes.py to compare them on a given base.
+    """
+    if engine.dialect.name != "postgresql":
+        raise ValueError("BRIN indexes are only supported by PostgreSQL.")
+    with engine.connect() as conn:
+        # Partitioned tables cannot be indexed concurrently
+        concurrently = ("" if partitions.is_partitioned(conn)
+                        else " CONCURRENTLY")
+        statements = []
+        if BRIN_INDEX in invalid_indexes(conn):
+            statements.append("DROP INDEX" + concurrently + " " + BRIN_INDEX)
+    statements.append("CREATE INDEX" + concurrently + " IF NOT EXISTS " +
+                      BRIN_INDEX + " ON measures USING brin (timestamp) " +
+                      "WITH (pages_per_range = %d)" % pages_per_range)
+    execute_index_ddl(engine, statements)
+
+
+def backfill_cumulative(engine, chunk_size=10000):
+    """Computes the cumulative energies of the sensors having measures
+    without them.
+
+    The measures of such sensors are integrated again from the first one, one
+    transaction per chunk of <chunk_size> measures, so that an interrupted
+    backfill is simply run again.
+    """
+    measures = database.Measures.__table__
+    with engine.begin() as conn:
+        sensors = [row[0] for row in conn.execute(
+            select([measures.c.sensor_id])
+            .where(measures.c.cumulative_day_rate.is_(None))
+            .distinct())]
+
+    update = (measures.update()
+              .where(measures.c.id == bindparam("measure"))
+              .values(cumulative_day_rate=bindparam("cumulative_day"),
+                      cumulative_night_rate=bindparam("cumulative_night")))
+    for sensor_id in sensors:
+        last = None
+        previous = None
+        day_rate, night_rate = 0, 0
+        while True:
+            with engine.begin() as conn:
+                query = (select([measures.c.id,
+                                 measures.c.timestamp,
+                                 measures.c.value,
+                                 measures.c.night_rate])
+                         .where(measures.c.sensor_id == sensor_id)
+                         .order_by(asc(measures.c.timestamp),
+                                   asc(measures.c.id))
+                         .limit(chunk_size))
+                if last is not None:
+                    query = query.where(
+                        or_(measures.c.timestamp > last[0],
+                            and_(measures.c.timestamp == last[0],
+                                 measures.c.id > last[1])))
+                rows = conn.execute(query).fetchall()
+                if not rows:
+                    break
+                params = []
+                for row in rows:
+                    if previous is not None and row["timestamp"] > previous[0]:
+                        segment = segment_energy(previous[0], previous[1],
+                                                 previous[2],
+                                                 row["timestamp"],
+                                                 row["value"],
+                                                 row["night_rate"])
+                        day_rate += segment[0]
+                        night_rate += segment[1]
+                    params.append({"measure": row["id"],
+                                   "cumulative_day": day_rate,
+                                   "cumulative_night": night_rate})
+                    previous = (row["timestamp"], row["value"],
+                                row["night_rate"])
+                conn.execute(update, params)
+                last = (rows[-1]["timestamp"], rows[-1]["id"])
+    return sensors
+
+
+def maintain(engine, retention_policy=None, store=None, invalidation=None):
+    """Periodic maintenance of the database, run by the ingest daemons.
+
+    Old data is deleted according to <retention_policy>, if given, from the
+    time-series <store> too if the measures are stored there, and its cached
+    results are invalidated by the <invalidation> publisher, if given.
+    """
+    for partition in partitions.ensure_partitions(engine):
+        print("Created partition " + partition + ".")
+    if retention_policy is not None:
+        deleted, dropped, deleted_rollups = retention.compact(
+            engine, retention_policy, store=store, invalidation=invalidation)
+        if deleted or dropped or deleted_rollups:
+            print("Retention: deleted %d measures, %d minute rollups" % (
+                      deleted, deleted_rollups) +
+                  "".join(", dropped " + partition for partition in dropped) +
+                  ".")
+
+
+def upgrade_schema(engine):
+    """Brings the tables of the database behind <engine> to the current
+    models: missing tables, columns and partitions only, so that it is quick
+    enough to run when the daemons start.
+    """
+    database.Base.metadata.create_all(engine)
+    for column in add_missing_columns(engine):
+        print("Added column " + column + ".")
+    for partition in partitions.ensure_partitions(engine):
+        print("Created partition " + partition + ".")
+
+
+def upgrade(engine):
+    """Brings the database behind <engine> to the current schema, and fills
+    in the data derived from the raw measures: indexes, cumulative energies
+    and rollups.
+
+    This may take long on a large database, it is run by manage.py upgrade
+    (see post_update.sh). Meanwhile, the API integrates the measures
+    without cumulative energies (see tools.range_energy()).
+    """
+    upgrade_schema(engine)
+    for index in create_indexes(engine):
+        print("Created index " + index + ".")
+    if backfill_cumulative(engine):
+        print("Cumulative energies computed.")
+    for sensor_id in rollups.needs_rebuild(engine):
+        print("Building the rollups of sensor %d from its measures..." %
+              sensor_id)
+        rollups.rebuild(engine, sensor_id)
+
+
+def upgrade_or_defer(engine):
+    """Upgrades the schema of the database behind <engine> if it is available
+    (see upgrade_schema()).
+
+    Otherwise, returns the upgrade to run once it is available, before the
+    first write of the ingest (see writer.MeasuresWriter), so that the ingest
+    starts and spools the measures meanwhile. Returns None if the database
+    was upgraded.
+    """
+    try:
+        upgrade_schema(engine)
+    except SQLAlchemyError as e:
+        tools.warning("Database unavailable, it will be upgraded before " +
+                      "the first write : " + str(e))
+        return functools.partial(upgrade_schema, engine)
+    return None
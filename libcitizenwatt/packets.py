@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""Decryption and decoding of the packets sent by the sensors."""
+import json
+import numpy
+import struct
+
+from Crypto.Cipher import AES
+from libcitizenwatt.transport import PACKET_SIZE
+
+
+PACKET_FORMAT = struct.Struct("<HHHLlH")
+
+PACKET_DTYPE = numpy.dtype([("power", "<u2"),
+                            ("voltage", "<u2"),
+                            ("battery", "<u2"),
+                            ("timer", "<u4"),
+                            ("reserved", "<i4"),
+                            ("padding", "<u2")])
+
+assert PACKET_FORMAT.size == PACKET_DTYPE.itemsize == PACKET_SIZE
+
+
+class PacketDecoder():
+    """Decrypts and decodes packets, reusing one cipher per AES key.
+
+    Packets are encrypted with AES in ECB mode, so each 16 bytes block can be
+    decrypted independently and a whole batch of packets is decrypted in a
+    single call.
+    """
+    def __init__(self):
+        self.ciphers = {}
+
+    def cipher(self, key):
+        """Returns the cipher associated to <key> (16 bytes)."""
+        cipher = self.ciphers.get(key)
+        if cipher is None:
+            cipher = AES.new(key, AES.MODE_ECB)
+            self.ciphers[key] = cipher
+        return cipher
+
+    def decrypt(self, key, packets):
+        """Decrypts a list of packets, returns the concatenated plaintexts."""
+        return self.cipher(key).decrypt(b"".join(packets))
+
+    def decode(self, key, packets):
+        """Decrypts and decodes a list of packets.
+
+        Returns a NumPy structured array of PACKET_DTYPE.
+        """
+        return numpy.frombuffer(self.decrypt(key, packets), dtype=PACKET_DTYPE)
+
+    def decode_one(self, key, packet):
+        """Decrypts and decodes a single packet.
+
+        Returns a tuple (power, voltage, battery, timer, reserved, padding).
+        """
+        return PACKET_FORMAT.unpack(self.cipher(key).decrypt(packet))
+
+
+def key_from_json(aes_key):
+    """Converts an AES key as stored in the database (JSON list of 16
+    integers) to bytes.
+    """
+    return bytes(json.loads(aes_key))
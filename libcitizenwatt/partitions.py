@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+"""Monthly range partitioning of the measures (PostgreSQL 11 or later).
+
+The partitioned measures table keeps the columns of database.Measures, with
+(id, timestamp) as primary key since it must include the partition key. Each
+month is stored in its own measures_YYYY_MM partition (months are in UTC), so
+that queries on a time range only scan the matching partitions, and dropping
+old measures is a DETACH and DROP of whole partitions instead of a DELETE.
+
+Partitions are created a few months ahead by ensure_partitions(), which the
+ingest daemons run periodically. Measures out of the monthly partitions (e.g.
+from a sensor with a wrong clock) go to the measures_default partition, and
+are moved to the partition of their month once it is created.
+"""
+import calendar
+import datetime
+import re
+import time
+
+from libcitizenwatt import database
+from sqlalchemy import text
+from sqlalchemy.sql import column, table
+
+
+TABLE = "measures"
+OLD_TABLE = "measures_old"
+DEFAULT = "measures_default"
+PARTITION_NAME = re.compile(r"^measures_(\d{4})_(\d{2})$")
+
+
+def month_start(year, month):
+    """Returns the timestamp of the first second of <month>, in UTC."""
+    year, month = year + (month - 1) // 12, (month - 1) % 12 + 1
+    return calendar.timegm((year, month, 1, 0, 0, 0))
+
+
+def month_of(timestamp):
+    """Returns the (year, month) containing <timestamp>, in UTC."""
+    date = datetime.datetime.utcfromtimestamp(timestamp)
+    return date.year, date.month
+
+
+def months(first, last):
+    """Yields the (year, month) from <first> to <last> included."""
+    year, month = first
+    while (year, month) <= last:
+        yield year, month
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+
+def partition_name(year, month):
+    return "%s_%04d_%02d" % (TABLE, year, month)
+
+
+def is_supported(conn):
+    return (conn.dialect.name == "postgresql" and
+            conn.dialect.server_version_info >= (11,))
+
+
+def table_exists(conn, table):
+    return conn.execute(text("SELECT to_regclass(:table) IS NOT NULL"),
+                        table=table).scalar()
+
+
+def is_partitioned(conn, table=TABLE):
+    """Returns True if <table> is a partitioned table."""
+    if conn.dialect.name != "postgresql":
+        return False
+    return bool(conn.execute(
+        text("SELECT count(*) FROM pg_partitioned_table p " +
+             "JOIN pg_class c ON c.oid = p.partrelid " +
+             "WHERE c.relname = :table"),
+        table=table).scalar())
+
+
+def partitions(conn):
+    """Returns the monthly partitions of the measures, as a sorted list of
+    (year, month).
+    """
+    rows = conn.execute(
+        text("SELECT c.relname FROM pg_inherits i " +
+             "JOIN pg_class c ON c.oid = i.inhrelid " +
+             "JOIN pg_class p ON p.oid = i.inhparent " +
+             "WHERE p.relname = :table"),
+        table=TABLE)
+    result = []
+    for row in rows:
+        match = PARTITION_NAME.match(row[0])
+        if match:
+            result.append((int(match.group(1)), int(match.group(2))))
+    return sorted(result)
+
+
+def default_table():
+    """Returns the DEFAULT partition, for SQL expressions."""
+    return table(DEFAULT, column("id"), column("timestamp"))
+
+
+def create_default_partition(conn):
+    conn.execute("CREATE TABLE IF NOT EXISTS %s PARTITION OF %s DEFAULT" % (
+        DEFAULT, TABLE))
+
+
+def move_measures(conn, source, target, year, month):
+    """Moves the measures of <month> from the table <source> to <target>."""
+    columns = ", ".join(column.name
+                        for column in database.Measures.__table__.columns)
+    conn.execute("WITH moved AS (DELETE FROM %s " % source +
+                 "WHERE timestamp >= %d AND timestamp < %d " % (
+                     month_start(year, month), month_start(year, month + 1)) +
+                 "RETURNING %s) " % columns +
+                 "INSERT INTO %s (%s) SELECT %s FROM moved" % (
+                     target, columns, columns))
+
+
+def create_partition(conn, year, month):
+    """Creates the partition of <month>, if missing.
+
+    A partition can not be created while the DEFAULT partition holds
+    measures of its month: they are moved to the new table first, which is
+    then attached.
+    """
+    name = partition_name(year, month)
+    bounds = "FOR VALUES FROM (%d) TO (%d)" % (month_start(year, month),
+                                               month_start(year, month + 1))
+    if not table_exists(conn, DEFAULT):
+        conn.execute("CREATE TABLE IF NOT EXISTS %s PARTITION OF %s " % (
+            name, TABLE) + bounds)
+        return
+    if table_exists(conn, name):
+        return
+    conn.execute("CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS)" % (name,
+                                                                   TABLE))
+    move_measures(conn, DEFAULT, name, year, month)
+    conn.execute("ALTER TABLE %s ATTACH PARTITION %s " % (TABLE, name) +
+                 bounds)
+
+
+def ensure_partitions(engine, months_ahead=2, now=None):
+    """Creates the partitions of the current month and of the <months_ahead>
+    next ones, and the DEFAULT partition, if the measures are partitioned.
+    Returns the names of the created partitions.
+    """
+    if now is None:
+        now = time.time()
+    created = []
+    with engine.begin() as conn:
+        if not is_partitioned(conn):
+            return created
+        if not table_exists(conn, DEFAULT):
+            create_default_partition(conn)
+            created.append(DEFAULT)
+        existing = set(partitions(conn))
+        year, month = month_of(now)
+        for year, month in months((year, month), month_of(
+                month_start(year, month + months_ahead))):
+            if (year, month) not in existing:
+                create_partition(conn, year, month)
+                created.append(partition_name(year, month))
+    return created
+
+
+def drop_partitions(engine, before):
+    """Detaches and drops the partitions holding only measures older than
+    <before>. Returns the names of the dropped partitions.
+    """
+    dropped = []
+    with engine.begin() as conn:
+        if not is_partitioned(conn):
+            return dropped
+        old = [(year, month) for year, month in partitions(conn)
+               if month_start(year, month + 1) <= before]
+    for year, month in old:
+        name = partition_name(year, month)
+        with engine.begin() as conn:
+            conn.execute("ALTER TABLE %s DETACH PARTITION %s" % (TABLE, name))
+            conn.execute("DROP TABLE %s" % name)
+        dropped.append(name)
+    return dropped
+
+
+def column_definitions(engine):
+    """Returns the column definitions of database.Measures, for the
+    partitioned table.
+    """
+    definitions = []
+    for column in database.Measures.__table__.columns:
+        definition = "%s %s" % (column.name,
+                                column.type.compile(dialect=engine.dialect))
+        if column.name == "id":
+            definition += " NOT NULL"
+        definitions.append(definition)
+    return definitions
+
+
+def migrate(engine, months_ahead=2, progress=None):
+    """Moves the measures to a partitioned table.
+
+    The table is renamed to measures_old, then its measures are moved to the
+    new partitioned table one month per transaction, so that an interrupted
+    migration is resumed by running it again. The ingest must be stopped
+    meanwhile.
+    """
+    with engine.begin() as conn:
+        if not is_supported(conn):
+            raise ValueError("Partitioning requires PostgreSQL 11 or later.")
+        if is_partitioned(conn) and not table_exists(conn, OLD_TABLE):
+            return
+        if not is_partitioned(conn):
+            create_table(engine, conn)
+
+    with engine.begin() as conn:
+        first, last = conn.execute("SELECT min(timestamp), max(timestamp) " +
+                                   "FROM " + OLD_TABLE).first()
+    if first is not None:
+        for year, month in months(month_of(first), month_of(last)):
+            with engine.begin() as conn:
+                create_partition(conn, year, month)
+                move_measures(conn, OLD_TABLE, TABLE, year, month)
+            if progress is not None:
+                progress(partition_name(year, month))
+
+    with engine.begin() as conn:
+        remaining = conn.execute("SELECT count(*) FROM " +
+                                 OLD_TABLE).scalar()
+        if remaining:
+            raise ValueError("%d measures without timestamp left in %s." % (
+                remaining, OLD_TABLE))
+        conn.execute("DROP TABLE " + OLD_TABLE)
+        for index in database.Measures.__table__.indexes:
+            conn.execute("CREATE INDEX IF NOT EXISTS %s ON %s (%s)" % (
+                index.name, TABLE,
+                ", ".join(column.name for column in index.columns)))
+    ensure_partitions(engine, months_ahead)
+
+
+def create_table(engine, conn):
+    """Renames the measures table to measures_old and creates the partitioned
+    measures table in its place, reusing its id sequence.
+    """
+    sequence = conn.execute(text("SELECT pg_get_serial_sequence(:table, " +
+                                 "'id')"),
+                            table=TABLE).scalar()
+    conn.execute("ALTER TABLE %s RENAME TO %s" % (TABLE, OLD_TABLE))
+    # Index and constraint names are unique per schema
+    conn.execute("ALTER TABLE %s RENAME CONSTRAINT %s_pkey TO %s_pkey" % (
+        OLD_TABLE, TABLE, OLD_TABLE))
+    for row in conn.execute(text("SELECT indexname FROM pg_indexes " +
+                                 "WHERE tablename = :table " +
+                                 "AND indexname != :pkey"),
+                            table=OLD_TABLE, pkey=OLD_TABLE + "_pkey"):
+        conn.execute("ALTER INDEX %s RENAME TO %s_old" % (row[0], row[0]))
+
+    conn.execute("CREATE TABLE %s (" % TABLE +
+                 ", ".join(column_definitions(engine)) + ", " +
+                 "PRIMARY KEY (id, timestamp), " +
+                 "FOREIGN KEY (sensor_id) REFERENCES sensors (id) " +
+                 "ON DELETE CASCADE" +
+                 ") PARTITION BY RANGE (timestamp)")
+    create_default_partition(conn)
+    if sequence:
+        conn.execute("ALTER TABLE %s ALTER COLUMN id " % TABLE +
+                     "SET DEFAULT nextval('%s')" % sequence)
+        conn.execute("ALTER SEQUENCE %s OWNED BY %s.id" % (sequence, TABLE))
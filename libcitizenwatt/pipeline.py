@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+"""Ingest pipeline, from the encrypted packets to the stored measures."""
+import asyncio
+import concurrent.futures
+import signal
+import threading
+import time
+
+from libcitizenwatt import metrics
+from libcitizenwatt import tools
+
+
+def decode_frames(frames, registry, decoder, tariff_schedule):
+    """Routes (address, pipe, received, packet) frames to their sensor,
+    decrypts, decodes and validates them.
+
+    Each measure is timestamped with the time at which its own packet was
+    received, and its rate is set according to that time.
+
+    Returns a tuple (measures, rejected) where measures is a list of
+    (sensor_id, power, timestamp, night_rate, timer) tuples, and rejected the
+    number of packets which were skipped.
+    """
+    metrics.packets_received.inc(len(frames))
+
+    # Route the packets to their sensor, keeping their order
+    rejected = 0
+    by_sensor = {}
+    for address, pipe, received, packet in frames:
+        sensor = registry.get(address, pipe)
+        if sensor is None:
+            tools.warning("Packet from unknown sensor (base address " +
+                          hex(address) + ", pipe " + str(pipe) +
+                          "), skipping it")
+            metrics.packets_rejected.inc(reason="unknown_sensor")
+            rejected += 1
+            continue
+        by_sensor.setdefault(sensor, []).append((received, packet))
+
+    measures = []
+    for sensor, items in by_sensor.items():
+        decoded = decoder.decode(sensor.key,
+                                 [packet for _, packet in items])
+        metrics.packets_decrypted.inc(len(decoded))
+        night_rates = tariff_schedule.night_rates(
+            [received for received, _ in items])
+        for (received, _), measure, night_rate in zip(items, decoded,
+                                                      night_rates):
+            timer = int(measure["timer"])
+            if not sensor.accept_timer(timer):
+                tools.warning("Invalid timer in the last packet, skipping it")
+                metrics.packets_rejected.inc(reason="invalid_timer")
+                rejected += 1
+                continue
+            metrics.timer_lag_seconds.observe(
+                sensor.timer_lag(timer, received), sensor=sensor.id)
+            measures.append((sensor.id, int(measure["power"]), received,
+                             int(night_rate), timer))
+    return measures, rejected
+
+
+class StageStats():
+    """Number of items handled by a pipeline stage, and their latency."""
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.total_latency = 0
+        self.max_latency = 0
+
+    def record(self, latency):
+        self.count += 1
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+
+    def summary(self):
+        mean = self.total_latency / self.count if self.count else 0
+        return "%d items, latency mean %.1f ms, max %.1f ms" % (
+            self.count, mean * 1000, self.max_latency * 1000)
+
+
+class IngestService():
+    """Reads the packets from the serial link, decodes them and writes the
+    measures to the database, in a single process.
+
+    The three stages are connected by bounded queues: when the database is
+    slow, the writer stops consuming, the queues fill up, and the serial
+    reader stops reading until there is room again.
+
+    If given, <maintenance> is called every <maintenance_interval> seconds,
+    in an executor.
+
+    The service runs until stop() is called or SIGTERM or SIGINT is received.
+    The measures still queued are then written, see run().
+    """
+    def __init__(self, receiver, base_address, registry, decoder,
+                 tariff_schedule, writer, queue_size=256, batch_size=100,
+                 stats_interval=60, maintenance=None,
+                 maintenance_interval=3600):
+        self.receiver = receiver
+        self.base_address = base_address
+        self.registry = registry
+        self.decoder = decoder
+        self.tariff_schedule = tariff_schedule
+        self.writer = writer
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.stats_interval = stats_interval
+        self.maintenance = maintenance
+        self.maintenance_interval = maintenance_interval
+        self.packets = None
+        self.measures = None
+        # Decoded measures not queued yet
+        self.decoded = []
+        self.stopping = threading.Event()
+        self.reader_error = None
+        # Flushes run one at a time, in their own thread
+        self.executor = None
+        self.tasks = []
+        self.stats = {"decode": StageStats(), "write": StageStats()}
+        self.rejected = 0
+
+    def read_serial_forever(self, loop):
+        """Reads the serial port until the service stops, in its own thread.
+        """
+        while not self.stopping.is_set():
+            for received, pipe, packet in self.receiver.read_packets():
+                item = (time.monotonic(), self.base_address.get(), pipe,
+                        received, packet)
+                # Blocks while the queue is full
+                try:
+                    asyncio.run_coroutine_threadsafe(self.packets.put(item),
+                                                     loop).result()
+                except (concurrent.futures.CancelledError, RuntimeError):
+                    # The event loop stopped
+                    return
+
+    def read_serial_thread(self, loop):
+        try:
+            self.read_serial_forever(loop)
+        except Exception as e:
+            self.reader_error = e
+
+    async def read_serial(self):
+        """Runs read_serial_forever() in a daemon thread, which does not
+        prevent the process from exiting while it waits for the serial port.
+        """
+        thread = threading.Thread(target=self.read_serial_thread,
+                                  args=(asyncio.get_event_loop(),),
+                                  daemon=True)
+        thread.start()
+        while thread.is_alive():
+            await asyncio.sleep(1)
+        if self.reader_error is not None:
+            raise self.reader_error
+
+    def decode_items(self, items):
+        """Decodes the queued packets <items>, returns their measures."""
+        measures, rejected = decode_frames(
+            [(address, pipe, received, packet)
+             for _, address, pipe, received, packet in items],
+            self.registry, self.decoder, self.tariff_schedule)
+        self.rejected += rejected
+
+        decoded = time.monotonic()
+        for queued, _, _, _, _ in items:
+            self.stats["decode"].record(decoded - queued)
+        return [(decoded, measure) for measure in measures]
+
+    async def decode(self):
+        while True:
+            items = [await self.packets.get()]
+            while len(items) < self.batch_size and not self.packets.empty():
+                items.append(self.packets.get_nowait())
+
+            self.decoded = self.decode_items(items)
+            while self.decoded:
+                await self.measures.put(self.decoded[0])
+                del self.decoded[0]
+
+    async def flush(self, pending, checkpoint=False):
+        loop = asyncio.get_event_loop()
+        try:
+            await loop.run_in_executor(self.executor, self.writer.flush,
+                                       checkpoint)
+        except Exception as e:
+            print("DB commit failed : " + str(e))
+            return
+        committed = time.monotonic()
+        for decoded in pending:
+            self.stats["write"].record(committed - decoded)
+        del pending[:]
+
+    async def write(self):
+        pending = []
+        while True:
+            try:
+                decoded, measure = await asyncio.wait_for(
+                    self.measures.get(), self.writer.timeout())
+            except asyncio.TimeoutError:
+                # Latency limit reached, write the pending measures
+                await self.flush(pending)
+                continue
+            self.writer.add(*measure)
+            pending.append(decoded)
+            if self.writer.is_due():
+                await self.flush(pending)
+
+    async def report(self):
+        while True:
+            await asyncio.sleep(self.stats_interval)
+            print("Queues: %d/%d packets, %d/%d measures. " % (
+                      self.packets.qsize(), self.queue_size,
+                      self.measures.qsize(), self.queue_size) +
+                  "Decode: %s. " % self.stats["decode"].summary() +
+                  "Write: %s. " % self.stats["write"].summary() +
+                  "%d rejected." % self.rejected)
+            for stats in self.stats.values():
+                stats.reset()
+            self.rejected = 0
+
+    async def maintain(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(self.maintenance_interval)
+            try:
+                await loop.run_in_executor(None, self.maintenance)
+            except Exception as e:
+                print("Maintenance failed : " + str(e))
+
+    def stop(self):
+        """Stops the service, see run()."""
+        self.stopping.set()
+        for task in self.tasks:
+            task.cancel()
+
+    def queued(self):
+        """Returns the measures still queued, decoding the queued packets."""
+        measures = self.decoded
+        self.decoded = []
+        while not self.measures.empty():
+            measures.append(self.measures.get_nowait())
+        items = []
+        while not self.packets.empty():
+            items.append(self.packets.get_nowait())
+        if items:
+            measures.extend(self.decode_items(items))
+        return [measure for _, measure in measures]
+
+    def write_last(self, measures):
+        """Writes the last <measures> and the timers of the sensors."""
+        for measure in measures:
+            self.writer.add(*measure)
+        self.writer.flush(checkpoint=True)
+
+    async def run(self):
+        """Runs the stages until one of them fails or the service is stopped.
+
+        The stages are then cancelled, and the queued measures written with
+        the timers of the sensors, after the flush in progress if any.
+        """
+        loop = asyncio.get_event_loop()
+        self.packets = asyncio.Queue(self.queue_size)
+        self.measures = asyncio.Queue(self.queue_size)
+        self.executor = concurrent.futures.ThreadPoolExecutor(1)
+        stages = [self.read_serial(), self.decode(), self.write(),
+                  self.report()]
+        if self.maintenance is not None:
+            stages.append(self.maintain())
+        self.tasks = [asyncio.ensure_future(stage) for stage in stages]
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, self.stop)
+        try:
+            await asyncio.gather(*self.tasks)
+        except asyncio.CancelledError:
+            if not self.stopping.is_set():
+                raise
+        finally:
+            for signum in (signal.SIGTERM, signal.SIGINT):
+                loop.remove_signal_handler(signum)
+            self.stop()
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+            try:
+                await loop.run_in_executor(self.executor, self.write_last,
+                                           self.queued())
+            except Exception as e:
+                print("DB commit failed : " + str(e))
+            self.executor.shutdown()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""Serial link to the Arduino relaying the nRF24L01+ packets."""
+import queue
+import serial
+import time
+
+from libcitizenwatt.transport import PACKET_SIZE
+
+
+class SerialFramer():
+    """Splits the raw serial byte stream into packets.
+
+    The Arduino sends each PACKET_SIZE bytes packet followed by <terminator>
+    (Serial.println). If <pipe_header> is set, each packet is preceded by a
+    byte holding the number of the nRF24L01+ pipe on which it was received,
+    which identifies the sensor among those paired with the base.
+
+    As the payload is binary, it may contain the terminator too, so a frame
+    is only accepted when the terminator comes right after the packet.
+    Otherwise, a framing error is counted and the stream is resynchronised
+    just after the next terminator.
+    """
+    def __init__(self, terminator=b"\r\n", pipe_header=False):
+        self.terminator = terminator
+        self.header_size = 1 if pipe_header else 0
+        self.packet_end = self.header_size + PACKET_SIZE
+        self.frame_size = self.packet_end + len(terminator)
+        self.buffer = b""
+        self.framing_errors = 0
+
+    def feed(self, data):
+        """Appends <data> to the stream and returns the complete packets, as
+        (pipe, packet) tuples. pipe is None without <pipe_header>.
+        """
+        self.buffer += data
+        packets = []
+        while len(self.buffer) >= self.frame_size:
+            if (self.buffer[self.packet_end:self.frame_size] ==
+                    self.terminator):
+                pipe = self.buffer[0] if self.header_size else None
+                packets.append((pipe,
+                                self.buffer[self.header_size:
+                                            self.packet_end]))
+                self.buffer = self.buffer[self.frame_size:]
+                continue
+            self.framing_errors += 1
+            index = self.buffer.find(self.terminator)
+            if index < 0:
+                # Keep what may be the beginning of a terminator
+                self.buffer = self.buffer[-(len(self.terminator) - 1):]
+            else:
+                self.buffer = self.buffer[index + len(self.terminator):]
+        return packets
+
+
+class SerialReceiver():
+    """Reads packets from the serial port into a bounded buffer.
+
+    Each packet is stamped with the time (in seconds since the epoch) at which
+    it was read, so that packets waiting in the buffers still get the time of
+    their own measure. Reads block until data is available (or <timeout>
+    seconds), so that no CPU is spent waiting. When the buffer is full, the
+    oldest packet is dropped and an overrun is counted.
+    """
+    def __init__(self, port, baudrate, buffer_size=256, timeout=1,
+                 terminator=b"\r\n", pipe_header=False):
+        self.serial = serial.Serial(port, baudrate, timeout=timeout)
+        self.framer = SerialFramer(terminator, pipe_header)
+        self.packets = queue.Queue(buffer_size)
+        self.received = 0
+        self.overruns = 0
+
+    def read_packets(self):
+        """Reads the available data once, and returns the complete packets as
+        (received, pipe, packet) tuples.
+
+        Blocks until at least one byte is received or the timeout expires.
+        """
+        data = self.serial.read(max(1, self.serial.in_waiting))
+        received = time.time()
+        packets = self.framer.feed(data)
+        self.received += len(packets)
+        return [(received, pipe, packet) for pipe, packet in packets]
+
+    def read(self):
+        """Reads the available data once, and buffers the complete packets."""
+        for item in self.read_packets():
+            try:
+                self.packets.put_nowait(item)
+            except queue.Full:
+                self.overruns += 1
+                try:
+                    self.packets.get_nowait()
+                except queue.Empty:
+                    pass
+                self.packets.put_nowait(item)
+
+    def run(self):
+        """Reads the serial port forever."""
+        while True:
+            self.read()
+
+    def get(self, timeout=None):
+        """Returns the next buffered (received, pipe, packet) tuple, or None
+        if <timeout> expires.
+        """
+        try:
+            return self.packets.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def stats(self):
+        return {"received": self.received,
+                "framing_errors": self.framer.framing_errors,
+                "overruns": self.overruns,
+                "buffered": self.packets.qsize()}
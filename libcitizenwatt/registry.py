@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+import time
+import types
+
+from libcitizenwatt import database
+from libcitizenwatt import tools
+from libcitizenwatt.packets import key_from_json
+from sqlalchemy.exc import SQLAlchemyError
+
+
+# Timers above this value are about to wrap, any new timer is then accepted
+MAX_TIMER = 4233600000
+
+# Sensors' timers count milliseconds
+TIMER_UNIT = 0.001
+
+# Columns of the sensors kept in their snapshot, see tools.save_snapshot
+SNAPSHOT_COLUMNS = ("id", "name", "type_id", "aes_key", "base_address",
+                    "pipe", "last_timer")
+
+
+def parse_base_address(base_address):
+    """Converts a base address as stored in the database ("0X...LL") to an
+    integer. Returns 0 if it is not set.
+    """
+    if not base_address:
+        return 0
+    try:
+        return int(base_address.strip("L"), 16)
+    except ValueError:
+        return 0
+
+
+class RegisteredSensor():
+    """In-memory state of a sensor, used during ingest."""
+    def __init__(self, sensor):
+        self.id = sensor.id
+        self.name = sensor.name
+        self.type_id = sensor.type_id
+        self.address = parse_base_address(sensor.base_address)
+        self.pipe = sensor.pipe
+        self.key = key_from_json(sensor.aes_key) if sensor.aes_key else None
+        self.last_timer = sensor.last_timer
+        # (timer, wall clock time) when the timer was first seen
+        self.timer_origin = None
+
+    def accept_timer(self, timer):
+        """Returns True and stores <timer> if it is a valid successor of the
+        last timer received from this sensor.
+        """
+        if (self.last_timer and self.last_timer > 0 and
+                self.last_timer < MAX_TIMER and
+                timer < self.last_timer):
+            return False
+        self.last_timer = timer
+        return True
+
+    def timer_lag(self, timer, now):
+        """Returns the drift (in seconds) between <timer> and the wall clock
+        time <now>, since the timer was first seen.
+        """
+        if self.timer_origin is None or timer < self.timer_origin[0]:
+            self.timer_origin = (timer, now)
+        origin_timer, origin_now = self.timer_origin
+        return abs((now - origin_now) - (timer - origin_timer) * TIMER_UNIT)
+
+
+class BaseAddress():
+    """Address of this base (see tools.get_base_address()), with which the
+    received packets are tagged.
+
+    The settings and the install bump the "sensors" version (see
+    tools.bump_version) after changing the address, so the address is read
+    again only when this version changes, which is checked at most every
+    <check_interval> seconds.
+    """
+    def __init__(self, check_interval=1):
+        self.check_interval = check_interval
+        self.address = 0
+        self.version = None
+        self.last_check = None
+
+    def get(self):
+        """Returns the current address of the base, or 0 if it is not set."""
+        if (self.last_check is None or
+                time.monotonic() - self.last_check >= self.check_interval):
+            version = tools.get_version("sensors")
+            if self.last_check is None or version != self.version:
+                self.address = tools.get_base_address()
+                self.version = version
+            self.last_check = time.monotonic()
+        return self.address
+
+
+class SensorRegistry():
+    """In-memory copy of the sensors having an AES key, keyed by (base
+    address, pipe), pipe being None for a sensor which is the only one of its
+    base.
+
+    The sensors are reloaded only when their version (see tools.bump_version)
+    changes, which is checked at most every <check_interval> seconds, so that
+    new sensors and AES keys are used without restarting and without any
+    query per packet.
+
+    While the database is unavailable, the loaded sensors are kept, and
+    reloading them is retried at the next check. If the database is
+    unavailable from the start, the sensors of the last successful load are
+    used, from their snapshot.
+    """
+    def __init__(self, create_session, check_interval=1):
+        self.create_session = create_session
+        self.check_interval = check_interval
+        self.sensors = {}
+        self.version = None
+        self.last_check = None
+        # Whether the last load failed, the database being unavailable
+        self.stale = False
+
+    def load(self):
+        """Loads the sensors from the database.
+
+        Timers received since the last checkpoint are kept, unless the timer
+        was reset from the settings.
+
+        Raises ValueError if several sensors are paired with the same base
+        address and pipe, as their packets could not be told apart, or
+        SQLAlchemyError if the database is unavailable. The previously loaded
+        sensors are then kept.
+        """
+        version = tools.get_version("sensors")
+        db = self.create_session()
+        try:
+            rows = db.query(database.Sensor).all()
+        finally:
+            db.close()
+        self.update(rows)
+        self.version = version
+        self.stale = False
+        self.last_check = time.monotonic()
+        try:
+            tools.save_snapshot("sensors",
+                                [{column: getattr(row, column)
+                                  for column in SNAPSHOT_COLUMNS}
+                                 for row in rows])
+        except OSError as e:
+            tools.warning("Unable to save the sensors : " + str(e))
+
+    def load_snapshot(self):
+        """Loads the sensors saved by the last successful load(), if any."""
+        rows = tools.load_snapshot("sensors")
+        if rows:
+            self.update([types.SimpleNamespace(**row) for row in rows])
+
+    def update(self, rows):
+        """Replaces the sensors by those of <rows> (Sensor-like objects)."""
+        previous = {sensor.id: sensor for sensor in self.sensors.values()}
+        sensors = {}
+        for row in rows:
+            sensor = RegisteredSensor(row)
+            if sensor.key is None:
+                # Not paired yet, no packet can be decrypted
+                continue
+            if sensor.id in previous and sensor.last_timer != 0:
+                sensor.last_timer = previous[sensor.id].last_timer
+            key = (sensor.address, sensor.pipe)
+            if key in sensors:
+                raise ValueError("Sensors " + sensors[key].name + " and " +
+                                 sensor.name + " are both paired with base " +
+                                 "address " + hex(sensor.address) +
+                                 ", pipe " + str(sensor.pipe) + ".")
+            sensors[key] = sensor
+        self.sensors = sensors
+
+    def refresh(self):
+        """Reloads the sensors if they changed since they were loaded.
+
+        If they conflict, the error is reported once and the previous sensors
+        are kept until the sensors change again. If the database is
+        unavailable, they are kept until the next check, the error being
+        reported once.
+        """
+        if self.last_check is None:
+            self.reload()
+        elif time.monotonic() - self.last_check >= self.check_interval:
+            if self.stale or tools.get_version("sensors") != self.version:
+                self.reload()
+            else:
+                self.last_check = time.monotonic()
+
+    def reload(self):
+        version = tools.get_version("sensors")
+        try:
+            self.load()
+        except ValueError as e:
+            tools.warning("Sensors not reloaded : " + str(e))
+            self.version = version
+            self.stale = False
+            self.last_check = time.monotonic()
+        except SQLAlchemyError as e:
+            if not self.stale:
+                tools.warning("Database unavailable, sensors not " +
+                              "reloaded : " + str(e))
+            if not self.sensors:
+                self.load_snapshot()
+            self.stale = True
+            self.last_check = time.monotonic()
+
+    def get(self, address, pipe=None):
+        """Returns the sensor sending on the pipe <pipe> of the base
+        <address>, or None.
+
+        Packets from a pipe without a sensor go to the sensor of the base
+        which is not bound to a pipe, if any. Packets which match no sensor go
+        to the only sensor, if there is a single one: their address is then
+        unknown (0), or was changed from the settings after they were tagged.
+        """
+        self.refresh()
+        sensor = self.sensors.get((address, pipe))
+        if sensor is None and pipe is not None:
+            sensor = self.sensors.get((address, None))
+        if sensor is None and len(self.sensors) == 1:
+            only = next(iter(self.sensors.values()))
+            if only.address != address:
+                sensor = only
+        return sensor
+
+    def is_ready(self):
+        """Returns True if at least one sensor has an AES key."""
+        self.refresh()
+        return bool(self.sensors)
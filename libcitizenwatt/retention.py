@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""Retention of the raw measures and of the minute rollups.
+
+Raw measures older than raw_retention_days, and minute rollups older than
+minute_rollups_retention_days, are deleted by compact(), run with the periodic
+maintenance of the ingest daemons. Their energy (trapezoidal, split between
+day and night rates) is kept by the coarser rollups, maintained as the
+measures are written, and hour and day rollups are kept forever. The API
+answers older ranges from the finest rollups left, see resolution_ranges().
+
+A retention of 0 days keeps the data forever.
+"""
+import time
+
+from libcitizenwatt import database
+from libcitizenwatt import partitions
+from libcitizenwatt import rollups
+from sqlalchemy import and_, select
+
+
+class RetentionPolicy():
+    def __init__(self, raw_days=0, minute_days=0):
+        self.raw_days = raw_days
+        self.minute_days = minute_days
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config.get("raw_retention_days"),
+                   config.get("minute_rollups_retention_days"))
+
+    @staticmethod
+    def cutoff(days, now=None):
+        if not days:
+            return None
+        if now is None:
+            now = time.time()
+        return now - days * 86400
+
+    def raw_cutoff(self, now=None):
+        """Returns the timestamp before which raw measures are deleted, or
+        None if they are kept forever.
+        """
+        return self.cutoff(self.raw_days, now)
+
+    def minute_cutoff(self, now=None):
+        return self.cutoff(self.minute_days, now)
+
+    def finest_resolution(self, timestamp, now=None):
+        """Returns the finest rollup resolution still available at
+        <timestamp>, or None if the raw measures are.
+        """
+        raw_cutoff = self.raw_cutoff(now)
+        if raw_cutoff is None or timestamp >= raw_cutoff:
+            return None
+        minute_cutoff = self.minute_cutoff(now)
+        if minute_cutoff is None or timestamp >= minute_cutoff:
+            return rollups.MINUTE
+        return rollups.HOUR
+
+    def resolution_ranges(self, time1, time2, now=None):
+        """Splits the range from <time1> to <time2> (excluded) into
+        consecutive (start, end, resolution) ranges, each answered from the
+        finest data left (see finest_resolution()).
+
+        Ranges answered from the rollups end on a boundary of their buckets,
+        so that the rollups cover them exactly, up to the next range.
+        """
+        ranges = []
+        start = time1
+        while start < time2:
+            resolution = self.finest_resolution(start, now)
+            if resolution is None:
+                ranges.append((start, time2, None))
+                break
+            # Finer data is left from there
+            if resolution == rollups.MINUTE:
+                finer = self.raw_cutoff(now)
+            else:
+                finer = min(self.minute_cutoff(now), self.raw_cutoff(now))
+            end = rollups.bucket_start(finer, resolution)
+            if end < finer:
+                end += resolution
+            end = min(end, time2)
+            ranges.append((start, end, resolution))
+            start = end
+        return ranges
+
+
+def delete_batches(engine, table, condition, batch_size, max_batches):
+    """Deletes the rows of <table> matching <condition>, <batch_size> rows
+    per transaction, and at most <max_batches> batches. Returns the number of
+    deleted rows.
+    """
+    deleted = 0
+    for i in range(max_batches):
+        with engine.begin() as conn:
+            count = conn.execute(
+                table.delete()
+                .where(table.c.id.in_(select([table.c.id])
+                                      .where(condition)
+                                      .limit(batch_size)))).rowcount
+        deleted += count
+        if count < batch_size:
+            break
+    return deleted
+
+
+def compact(engine, policy, now=None, batch_size=10000, max_batches=100,
+            store=None, invalidation=None):
+    """Deletes the raw measures and minute rollups older than allowed by
+    <policy>, in bounded batches so that the ingest is never blocked for
+    long. Remaining rows are deleted by the next runs.
+
+    Partitioned measures are dropped a whole month at a time instead, those
+    of the DEFAULT partition being deleted in batches. If the
+    measures are in a time-series <store>, they are deleted from its files
+    (see tsstore.SensorSeries.drop_before()). The cached results of the
+    compacted ranges are then invalidated by the <invalidation> publisher, if
+    given, as the older ones are computed from the rollups.
+
+    Returns a tuple (deleted measures, dropped partitions, deleted rollups).
+    """
+    measures = database.Measures.__table__
+    rollups_table = database.Rollup.__table__
+    deleted, dropped, deleted_rollups = 0, [], 0
+
+    raw_cutoff = policy.raw_cutoff(now)
+    if raw_cutoff is not None:
+        with engine.begin() as conn:
+            partitioned = partitions.is_partitioned(conn)
+        if partitioned:
+            dropped = partitions.drop_partitions(engine, raw_cutoff)
+            # Measures out of the monthly partitions
+            default = partitions.default_table()
+            deleted = delete_batches(engine, default,
+                                     default.c.timestamp < raw_cutoff,
+                                     batch_size, max_batches)
+        else:
+            deleted = delete_batches(engine, measures,
+                                     measures.c.timestamp < raw_cutoff,
+                                     batch_size, max_batches)
+        if store is not None:
+            deleted += store.drop_before(raw_cutoff)
+
+    minute_cutoff = policy.minute_cutoff(now)
+    if minute_cutoff is not None:
+        deleted_rollups = delete_batches(
+            engine, rollups_table,
+            and_(rollups_table.c.resolution == rollups.MINUTE,
+                 rollups_table.c.start < minute_cutoff),
+            batch_size, max_batches)
+
+    if invalidation is not None and (deleted or dropped or deleted_rollups):
+        cutoff = max(raw_cutoff if deleted or dropped else 0,
+                     minute_cutoff if deleted_rollups else 0)
+        sensors = database.Sensor.__table__
+        with engine.begin() as conn:
+            invalidation.publish({row[0]: (0, cutoff) for row in
+                                  conn.execute(select([sensors.c.id]))})
+    return deleted, dropped, deleted_rollups
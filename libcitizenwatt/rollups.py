@@ -0,0 +1,396 @@
+#!/usr/bin/env python3
+"""Per-sensor energy rollups by minute, hour and day.
+
+Each rollup holds the day and night rate energies integrated (trapezoidal
+rule) over the measures of its bucket, their count, min and max power, and
+its first and last measures. The energy of any range made of whole buckets is
+the sum of their energies, plus the trapezoids joining consecutive buckets,
+which is exactly what tools.energy computes from the raw measures.
+
+Grouped energies are computed by EnergyAccumulator from rows streamed in
+chunks, so that the memory used does not depend on the length of the range.
+"""
+import bisect
+import datetime
+import time
+
+from libcitizenwatt import database
+from sqlalchemy import and_, asc, func, or_, select
+
+
+MINUTE = 60
+HOUR = 3600
+DAY = 86400
+RESOLUTIONS = (MINUTE, HOUR, DAY)
+
+COLUMNS = ("day_rate", "night_rate", "count", "min_value", "max_value",
+           "first_timestamp", "first_value", "first_night_rate",
+           "last_timestamp", "last_value", "last_night_rate")
+
+
+def bucket_start(timestamp, resolution):
+    """Returns the start of the bucket of <resolution> containing
+    <timestamp>. Days start at local midnight.
+    """
+    timestamp = int(timestamp)
+    if resolution == DAY:
+        day = datetime.datetime.fromtimestamp(timestamp).date()
+        return int(time.mktime(day.timetuple()))
+    return timestamp - timestamp % resolution
+
+
+def segment_energy(timestamp1, value1, night_rate1,
+                   timestamp2, value2, night_rate2):
+    """Returns the (day_rate, night_rate) energies in kWh of the trapezoid
+    between two consecutive measures, split as numpy.trapz does in
+    tools.energy.
+    """
+    duration = (timestamp2 - timestamp1) / 1000 / 3600
+    day_rate = ((0 if night_rate1 == 1 else value1) +
+                (0 if night_rate2 == 1 else value2)) / 2 * duration
+    night_rate = ((value1 if night_rate1 == 1 else 0) +
+                  (value2 if night_rate2 == 1 else 0)) / 2 * duration
+    return day_rate, night_rate
+
+
+class EnergyAccumulator():
+    """Integrates measures (or buckets) given one at a time, in timestamp
+    order, as tools.energy (or energy()) would from the whole list, in
+    constant memory.
+    """
+    def __init__(self, default_timestep=8):
+        self.default_timestep = default_timestep
+        self.count = 0
+        self.day_rate = 0
+        self.night_rate = 0
+        self.first = None
+        self.last = None
+
+    def join(self, timestamp, value, night_rate):
+        """Adds the trapezoid from the last measure to the given one."""
+        if self.last is None:
+            self.first = (value, night_rate)
+        else:
+            day_rate, night_rate_energy = segment_energy(
+                self.last[0], self.last[1], self.last[2],
+                timestamp, value, night_rate)
+            self.day_rate += day_rate
+            self.night_rate += night_rate_energy
+
+    def add(self, timestamp, value, night_rate):
+        """Adds a measure."""
+        self.join(timestamp, value, night_rate)
+        self.last = (timestamp, value, night_rate)
+        self.count += 1
+
+    def add_bucket(self, bucket):
+        """Adds a bucket (dict with the rollups COLUMNS)."""
+        self.join(bucket["first_timestamp"], bucket["first_value"],
+                  bucket["first_night_rate"])
+        self.day_rate += bucket["day_rate"]
+        self.night_rate += bucket["night_rate"]
+        self.last = (bucket["last_timestamp"], bucket["last_value"],
+                     bucket["last_night_rate"])
+        self.count += bucket["count"]
+
+    def energy(self):
+        """Returns the energy of the added measures, or None if there is
+        none.
+        """
+        if not self.count:
+            return None
+        energy = {'night_rate': 0, 'day_rate': 0}
+        if self.count == 1:
+            # A single measure lasts a timestep
+            value = self.first[0] / 1000 * self.default_timestep / 3600
+            if self.first[1] == 1:
+                energy["night_rate"] = value
+            else:
+                energy["day_rate"] = value
+        else:
+            energy["day_rate"] = self.day_rate
+            energy["night_rate"] = self.night_rate
+        energy['value'] = energy['day_rate'] + energy['night_rate']
+        return energy
+
+
+def group_energies(rows, steps, group, add, default_timestep=8):
+    """Returns the energies of the groups between consecutive <steps>, of
+    <rows> ordered by time, <group>(row) being the index of the group of a
+    row, and <add>(accumulator, row) adding it to an EnergyAccumulator.
+
+    <rows> are read once, and only the accumulator of the current group is
+    kept, so that they can be streamed. Each item is None if there is no row
+    in the group.
+    """
+    energies = [None] * (len(steps) - 1)
+    index, accumulator = None, None
+    for row in rows:
+        row_index = group(row)
+        if row_index != index:
+            if accumulator is not None:
+                energies[index] = accumulator.energy()
+            index = row_index
+            accumulator = EnergyAccumulator(default_timestep)
+        add(accumulator, row)
+    if accumulator is not None:
+        energies[index] = accumulator.energy()
+    return energies
+
+
+def new_bucket(sensor_id, resolution, start, timestamp, value, night_rate):
+    return {"sensor_id": sensor_id,
+            "resolution": resolution,
+            "start": start,
+            "day_rate": 0,
+            "night_rate": 0,
+            "count": 1,
+            "min_value": value,
+            "max_value": value,
+            "first_timestamp": timestamp,
+            "first_value": value,
+            "first_night_rate": night_rate,
+            "last_timestamp": timestamp,
+            "last_value": value,
+            "last_night_rate": night_rate}
+
+
+def add_measure(bucket, timestamp, value, night_rate):
+    """Adds a measure to <bucket> (dict), in place."""
+    bucket["count"] += 1
+    bucket["min_value"] = min(bucket["min_value"], value)
+    bucket["max_value"] = max(bucket["max_value"], value)
+    if timestamp >= bucket["last_timestamp"]:
+        day_rate, night_rate_energy = segment_energy(
+            bucket["last_timestamp"], bucket["last_value"],
+            bucket["last_night_rate"], timestamp, value, night_rate)
+        bucket["day_rate"] += day_rate
+        bucket["night_rate"] += night_rate_energy
+        bucket["last_timestamp"] = timestamp
+        bucket["last_value"] = value
+        bucket["last_night_rate"] = night_rate
+
+
+class RollupMaintainer():
+    """Maintains the rollups incrementally, as measures are written.
+
+    Only the latest stored bucket of each sensor and resolution is kept in
+    memory. Older buckets are loaded from the database when needed.
+    """
+    def __init__(self):
+        # (sensor_id, resolution) => latest stored bucket
+        self.latest = {}
+
+    def load(self, conn, key):
+        rollups = database.Rollup.__table__
+        row = conn.execute(rollups.select()
+                           .where(and_(rollups.c.sensor_id == key[0],
+                                       rollups.c.resolution == key[1],
+                                       rollups.c.start == key[2]))).first()
+        if row is None:
+            return None
+        return {column: row[column]
+                for column in ("sensor_id", "resolution", "start") + COLUMNS}
+
+    def get(self, conn, key):
+        """Returns a copy of the stored bucket <key>, or None."""
+        latest = self.latest.get(key[:2])
+        if latest is not None:
+            if latest["start"] == key[2]:
+                return dict(latest)
+            elif latest["start"] < key[2]:
+                # Newer than anything stored
+                return None
+        return self.load(conn, key)
+
+    def write(self, conn, rows):
+        """Updates the rollups with the measures <rows> (dicts, ordered by
+        timestamp), using <conn>.
+
+        The in-memory state is only updated once the caller commits, see
+        commit().
+        """
+        updated = {}
+        stored = set()
+        for row in rows:
+            for resolution in RESOLUTIONS:
+                key = (row["sensor_id"], resolution,
+                       bucket_start(row["timestamp"], resolution))
+                bucket = updated.get(key)
+                if bucket is None:
+                    bucket = self.get(conn, key)
+                    if bucket is not None:
+                        stored.add(key)
+                if bucket is None:
+                    bucket = new_bucket(key[0], key[1], key[2],
+                                        row["timestamp"], row["value"],
+                                        row["night_rate"])
+                else:
+                    add_measure(bucket, row["timestamp"], row["value"],
+                                row["night_rate"])
+                updated[key] = bucket
+
+        rollups = database.Rollup.__table__
+        for key, bucket in updated.items():
+            if key in stored:
+                conn.execute(rollups.update()
+                             .where(and_(rollups.c.sensor_id == key[0],
+                                         rollups.c.resolution == key[1],
+                                         rollups.c.start == key[2]))
+                             .values({column: bucket[column]
+                                      for column in COLUMNS}))
+            else:
+                conn.execute(rollups.insert().values(bucket))
+        return updated
+
+    def commit(self, updated):
+        """Keeps the buckets <updated> by a committed write()."""
+        for key, bucket in updated.items():
+            latest = self.latest.get(key[:2])
+            if latest is None or latest["start"] <= key[2]:
+                self.latest[key[:2]] = bucket
+
+
+def energy(buckets, default_timestep=8):
+    """Computes the energy of consecutive buckets (dicts or Rollup objects,
+    ordered by start), as tools.energy would from their measures.
+    """
+    accumulator = EnergyAccumulator(default_timestep)
+    for bucket in buckets:
+        if not isinstance(bucket, dict):
+            bucket = {column: getattr(bucket, column) for column in COLUMNS}
+        accumulator.add_bucket(bucket)
+    energy = accumulator.energy()
+    if energy is None:
+        energy = {'night_rate': 0, 'day_rate': 0, 'value': 0}
+    return energy
+
+
+def is_aligned(timestamp, resolution):
+    return (float(timestamp).is_integer() and
+            bucket_start(timestamp, resolution) == int(timestamp))
+
+
+def coarsest_resolution(steps):
+    """Returns the coarsest resolution whose buckets are aligned on all the
+    <steps> boundaries, or None.
+    """
+    for resolution in reversed(RESOLUTIONS):
+        if all(is_aligned(step, resolution) for step in steps):
+            return resolution
+    return None
+
+
+def grouped_energy(db, sensor, steps, resolution, default_timestep=8,
+                   chunk_size=1000):
+    """Returns the energy of the measures of <sensor> in each group between
+    consecutive <steps>, computed from the rollups of <resolution>, streamed
+    by <chunk_size> rows.
+
+    Each rollup is counted in the group containing its start, which is exact
+    if the steps are aligned on the resolution (see coarsest_resolution()).
+    Each item is None if there is no measure in the group.
+    """
+    rows = (db.query(database.Rollup.start,
+                     *[getattr(database.Rollup, column) for column in COLUMNS])
+            .filter(database.Rollup.sensor_id == sensor,
+                    database.Rollup.resolution == resolution,
+                    database.Rollup.start >= steps[0],
+                    database.Rollup.start < steps[-1])
+            .order_by(asc(database.Rollup.start))
+            .yield_per(chunk_size))
+    return group_energies(
+        rows, steps,
+        lambda row: bisect.bisect_right(steps, row.start) - 1,
+        lambda accumulator, row: accumulator.add_bucket(row._asdict()),
+        default_timestep)
+
+
+def rebuild(engine, sensor=None, since=None, chunk_size=10000,
+            invalidation=None):
+    """Rebuilds the rollups of <sensor> (default to all the sensors) from
+    the raw measures.
+
+    If <since> is given (the retention cutoff of the raw measures, see
+    retention.RetentionPolicy), only the rollups from the first day starting
+    at or after <since> are rebuilt. Older rollups are kept, as the measures
+    they were computed from may have been deleted.
+
+    The cached results of the rebuilt ranges are then invalidated by the
+    <invalidation> publisher, if given (see invalidation.Publisher).
+    """
+    measures = database.Measures.__table__
+    rollups = database.Rollup.__table__
+    if since is not None:
+        start = bucket_start(since, DAY)
+        if start < since:
+            # Days last from 23 to 25 hours
+            start = bucket_start(start + DAY + 2 * HOUR, DAY)
+        since = start
+    if sensor is None:
+        with engine.begin() as conn:
+            sensors = [row[0] for row in
+                       conn.execute(select([measures.c.sensor_id])
+                                    .distinct())]
+    else:
+        sensors = [sensor]
+
+    for sensor_id in sensors:
+        maintainer = RollupMaintainer()
+        with engine.begin() as conn:
+            delete = rollups.delete().where(rollups.c.sensor_id == sensor_id)
+            if since is not None:
+                delete = delete.where(rollups.c.start >= since)
+            conn.execute(delete)
+            last = None
+            while True:
+                query = (measures.select()
+                         .where(measures.c.sensor_id == sensor_id)
+                         .order_by(asc(measures.c.timestamp),
+                                   asc(measures.c.id))
+                         .limit(chunk_size))
+                if since is not None:
+                    query = query.where(measures.c.timestamp >= since)
+                if last is not None:
+                    query = query.where(
+                        or_(measures.c.timestamp > last[0],
+                            and_(measures.c.timestamp == last[0],
+                                 measures.c.id > last[1])))
+                rows = conn.execute(query).fetchall()
+                if not rows:
+                    break
+                maintainer.commit(maintainer.write(
+                    conn,
+                    [{"sensor_id": row["sensor_id"],
+                      "timestamp": row["timestamp"],
+                      "value": row["value"],
+                      "night_rate": row["night_rate"]} for row in rows]))
+                last = (rows[-1]["timestamp"], rows[-1]["id"])
+        if invalidation is not None:
+            invalidation.publish({sensor_id: (since or 0, time.time())})
+
+
+def needs_rebuild(engine):
+    """Returns the ids of the sensors having measures before their first day
+    rollup, e.g. measures written before an upgrade (possibly by a daemon
+    which had already started and built the rollups of the newer ones).
+    """
+    measures = database.Measures.__table__
+    rollups = database.Rollup.__table__
+    sensors = []
+    with engine.begin() as conn:
+        for sensor_id in [row[0] for row in conn.execute(
+                select([database.Sensor.__table__.c.id]))]:
+            first = conn.execute(
+                select([func.min(measures.c.timestamp)])
+                .where(measures.c.sensor_id == sensor_id)).scalar()
+            if first is None:
+                continue
+            # Day rollups are never deleted by the retention
+            first_day = conn.execute(
+                select([func.min(rollups.c.start)])
+                .where(and_(rollups.c.sensor_id == sensor_id,
+                            rollups.c.resolution == DAY))).scalar()
+            if first_day is None or first < first_day:
+                sensors.append(sensor_id)
+    return sensors
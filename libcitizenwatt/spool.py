@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+import os
+import struct
+
+from libcitizenwatt import tools
+from libcitizenwatt.config import make_sure_path_exists
+
+
+# sensor_id, timestamp, value, night_rate
+RECORD = struct.Struct("<Iddi")
+
+
+class Spool():
+    """Durable on-disk queue of the measures which could not be written to
+    the database.
+
+    Measures are appended as fixed-size binary records to segment files in
+    <directory>, with a single fsync per batch. A new segment is started once
+    the current one holds <segment_records> records. When the database is
+    back, each segment is inserted in a single transaction, then deleted.
+    Segments which can never be inserted are renamed to *.failed, see
+    replay().
+    """
+    def __init__(self, directory, segment_records=10000):
+        self.directory = os.path.expanduser(directory)
+        self.segment_records = segment_records
+        make_sure_path_exists(self.directory)
+        self.has_pending = bool(self.segments())
+
+    def segments(self):
+        """Returns the paths of the segments, oldest first."""
+        return [os.path.join(self.directory, name)
+                for name in sorted(os.listdir(self.directory))
+                if name.endswith(".spool")]
+
+    def pending(self):
+        """Returns True if some measures are waiting to be replayed."""
+        return self.has_pending
+
+    def append(self, rows):
+        """Appends measures (as dicts) to the spool, durably."""
+        segments = self.segments()
+        if (segments and
+                os.path.getsize(segments[-1]) <
+                self.segment_records * RECORD.size):
+            path = segments[-1]
+        else:
+            index = (int(os.path.basename(segments[-1]).split(".")[0]) + 1
+                     if segments else 0)
+            path = os.path.join(self.directory, "%012d.spool" % index)
+        data = b"".join(RECORD.pack(row["sensor_id"],
+                                    row["timestamp"],
+                                    row["value"],
+                                    row["night_rate"])
+                        for row in rows)
+        with open(path, "ab") as fh:
+            # Drop a truncated record, left by a crash during a write
+            extra = fh.tell() % RECORD.size
+            if extra:
+                fh.truncate(fh.tell() - extra)
+                fh.seek(0, os.SEEK_END)
+            fh.write(data)
+            fh.flush()
+            os.fsync(fh.fileno())
+        self.has_pending = True
+
+    def read(self, path):
+        """Returns the measures stored in segment <path>, as dicts.
+
+        A truncated trailing record, left by a crash during a write, is
+        ignored.
+        """
+        with open(path, "rb") as fh:
+            data = fh.read()
+        data = data[:len(data) - len(data) % RECORD.size]
+        return [{"sensor_id": sensor_id,
+                 "timestamp": timestamp,
+                 "value": value,
+                 "night_rate": night_rate}
+                for sensor_id, timestamp, value, night_rate
+                in RECORD.iter_unpack(data)]
+
+    def replay(self, insert, is_transient=None):
+        """Replays the spooled measures, oldest first.
+
+        <insert> is called with the measures of each segment and should write
+        them in a single transaction. The segment is deleted once <insert>
+        returns.
+
+        If <insert> raises a transient error (according to <is_transient>, all
+        errors if it is None), the segment is kept and the error raised
+        again, to retry later. Otherwise, the segment can never be inserted:
+        it is renamed to *.failed, out of the spool, and the replay goes on.
+        """
+        for path in self.segments():
+            rows = self.read(path)
+            if rows:
+                try:
+                    insert(rows)
+                except Exception as e:
+                    if is_transient is None or is_transient(e):
+                        raise
+                    failed = path[:-len(".spool")] + ".failed"
+                    os.replace(path, failed)
+                    tools.warning("Spooled measures rejected, moved to " +
+                                  failed + " : " + str(e))
+                    continue
+            os.remove(path)
+        self.has_pending = False
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""SQLite profile, for small single-home bases without a PostgreSQL server.
+
+The database is a single file (sqlite_path setting) in WAL mode, so that the
+web interface reads while the ingest writes. Each process opens it through
+its own engine:
+
+* the ingest daemons use a writer engine, holding a single connection shared
+  by the measures writer and the sessions (as with PostgreSQL), since SQLite
+  serializes the writes anyway;
+* the web interface uses a pool of connections, mostly reading, whose rare
+  writes (settings, sensors) wait for the ingest through the busy timeout.
+
+Every connection is tuned by the PRAGMAS below when it is opened.
+"""
+import os
+
+import sqlalchemy
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+
+
+PRAGMAS = [
+    # Readers do not block the writer, and conversely
+    ("journal_mode", "WAL"),
+    # Durable at each WAL checkpoint, enough for measures which are spooled
+    # on failure
+    ("synchronous", "NORMAL"),
+    # In KiB when negative
+    ("cache_size", -16384),
+    ("mmap_size", 128 * 1024 * 1024),
+    ("temp_store", "MEMORY"),
+    # In ms, time waited for the lock of another writer
+    ("busy_timeout", 5000),
+    # ON DELETE CASCADE of the measures
+    ("foreign_keys", "ON"),
+]
+
+
+def database_url(path):
+    return "sqlite:///" + os.path.expanduser(path)
+
+
+def set_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for pragma, value in PRAGMAS:
+        cursor.execute("PRAGMA %s = %s" % (pragma, value))
+    cursor.close()
+
+
+def create_engine(path, writer=False, pool_size=4, echo=False):
+    """Returns an engine on the SQLite database at <path>.
+
+    A <writer> engine holds a single connection, others a pool of
+    <pool_size> connections. Connections may be used by other threads than
+    the one which opened them (e.g. executors of the ingest), but by a single
+    one at a time, as checked out from the pool.
+    """
+    engine = sqlalchemy.create_engine(
+        database_url(path),
+        echo=echo,
+        poolclass=QueuePool,
+        pool_size=1 if writer else pool_size,
+        max_overflow=0,
+        connect_args={"check_same_thread": False})
+    event.listen(engine, "connect", set_pragmas)
+    return engine
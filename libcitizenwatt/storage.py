@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""Access to the raw measures, for the API.
+
+The measures are stored either in the database (SQLStorage), or in the
+embedded time-series store (see libcitizenwatt.tsstore), as set by the
+storage_backend setting. Both return measures as objects with the attributes
+of database.Measures, ordered by timestamp.
+
+Pages of measures are read with by_cursor(), from a (timestamp, id) position
+rather than an offset, so that a page far in the past costs as much as the
+last one. The API exposes these positions as opaque cursors, see
+encode_cursor().
+"""
+import base64
+import bisect
+import json
+
+from libcitizenwatt import database
+from libcitizenwatt import rollups
+from libcitizenwatt import tools
+from libcitizenwatt import tsstore
+from sqlalchemy import and_, asc, desc, or_
+
+
+def encode_cursor(measure, direction):
+    """Returns the cursor of the page of measures before <measure> if
+    <direction> is "previous", or after it if it is "next".
+    """
+    position = [direction, measure.timestamp, measure.id]
+    return base64.urlsafe_b64encode(
+        json.dumps(position).encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor):
+    """Returns the (direction, timestamp, id) of <cursor>. Raises ValueError
+    if it is invalid.
+    """
+    try:
+        direction, timestamp, id1 = json.loads(
+            base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8"))
+    except (TypeError, ValueError):
+        raise ValueError
+    if (direction not in ("previous", "next") or
+            not isinstance(timestamp, (int, float)) or
+            not isinstance(id1, int)):
+        raise ValueError
+    return direction, timestamp, id1
+
+
+class SQLStorage():
+    """Measures stored in the database, through the session <db>."""
+    def __init__(self, db):
+        self.db = db
+
+    def get_id(self, sensor, id1):
+        """Returns the measure <id1> of <sensor>, or None.
+
+        If <id1> < 0, counts from the last measure, as in Python lists.
+        """
+        if id1 >= 0:
+            return (self.db.query(database.Measures)
+                    .filter_by(sensor_id=sensor, id=id1)
+                    .first())
+        else:
+            return (self.db.query(database.Measures)
+                    .filter_by(sensor_id=sensor)
+                    .order_by(desc(database.Measures.timestamp))
+                    .slice(-id1 - 1, -id1)
+                    .first())
+
+    def by_ids(self, sensor, id1, id2):
+        """Returns the measures of <sensor> with ids between <id1> (included)
+        and <id2> (excluded).
+
+        If both are negative, counts from the end of the measures. Raises
+        ValueError if the ids are invalid.
+        """
+        if id1 >= 0 and id2 >= 0 and id2 >= id1:
+            return (self.db.query(database.Measures)
+                    .filter(database.Measures.sensor_id == sensor,
+                            database.Measures.id >= id1,
+                            database.Measures.id < id2)
+                    .order_by(asc(database.Measures.timestamp))
+                    .all())
+        elif id1 <= 0 and id2 <= 0 and id2 >= id1:
+            data = (self.db.query(database.Measures)
+                    .filter_by(sensor_id=sensor)
+                    .order_by(desc(database.Measures.timestamp))
+                    .slice(-id2, -id1)
+                    .all())
+            data.reverse()
+            return data
+        else:
+            raise ValueError
+
+    def by_cursor(self, sensor, count, position=None, before=True):
+        """Returns the <count> measures of <sensor> before (or after, if not
+        <before>) <position>, a (timestamp, id) tuple, or the last ones if
+        <position> is None.
+        """
+        measures = database.Measures
+        query = self.db.query(measures).filter(measures.sensor_id == sensor)
+        if before:
+            if position is not None:
+                # The first condition bounds the index scan
+                query = query.filter(
+                    measures.timestamp <= position[0],
+                    or_(measures.timestamp < position[0],
+                        and_(measures.timestamp == position[0],
+                             measures.id < position[1])))
+            data = (query.order_by(desc(measures.timestamp),
+                                   desc(measures.id))
+                    .limit(count)
+                    .all())
+            data.reverse()
+            return data
+        if position is not None:
+            query = query.filter(
+                measures.timestamp >= position[0],
+                or_(measures.timestamp > position[0],
+                    and_(measures.timestamp == position[0],
+                         measures.id > position[1])))
+        return (query.order_by(asc(measures.timestamp), asc(measures.id))
+                .limit(count)
+                .all())
+
+    def at_time(self, sensor, timestamp):
+        """Returns the measure of <sensor> at <timestamp>, or None."""
+        return (self.db.query(database.Measures)
+                .filter_by(sensor_id=sensor,
+                           timestamp=timestamp)
+                .first())
+
+    def by_time(self, sensor, time1, time2):
+        """Returns the measures of <sensor> between <time1> (included) and
+        <time2> (excluded).
+        """
+        return (self.db.query(database.Measures)
+                .filter(database.Measures.sensor_id == sensor,
+                        database.Measures.timestamp >= time1,
+                        database.Measures.timestamp < time2)
+                .order_by(asc(database.Measures.timestamp))
+                .all())
+
+    def range_energy(self, sensor, time1, time2, default_timestep=8):
+        """See tools.range_energy()."""
+        return tools.range_energy(self.db, sensor, time1, time2,
+                                  default_timestep)
+
+    def grouped_energy(self, sensor, steps, default_timestep=8,
+                       chunk_size=1000):
+        """Returns the energy of the measures of <sensor> in each group
+        between consecutive <steps>, computed from the raw measures, streamed
+        by <chunk_size> rows.
+
+        Group i holds the measures in [steps[i], steps[i + 1]), as the rollups
+        (see rollups.grouped_energy()). Each item is None if there is no
+        measure in the group.
+        """
+        rows = (self.db.query(database.Measures.timestamp,
+                              database.Measures.value,
+                              database.Measures.night_rate)
+                .filter(database.Measures.sensor_id == sensor,
+                        database.Measures.timestamp >= steps[0],
+                        database.Measures.timestamp < steps[-1])
+                .order_by(asc(database.Measures.timestamp))
+                .yield_per(chunk_size))
+        return rollups.group_energies(
+            rows, steps,
+            lambda row: bisect.bisect_right(steps, row.timestamp) - 1,
+            lambda accumulator, row: accumulator.add(*row),
+            default_timestep)
+
+
+def get_storage(db, config):
+    """Returns the storage of the measures set in <config>, <db> being the
+    database session of the request.
+    """
+    if config.get("storage_backend") == "tsstore":
+        return tsstore.get_store(config.get("tsstore_directory"))
+    return SQLStorage(db)
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+import datetime
+import numpy
+import time
+
+from libcitizenwatt import database
+from libcitizenwatt import tools
+from sqlalchemy.exc import SQLAlchemyError
+
+
+class TariffSchedule():
+    """Night rate schedule, loaded once from the admin user.
+
+    The schedule is reloaded only when its version (see tools.bump_version)
+    changes, which is checked at most every <check_interval> seconds.
+    Timestamps are then classified without any database query.
+
+    While the database is unavailable, the loaded schedule is kept, and
+    reloading it is retried at the next check. If the database is unavailable
+    from the start, the schedule of the last successful load is used, from
+    its snapshot (see tools.save_snapshot).
+    """
+    def __init__(self, create_session, check_interval=1):
+        self.create_session = create_session
+        self.check_interval = check_interval
+        # (start_night_rate, end_night_rate), replaced at once so that it can
+        # be read from several threads
+        self.bounds = None
+        self.version = None
+        self.last_check = None
+        # Whether the last load failed, the database being unavailable
+        self.stale = False
+
+    def load(self):
+        """Loads the schedule from the database.
+
+        Raises SQLAlchemyError if the database is unavailable.
+        """
+        version = tools.get_version("tariff")
+        db = self.create_session()
+        try:
+            user = db.query(database.User).filter_by(is_admin=1).first()
+        finally:
+            db.close()
+        if user is None:
+            self.bounds = None
+        else:
+            self.bounds = (user.start_night_rate, user.end_night_rate)
+        self.version = version
+        self.stale = False
+        self.last_check = time.monotonic()
+        try:
+            tools.save_snapshot("tariff", self.bounds)
+        except OSError as e:
+            tools.warning("Unable to save the night rate schedule : " +
+                          str(e))
+
+    def reload(self):
+        try:
+            self.load()
+        except SQLAlchemyError as e:
+            if not self.stale:
+                tools.warning("Database unavailable, night rate schedule " +
+                              "not reloaded : " + str(e))
+            if self.version is None and self.bounds is None:
+                bounds = tools.load_snapshot("tariff")
+                if bounds is not None:
+                    self.bounds = tuple(bounds)
+            self.stale = True
+            self.last_check = time.monotonic()
+
+    def refresh(self):
+        """Reloads the schedule if it changed since it was loaded."""
+        if self.last_check is None:
+            self.reload()
+        elif time.monotonic() - self.last_check >= self.check_interval:
+            if self.stale or tools.get_version("tariff") != self.version:
+                self.reload()
+            else:
+                self.last_check = time.monotonic()
+
+    @staticmethod
+    def is_night(bounds, seconds):
+        """Returns True if <seconds> since the beginning of the day are in
+        night rate. Works on NumPy arrays too.
+        """
+        start_night_rate, end_night_rate = bounds
+        if end_night_rate > start_night_rate:
+            return ((seconds > start_night_rate) &
+                    (seconds < end_night_rate))
+        else:
+            return ((seconds > start_night_rate) |
+                    (seconds < end_night_rate))
+
+    def night_rate(self, timestamp=None):
+        """Returns 1 if <timestamp> (default to now) is in night rate, 0 if it
+        is in day rate and -1 if no schedule is set.
+        """
+        self.refresh()
+        bounds = self.bounds
+        if bounds is None:
+            return -1
+        if timestamp is None:
+            now = datetime.datetime.now()
+        else:
+            now = datetime.datetime.fromtimestamp(timestamp)
+        return int(self.is_night(bounds, 3600 * now.hour + 60 * now.minute))
+
+    def night_rates(self, timestamps):
+        """Vectorized version of night_rate, returns a NumPy array."""
+        self.refresh()
+        bounds = self.bounds
+        timestamps = numpy.asarray(timestamps, dtype=numpy.int64)
+        if bounds is None:
+            return numpy.full(timestamps.shape, -1, dtype=numpy.int8)
+        # Local time offsets only change on hour boundaries
+        hours = timestamps - timestamps % 3600
+        unique_hours, index = numpy.unique(hours, return_inverse=True)
+        offsets = numpy.array([time.localtime(int(i)).tm_gmtoff
+                               for i in unique_hours], dtype=numpy.int64)
+        seconds = (timestamps + offsets[index]) % 86400
+        seconds -= seconds % 60
+        return self.is_night(bounds, seconds).astype(numpy.int8)
+
+    def rate_type(self, timestamp=None):
+        """Returns "day" or "night" according to <timestamp> (default to now),
+        or None if no schedule is set.
+        """
+        night_rate = self.night_rate(timestamp)
+        if night_rate == -1:
+            return None
+        return "night" if night_rate else "day"
@@ -1,9 +1,13 @@
 #!/usr/bin/env python3
+import json
 import numpy
 import os
 import sys
+import uuid
 
 from libcitizenwatt import database
+from libcitizenwatt import rollups
+from sqlalchemy import asc, desc
 
 
 def warning(*objs):
@@ -21,6 +25,9 @@ def to_dict(model):
     """
     if isinstance(model, list):
         return [to_dict(i) for i in model]
+    elif hasattr(model, "_asdict"):
+        # Records of the time-series store
+        return model._asdict()
     else:
         dict = {}
         dict['id'] = getattr(model, 'id')
@@ -78,6 +85,55 @@ def energy(powers, default_timestep=8):
     return energy
 
 
+def range_energy(db, sensor, time1, time2, default_timestep=8,
+                 chunk_size=1000):
+    """Computes the energy of the measures of <sensor> between <time1>
+    (included) and <time2> (excluded), as energy() would.
+
+    Only the first and last measures of the range are fetched, the energy
+    being the difference of their cumulative energies. Returns None if there
+    is no measure in the range.
+    """
+    first = (db.query(database.Measures)
+             .filter(database.Measures.sensor_id == sensor,
+                     database.Measures.timestamp >= time1,
+                     database.Measures.timestamp < time2)
+             .order_by(asc(database.Measures.timestamp),
+                       asc(database.Measures.id))
+             .first())
+    if first is None:
+        return None
+    last = (db.query(database.Measures)
+            .filter(database.Measures.sensor_id == sensor,
+                    database.Measures.timestamp >= time1,
+                    database.Measures.timestamp < time2)
+            .order_by(desc(database.Measures.timestamp),
+                      desc(database.Measures.id))
+            .first())
+    if first.id == last.id:
+        return energy([first], default_timestep)
+    if (first.cumulative_day_rate is None or
+            last.cumulative_day_rate is None):
+        # Not upgraded yet, integrate the measures, streamed
+        accumulator = rollups.EnergyAccumulator(default_timestep)
+        for row in (db.query(database.Measures.timestamp,
+                             database.Measures.value,
+                             database.Measures.night_rate)
+                    .filter(database.Measures.sensor_id == sensor,
+                            database.Measures.timestamp >= time1,
+                            database.Measures.timestamp < time2)
+                    .order_by(asc(database.Measures.timestamp))
+                    .yield_per(chunk_size)):
+            accumulator.add(*row)
+        return accumulator.energy()
+    result = {"day_rate": (last.cumulative_day_rate -
+                           first.cumulative_day_rate),
+              "night_rate": (last.cumulative_night_rate -
+                             first.cumulative_night_rate)}
+    result["value"] = result["day_rate"] + result["night_rate"]
+    return result
+
+
 def watt_euros(energy_provider, tariff, consumption, db):
     if energy_provider != 0:
         provider = (db.query(database.Provider)
@@ -106,3 +162,76 @@ def update_base_address(base_address):
     path = os.path.expanduser("~/.config/citizenwatt/base_address")
     with open(path, "w+") as fh:
         fh.write(str(base_address))
+
+
+def get_base_address():
+    """Returns the address of the base stored in
+    ~/.config/citizenwatt/base_address, or 0 if it is not set.
+    """
+    path = os.path.expanduser("~/.config/citizenwatt/base_address")
+    try:
+        with open(path, "r") as fh:
+            return int(fh.read().strip())
+    except (IOError, ValueError):
+        return 0
+
+
+def version_path(name):
+    return os.path.expanduser("~/.config/citizenwatt/" + name + "_version")
+
+
+def bump_version(name):
+    """Changes the version of <name>, shared between the CitizenWatt processes
+    through ~/.config/citizenwatt/<name>_version.
+
+    The file is atomically replaced, so readers never see a partial write.
+    """
+    path = version_path(name)
+    with open(path + ".tmp", "w") as fh:
+        fh.write(uuid.uuid4().hex)
+    os.replace(path + ".tmp", path)
+
+
+def get_version(name):
+    """Returns the current version of <name>, or None if never bumped."""
+    try:
+        with open(version_path(name), "r") as fh:
+            return fh.read()
+    except FileNotFoundError:
+        return None
+
+
+def snapshot_path(name):
+    return os.path.expanduser("~/.config/citizenwatt/" + name + ".json")
+
+
+def save_snapshot(name, data):
+    """Stores a copy of <data> (JSON serializable) loaded from the database,
+    in ~/.config/citizenwatt/<name>.json, so that the ingest can start while
+    the database is unavailable.
+
+    The file is only readable by its owner (it may hold the AES keys), and is
+    atomically replaced.
+    """
+    path = snapshot_path(name)
+    fd = os.open(path + ".tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as fh:
+        json.dump(data, fh)
+    os.replace(path + ".tmp", path)
+
+
+def load_snapshot(name):
+    """Returns the data stored by save_snapshot(), or None."""
+    try:
+        with open(snapshot_path(name), "r") as fh:
+            return json.load(fh)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def drop_snapshot(name):
+    """Deletes the data stored by save_snapshot(), if any."""
+    try:
+        os.remove(snapshot_path(name))
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+"""Packet transport between receive.py and process.py.
+
+Encrypted packets are written as fixed-size frames to the named FIFO set by
+the `named_fifo` config key. Each frame holds the address of the base which
+received the packet, the nRF24L01+ pipe on which it was received (NO_PIPE if
+the Arduino does not forward it) and the time (in seconds since the epoch) at
+which it was received from the serial link, followed by the packet itself.
+Writes smaller than PIPE_BUF are atomic, so frames are never split nor
+interleaved, and each frame written by the receiver is consumed exactly once
+by the processing script.
+"""
+import errno
+import os
+import select
+import stat
+import struct
+import time
+
+
+PACKET_SIZE = 16
+
+FRAME_FORMAT = struct.Struct("<QBd%ds" % PACKET_SIZE)
+FRAME_SIZE = FRAME_FORMAT.size
+
+NO_PIPE = 0xFF
+
+
+def make_fifo(path):
+    """Creates the named FIFO <path> if it does not already exist.
+
+    Raises OSError if <path> exists and is not a FIFO.
+    """
+    try:
+        os.mkfifo(path, 0o660)
+    except OSError as exception:
+        if exception.errno != errno.EEXIST:
+            raise
+        if not stat.S_ISFIFO(os.stat(path).st_mode):
+            raise OSError(errno.EEXIST, "Not a named FIFO", path)
+
+
+def unpack_frame(frame):
+    """Returns the (address, pipe, received, packet) tuple of <frame>."""
+    address, pipe, received, packet = FRAME_FORMAT.unpack(frame)
+    if pipe == NO_PIPE:
+        pipe = None
+    return address, pipe, received, packet
+
+
+class FifoWriter():
+    """Writing end of the packet FIFO."""
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+
+    def open(self):
+        """Opens the FIFO, blocking until a reader is available."""
+        make_fifo(self.path)
+        self.fd = os.open(self.path, os.O_WRONLY)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, packet, address=0, received=None, pipe=None):
+        """Writes a single packet of PACKET_SIZE bytes, received by the base
+        with address <address> (0 if unknown) on the pipe <pipe> (None if
+        unknown) at the time <received> (default to now).
+
+        If the reader went away, waits for a new one and writes the packet
+        again, so that it is not lost.
+        """
+        if len(packet) != PACKET_SIZE:
+            raise ValueError("Packets must be %d bytes long." % PACKET_SIZE)
+        if received is None:
+            received = time.time()
+        if pipe is None:
+            pipe = NO_PIPE
+        frame = FRAME_FORMAT.pack(address, pipe, received, packet)
+        while True:
+            if self.fd is None:
+                self.open()
+            try:
+                os.write(self.fd, frame)
+                return
+            except BrokenPipeError:
+                self.close()
+
+
+class FifoReader():
+    """Reading end of the packet FIFO.
+
+    A dummy writing descriptor is kept open, so that the FIFO never reaches
+    EOF when the receiver restarts and reads keep blocking instead of
+    spinning.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+        self.keepalive_fd = None
+        self.buffer = b""
+
+    def open(self):
+        make_fifo(self.path)
+        self.fd = os.open(self.path, os.O_RDONLY | os.O_NONBLOCK)
+        self.keepalive_fd = os.open(self.path, os.O_WRONLY | os.O_NONBLOCK)
+
+    def close(self):
+        for fd in (self.fd, self.keepalive_fd):
+            if fd is not None:
+                os.close(fd)
+        self.fd = None
+        self.keepalive_fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def fileno(self):
+        return self.fd
+
+    def read(self, timeout=None):
+        """Returns the next (address, pipe, received, packet) tuple, blocking
+        until one is available. pipe is None if it is unknown.
+
+        Returns None if <timeout> (in seconds) expires first.
+        """
+        if self.fd is None:
+            self.open()
+        while len(self.buffer) < FRAME_SIZE:
+            readable, _, _ = select.select([self.fd], [], [], timeout)
+            if not readable:
+                return None
+            try:
+                self.buffer += os.read(self.fd,
+                                       FRAME_SIZE - len(self.buffer))
+            except BlockingIOError:
+                continue
+        frame = unpack_frame(self.buffer[:FRAME_SIZE])
+        self.buffer = self.buffer[FRAME_SIZE:]
+        return frame
+
+    def read_many(self, max_count, timeout=None):
+        """Returns a list of up to <max_count> (address, pipe, received,
+        packet) tuples, blocking until at least one is available.
+
+        Returns an empty list if <timeout> (in seconds) expires first.
+        """
+        frame = self.read(timeout)
+        if frame is None:
+            return []
+        frames = [frame]
+        while len(frames) < max_count:
+            size = ((max_count - len(frames)) * FRAME_SIZE -
+                    len(self.buffer))
+            try:
+                if size > 0:
+                    self.buffer += os.read(self.fd, size)
+            except BlockingIOError:
+                pass
+            count = min(len(self.buffer) // FRAME_SIZE,
+                        max_count - len(frames))
+            if not count:
+                break
+            frames.extend(unpack_frame(self.buffer[i:i + FRAME_SIZE])
+                          for i in range(0, count * FRAME_SIZE, FRAME_SIZE))
+            self.buffer = self.buffer[count * FRAME_SIZE:]
+        return frames
@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+"""Embedded append-only time-series store for the measures.
+
+Each sensor has its own file of fixed-width binary records (RECORD_DTYPE),
+appended in timestamp order, and memory-mapped for reading, so that a time
+range is found by a binary search on the timestamps, without any database
+server. Records also carry the cumulative energies of the sensor (see
+writer.MeasuresWriter), so that the energy of a range is the difference of
+two records.
+
+Measures are identified by their position in the file of their sensor,
+starting at 1. Once the oldest records have been deleted by the raw measures
+retention (see SensorSeries.drop_before()), the file starts with a HEADER
+record holding the number of deleted records, so that the ids of the others
+do not change.
+
+The store is written by the ingest process only. Readers map the file again
+whenever it has grown or has been replaced.
+"""
+import collections
+import os
+import threading
+
+import numpy
+
+from libcitizenwatt import database
+from libcitizenwatt import tools
+from libcitizenwatt.config import make_sure_path_exists
+from libcitizenwatt.rollups import segment_energy
+from sqlalchemy import and_, asc, or_, select
+
+
+RECORD_DTYPE = numpy.dtype([("timestamp", "<f8"),
+                            ("value", "<f8"),
+                            ("night_rate", "<i4"),
+                            ("cumulative_day_rate", "<f8"),
+                            ("cumulative_night_rate", "<f8")])
+
+# Timestamp of the header record, see SensorSeries.load()
+HEADER = -numpy.inf
+
+# Same attributes as database.Measures
+Record = collections.namedtuple("Record",
+                                ["id", "sensor_id", "value", "timestamp",
+                                 "night_rate", "cumulative_day_rate",
+                                 "cumulative_night_rate"])
+
+
+class SensorSeries():
+    """Records file of a single sensor."""
+    def __init__(self, sensor_id, path):
+        self.sensor_id = sensor_id
+        self.path = path
+        self.lock = threading.Lock()
+        # Held by the writes, which replace the file when deleting records
+        self.write_lock = threading.Lock()
+        # (inode, number of records) of the mapped file
+        self.mapped = None
+        self.records = numpy.empty(0, dtype=RECORD_DTYPE)
+        self.offset = 0
+
+    def load(self):
+        """Returns a tuple (records, offset), offset being the number of
+        deleted records before the first one, mapping the file again if it
+        has grown or has been replaced.
+
+        A truncated trailing record, left by a crash during a write, is
+        ignored.
+        """
+        try:
+            stat = os.stat(self.path)
+            mapped = (stat.st_ino, stat.st_size // RECORD_DTYPE.itemsize)
+        except FileNotFoundError:
+            mapped = None
+        with self.lock:
+            if mapped != self.mapped:
+                if mapped is not None and mapped[1]:
+                    records = numpy.memmap(self.path, dtype=RECORD_DTYPE,
+                                           mode="r", shape=(mapped[1],))
+                else:
+                    records = numpy.empty(0, dtype=RECORD_DTYPE)
+                if len(records) and records[0]["timestamp"] == HEADER:
+                    self.offset = int(records[0]["value"])
+                    self.records = records[1:]
+                else:
+                    self.offset = 0
+                    self.records = records
+                self.mapped = mapped
+            return self.records, self.offset
+
+    def record(self, records, offset, index):
+        row = records[index]
+        return Record(offset + index + 1, self.sensor_id,
+                      float(row["value"]), float(row["timestamp"]),
+                      int(row["night_rate"]),
+                      float(row["cumulative_day_rate"]),
+                      float(row["cumulative_night_rate"]))
+
+    def to_records(self, records, offset, start, stop):
+        return [self.record(records, offset, i) for i in range(start, stop)]
+
+    def append(self, rows):
+        """Appends measures (as dicts, ordered by timestamp), computing their
+        cumulative energies, and syncs the file.
+
+        Measures older than the last record are skipped, as are measures
+        identical to a last record, which were already written before a
+        failure of the database and are replayed.
+        """
+        with self.write_lock:
+            self.write(rows)
+
+    def write(self, rows):
+        records, offset = self.load()
+        last = (self.record(records, offset, len(records) - 1)
+                if len(records) else None)
+        tail = set()
+        if last is not None:
+            i = len(records) - 1
+            while i >= 0 and records[i]["timestamp"] == last.timestamp:
+                tail.add((float(records[i]["value"]),
+                          int(records[i]["night_rate"])))
+                i -= 1
+
+        data = numpy.empty(len(rows), dtype=RECORD_DTYPE)
+        count = 0
+        for row in rows:
+            if last is not None:
+                if row["timestamp"] < last.timestamp:
+                    continue
+                if (row["timestamp"] == last.timestamp and
+                        (row["value"], row["night_rate"]) in tail):
+                    continue
+                day_rate, night_rate = segment_energy(
+                    last.timestamp, last.value, last.night_rate,
+                    row["timestamp"], row["value"], row["night_rate"])
+                cumulative = (last.cumulative_day_rate + day_rate,
+                              last.cumulative_night_rate + night_rate)
+            else:
+                cumulative = (0, 0)
+            data[count] = (row["timestamp"], row["value"], row["night_rate"],
+                           cumulative[0], cumulative[1])
+            last = Record(None, self.sensor_id, row["value"],
+                          row["timestamp"], row["night_rate"],
+                          cumulative[0], cumulative[1])
+            count += 1
+        if not count:
+            return
+
+        with open(self.path, "ab") as fh:
+            # Drop a truncated record, left by a crash during a write
+            extra = fh.tell() % RECORD_DTYPE.itemsize
+            if extra:
+                fh.truncate(fh.tell() - extra)
+                fh.seek(0, os.SEEK_END)
+            fh.write(data[:count].tobytes())
+            fh.flush()
+            os.fsync(fh.fileno())
+
+    def drop_before(self, timestamp, min_fraction=0.1):
+        """Deletes the records older than <timestamp>, the ids of the others
+        being kept. Returns the number of deleted records.
+
+        The file is rewritten, so records are only deleted once they are at
+        least <min_fraction> of them, and the file is rewritten at most every
+        few days.
+        """
+        with self.write_lock:
+            records, offset = self.load()
+            count = int(numpy.searchsorted(records["timestamp"], timestamp))
+            if not count or count < len(records) * min_fraction:
+                return 0
+            header = numpy.zeros(1, dtype=RECORD_DTYPE)
+            header["timestamp"] = HEADER
+            header["value"] = offset + count
+            with open(self.path + ".tmp", "wb") as fh:
+                fh.write(header.tobytes())
+                fh.write(records[count:].tobytes())
+                fh.flush()
+                os.fsync(fh.fileno())
+            os.replace(self.path + ".tmp", self.path)
+            return count
+
+
+class TimeSeriesStore():
+    """Per-sensor record files in <directory>, with the same query methods
+    as storage.SQLStorage.
+    """
+    def __init__(self, directory):
+        self.directory = os.path.expanduser(directory)
+        make_sure_path_exists(self.directory)
+        self.lock = threading.Lock()
+        self.series = {}
+
+    def get_series(self, sensor):
+        with self.lock:
+            if sensor not in self.series:
+                self.series[sensor] = SensorSeries(
+                    sensor, os.path.join(self.directory, "%d.bin" % sensor))
+            return self.series[sensor]
+
+    def append(self, rows):
+        """Appends measures (as dicts, see writer.MeasuresWriter)."""
+        by_sensor = collections.OrderedDict()
+        for row in rows:
+            by_sensor.setdefault(row["sensor_id"], []).append(row)
+        for sensor, sensor_rows in by_sensor.items():
+            self.get_series(sensor).append(sensor_rows)
+
+    def sensors(self):
+        """Returns the ids of the sensors having a records file."""
+        names = [os.path.splitext(name) for name in os.listdir(self.directory)]
+        return sorted(int(sensor) for sensor, extension in names
+                      if extension == ".bin" and sensor.isdigit())
+
+    def drop_before(self, timestamp):
+        """Deletes the measures older than <timestamp>, see
+        SensorSeries.drop_before(). Returns the number of deleted measures.
+        """
+        return sum(self.get_series(sensor).drop_before(timestamp)
+                   for sensor in self.sensors())
+
+    def get_id(self, sensor, id1):
+        series = self.get_series(sensor)
+        records, offset = series.load()
+        index = id1 - 1 - offset if id1 > 0 else len(records) + id1
+        if id1 == 0 or not 0 <= index < len(records):
+            return None
+        return series.record(records, offset, index)
+
+    def by_ids(self, sensor, id1, id2):
+        series = self.get_series(sensor)
+        records, offset = series.load()
+        if id1 >= 0 and id2 >= 0 and id2 >= id1:
+            start = max(id1 - 1 - offset, 0)
+            stop = max(id2 - 1 - offset, 0)
+        elif id1 <= 0 and id2 <= 0 and id2 >= id1:
+            start = max(len(records) + id1, 0)
+            stop = max(len(records) + id2, 0)
+        else:
+            raise ValueError
+        stop = min(stop, len(records))
+        return series.to_records(records, offset, start, max(start, stop))
+
+    def by_cursor(self, sensor, count, position=None, before=True):
+        series = self.get_series(sensor)
+        records, offset = series.load()
+        if before:
+            if position is None:
+                stop = len(records)
+            else:
+                stop = min(max(position[1] - 1 - offset, 0), len(records))
+            start = max(stop - count, 0)
+        else:
+            start = 0 if position is None else max(position[1] - offset, 0)
+            stop = min(start + count, len(records))
+        return series.to_records(records, offset, start, max(start, stop))
+
+    def at_time(self, sensor, timestamp):
+        series = self.get_series(sensor)
+        records, offset = series.load()
+        index = numpy.searchsorted(records["timestamp"], timestamp)
+        if (index < len(records) and
+                records[index]["timestamp"] == timestamp):
+            return series.record(records, offset, index)
+        return None
+
+    def by_time(self, sensor, time1, time2):
+        series = self.get_series(sensor)
+        records, offset = series.load()
+        timestamps = records["timestamp"]
+        return series.to_records(records, offset,
+                                 numpy.searchsorted(timestamps, time1),
+                                 numpy.searchsorted(timestamps, time2))
+
+    @staticmethod
+    def single_energy(record, default_timestep):
+        return tools.energy([record], default_timestep)
+
+    def range_energy(self, sensor, time1, time2, default_timestep=8):
+        series = self.get_series(sensor)
+        records, offset = series.load()
+        timestamps = records["timestamp"]
+        start = numpy.searchsorted(timestamps, time1)
+        stop = numpy.searchsorted(timestamps, time2)
+        return self.energy(series, records, offset, start, stop,
+                           default_timestep)
+
+    def energy(self, series, records, offset, start, stop, default_timestep):
+        """Energy of the records from <start> to <stop> (excluded), as
+        tools.energy() would compute it.
+        """
+        if stop <= start:
+            return None
+        elif stop - start == 1:
+            return self.single_energy(series.record(records, offset, start),
+                                      default_timestep)
+        first, last = records[start], records[stop - 1]
+        energy = {"day_rate": float(last["cumulative_day_rate"] -
+                                    first["cumulative_day_rate"]),
+                  "night_rate": float(last["cumulative_night_rate"] -
+                                      first["cumulative_night_rate"])}
+        energy["value"] = energy["day_rate"] + energy["night_rate"]
+        return energy
+
+    def grouped_energy(self, sensor, steps, default_timestep=8):
+        """Same grouping as storage.SQLStorage.grouped_energy(): group i
+        holds the measures in [steps[i], steps[i + 1]).
+        """
+        series = self.get_series(sensor)
+        records, offset = series.load()
+        bounds = numpy.searchsorted(records["timestamp"], steps)
+        return [self.energy(series, records, offset, bounds[i], bounds[i + 1],
+                            default_timestep)
+                for i in range(len(steps) - 1)]
+
+
+stores = {}
+stores_lock = threading.Lock()
+
+
+def get_store(directory):
+    """Returns the store in <directory>, shared by the threads of the
+    process.
+    """
+    with stores_lock:
+        if directory not in stores:
+            stores[directory] = TimeSeriesStore(directory)
+        return stores[directory]
+
+
+def import_measures(engine, store, chunk_size=10000, invalidation=None):
+    """Appends the measures of the database to <store>, e.g. when switching
+    an existing install to the time-series store. Measures already in the
+    store are skipped, and the cached results of the imported ones are
+    invalidated by the <invalidation> publisher, if given. Returns the number
+    of read measures.
+    """
+    measures = database.Measures.__table__
+    with engine.begin() as conn:
+        sensors = [row[0] for row in
+                   conn.execute(select([measures.c.sensor_id]).distinct())]
+    count = 0
+    for sensor_id in sensors:
+        last = None
+        while True:
+            with engine.begin() as conn:
+                query = (select([measures.c.id,
+                                 measures.c.sensor_id,
+                                 measures.c.timestamp,
+                                 measures.c.value,
+                                 measures.c.night_rate])
+                         .where(measures.c.sensor_id == sensor_id)
+                         .order_by(asc(measures.c.timestamp),
+                                   asc(measures.c.id))
+                         .limit(chunk_size))
+                if last is not None:
+                    query = query.where(
+                        or_(measures.c.timestamp > last[0],
+                            and_(measures.c.timestamp == last[0],
+                                 measures.c.id > last[1])))
+                rows = conn.execute(query).fetchall()
+            if not rows:
+                break
+            rows = [dict(row) for row in rows]
+            store.append(rows)
+            if invalidation is not None:
+                invalidation.written(rows)
+            count += len(rows)
+            last = (rows[-1]["timestamp"], rows[-1]["id"])
+    return count
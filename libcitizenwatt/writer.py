@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+import time
+
+from libcitizenwatt import database
+from libcitizenwatt import metrics
+from libcitizenwatt.rollups import RollupMaintainer, segment_energy
+from sqlalchemy import bindparam, desc, select
+from sqlalchemy.exc import DBAPIError, OperationalError
+
+
+def is_transient(error):
+    """Returns True if <error> may go away when retrying, the database being
+    unavailable, rather than rejecting the measures.
+    """
+    return (isinstance(error, OperationalError) or
+            (isinstance(error, DBAPIError) and error.connection_invalidated))
+
+
+class MeasuresWriter():
+    """Buffers decoded measures and writes them to the database in batches.
+
+    Buffered measures are flushed as a single multi-row INSERT as soon as
+    <max_rows> measures are waiting, or the oldest one has been waiting for
+    <max_latency> seconds. The sensors' last_timer are only written every
+    <checkpoint_interval> seconds, along with a flush.
+
+    The engine is expected to hold a single pooled connection, which is reused
+    for every flush.
+
+    If a <spool> is given, measures which could not be written are appended to
+    it, and replayed before the next successful flush. Flushes are retried
+    every <max_latency> seconds meanwhile. Spooled measures which the
+    database rejects (see is_transient) are set aside instead of blocking the
+    ingest, see Spool.replay().
+
+    The rollups are updated in the same transactions as the measures.
+
+    Each measure carries the energy integrated since the first measure of its
+    sensor (cumulative_day_rate and cumulative_night_rate), computed from the
+    previous measure of the sensor.
+
+    If a time-series <store> is given (see libcitizenwatt.tsstore), the
+    measures are appended to it instead of the measures table, before the
+    database transaction.
+
+    If an <invalidation> publisher is given (see libcitizenwatt.invalidation),
+    the cached results overlapping the measures are invalidated once they are
+    committed, replayed ones included.
+
+    If given, <upgrade> is called before the first write, and again before
+    each retry until it succeeds (see migrations.upgrade_or_defer).
+    """
+    def __init__(self, engine, max_rows=100, max_latency=5,
+                 checkpoint_interval=60, spool=None, store=None,
+                 invalidation=None, upgrade=None):
+        self.engine = engine
+        self.max_rows = max_rows
+        self.max_latency = max_latency
+        self.checkpoint_interval = checkpoint_interval
+        self.spool = spool
+        self.store = store
+        self.invalidation = invalidation
+        self.upgrade = upgrade
+        self.rollups = RollupMaintainer()
+        # sensor_id => last written measure, as a dict
+        self.previous = {}
+        self.rows = []
+        self.oldest = None
+        self.next_retry = time.monotonic()
+        self.last_timers = {}
+        self.last_checkpoint = time.monotonic()
+
+    def add(self, sensor_id, value, timestamp, night_rate, timer=None):
+        """Buffers a measure. Call flush() once is_due() returns True."""
+        self.rows.append({"sensor_id": sensor_id,
+                          "value": value,
+                          "timestamp": timestamp,
+                          "night_rate": night_rate})
+        if self.oldest is None:
+            self.oldest = time.monotonic()
+        if timer is not None:
+            self.last_timers[sensor_id] = timer
+
+    def spooled(self):
+        return self.spool is not None and self.spool.pending()
+
+    def timeout(self):
+        """Returns the number of seconds before the next flush is due, or None
+        if nothing is waiting.
+        """
+        deadlines = []
+        if self.oldest is not None:
+            deadlines.append(self.oldest + self.max_latency)
+        if self.spooled():
+            deadlines.append(self.next_retry)
+        if not deadlines:
+            return None
+        return max(0, min(deadlines) - time.monotonic())
+
+    def is_due(self):
+        now = time.monotonic()
+        return (len(self.rows) >= self.max_rows or
+                (self.oldest is not None and
+                 now - self.oldest >= self.max_latency) or
+                (self.spooled() and now >= self.next_retry))
+
+    def checkpoint_is_due(self):
+        return (self.last_timers and
+                time.monotonic() - self.last_checkpoint >=
+                self.checkpoint_interval)
+
+    def load_previous(self, conn, sensor_id):
+        """Returns the last stored measure of <sensor_id>, or None."""
+        measures = database.Measures.__table__
+        row = conn.execute(select([measures.c.timestamp,
+                                   measures.c.value,
+                                   measures.c.night_rate,
+                                   measures.c.cumulative_day_rate,
+                                   measures.c.cumulative_night_rate])
+                           .where(measures.c.sensor_id == sensor_id)
+                           .order_by(desc(measures.c.timestamp),
+                                     desc(measures.c.id))
+                           .limit(1)).first()
+        if row is None:
+            return None
+        return dict(row)
+
+    def integrate(self, conn, rows):
+        """Sets the cumulative energies of <rows>, in place.
+
+        Returns the last measure of each sensor, to be kept by commit() once
+        the transaction is committed.
+        """
+        previous = {}
+        for row in rows:
+            sensor_id = row["sensor_id"]
+            if sensor_id not in previous:
+                if sensor_id not in self.previous:
+                    self.previous[sensor_id] = self.load_previous(conn,
+                                                                  sensor_id)
+                previous[sensor_id] = self.previous[sensor_id]
+            last = previous[sensor_id]
+            if last is None:
+                row["cumulative_day_rate"] = 0
+                row["cumulative_night_rate"] = 0
+            else:
+                day_rate, night_rate = 0, 0
+                if row["timestamp"] > last["timestamp"]:
+                    day_rate, night_rate = segment_energy(
+                        last["timestamp"], last["value"], last["night_rate"],
+                        row["timestamp"], row["value"], row["night_rate"])
+                row["cumulative_day_rate"] = ((last["cumulative_day_rate"] or
+                                               0) + day_rate)
+                row["cumulative_night_rate"] = ((last["cumulative_night_rate"]
+                                                 or 0) + night_rate)
+            previous[sensor_id] = row
+        return previous
+
+    def insert(self, conn, rows):
+        """Inserts <rows> with multi-row INSERTs of at most max_rows rows, and
+        updates the rollups accordingly.
+
+        Returns the state to be passed to commit() once the transaction is
+        committed.
+        """
+        if self.store is not None:
+            # Measures replayed after a database failure are skipped
+            self.store.append(rows)
+            return {}, self.rollups.write(conn, rows)
+        previous = self.integrate(conn, rows)
+        for i in range(0, len(rows), self.max_rows):
+            conn.execute(database.Measures.__table__.insert()
+                         .values(rows[i:i + self.max_rows]))
+        return previous, self.rollups.write(conn, rows)
+
+    def commit(self, state):
+        """Keeps the in-memory state of a committed insert()."""
+        previous, rollups = state
+        self.previous.update(previous)
+        self.rollups.commit(rollups)
+
+    def invalidate(self, rows):
+        if self.invalidation is not None:
+            self.invalidation.written(rows)
+
+    def insert_spooled(self, rows):
+        start = time.monotonic()
+        with self.engine.begin() as conn:
+            state = self.insert(conn, rows)
+        self.commit(state)
+        metrics.db_commit_seconds.observe(time.monotonic() - start)
+        metrics.measures_inserted.inc(len(rows))
+        self.invalidate(rows)
+
+    def flush(self, checkpoint=False):
+        """Writes the spooled measures, then the buffered ones in a single
+        transaction.
+
+        Sensors' last_timer are written too if <checkpoint> is True or if the
+        checkpoint interval has elapsed. On failure, the buffered measures are
+        spooled (or, if there is no spool, kept in the buffer unless the
+        database rejected them) and the exception is raised again.
+        """
+        checkpoint = checkpoint or self.checkpoint_is_due()
+        spooled = self.spooled()
+        if not self.rows and not checkpoint and not spooled:
+            return
+        try:
+            if self.upgrade is not None:
+                self.upgrade()
+                self.upgrade = None
+            if spooled:
+                # Older measures first
+                self.spool.replay(self.insert_spooled, is_transient)
+            start = time.monotonic()
+            state = ({}, {})
+            with self.engine.begin() as conn:
+                if self.rows:
+                    state = self.insert(conn, self.rows)
+                if checkpoint and self.last_timers:
+                    sensors = database.Sensor.__table__
+                    conn.execute(sensors.update()
+                                 .where(sensors.c.id == bindparam("sensor"))
+                                 .values(last_timer=bindparam("timer")),
+                                 [{"sensor": sensor, "timer": timer}
+                                  for sensor, timer in
+                                  self.last_timers.items()])
+        except Exception as e:
+            # Retry after another max_latency seconds
+            self.next_retry = time.monotonic() + self.max_latency
+            if self.spool is not None and self.rows:
+                self.spool.append(self.rows)
+                self.rows = []
+                self.oldest = None
+            elif not is_transient(e):
+                # Rejected, they would never be written
+                self.rows = []
+                self.oldest = None
+            elif self.oldest is not None:
+                self.oldest = time.monotonic()
+            raise
+        self.commit(state)
+        metrics.db_commit_seconds.observe(time.monotonic() - start)
+        metrics.measures_inserted.inc(len(self.rows))
+        self.invalidate(self.rows)
+        self.rows = []
+        self.oldest = None
+        if checkpoint:
+            self.last_timers = {}
+            self.last_checkpoint = time.monotonic()
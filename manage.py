@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""Maintenance commands for the CitizenWatt database."""
+
+import argparse
+import time
+
+from libcitizenwatt import database
+from libcitizenwatt import engines
+from libcitizenwatt import invalidation
+from libcitizenwatt import migrations
+from libcitizenwatt import partitions
+from libcitizenwatt import rollups
+from libcitizenwatt import tools
+from libcitizenwatt import tsstore
+from libcitizenwatt.config import Config
+from libcitizenwatt.retention import RetentionPolicy
+
+
+def upgrade(engine, args):
+    migrations.upgrade(engine)
+    print("Database is up to date.")
+
+
+def create_indexes(engine, args):
+    for index in migrations.create_indexes(engine):
+        print("Created index " + index + ".")
+    if args.brin:
+        migrations.create_brin_index(engine, args.pages_per_range)
+        print("Created index " + migrations.BRIN_INDEX + ".")
+
+
+def partition_measures(engine, args):
+    partitions.migrate(engine, progress=lambda partition:
+                       print("Moved the measures of " + partition + "."))
+    print("Measures are partitioned.")
+
+
+def import_tsstore(engine, args):
+    config = Config()
+    count = tsstore.import_measures(
+        engine, tsstore.get_store(config.get("tsstore_directory")),
+        invalidation=invalidation.get_publisher(config))
+    print("%d measures imported." % count)
+
+
+def rebuild_rollups(engine, args):
+    config = Config()
+    if config.get("storage_backend") == "tsstore":
+        print("Rollups are rebuilt from the measures of the database, " +
+              "which are not used with the time-series store.")
+        return
+    # Older measures may have been deleted, their rollups are kept
+    since = RetentionPolicy.from_config(config).raw_cutoff()
+    rollups.rebuild(engine, args.sensor, since,
+                    invalidation=invalidation.get_publisher(config))
+    if since is None:
+        print("Rollups rebuilt.")
+    else:
+        print("Rollups rebuilt from the first day after " +
+              time.strftime("%Y-%m-%d", time.localtime(since)) +
+              ", older measures being deleted.")
+
+
+def set_pipe(engine, args):
+    sensors = database.Sensor.__table__
+    with engine.begin() as conn:
+        result = conn.execute(sensors.update()
+                              .where(sensors.c.id == args.sensor)
+                              .values(pipe=args.pipe))
+    if not result.rowcount:
+        print("No sensor with id %d." % args.sensor)
+        return
+    tools.bump_version("sensors")
+    print("Pipe of sensor %d set to %s." % (args.sensor, args.pipe))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    subparsers.add_parser("upgrade",
+                          help="upgrade the database schema and fill in " +
+                               "the derived data").set_defaults(func=upgrade)
+
+    indexes = subparsers.add_parser("create-indexes",
+                                    help="create the missing indexes, " +
+                                         "without locking the measures")
+    indexes.add_argument("--brin", action="store_true",
+                         help="also create a BRIN index on the measures " +
+                              "timestamps (PostgreSQL only)")
+    indexes.add_argument("--pages-per-range", type=int, default=32,
+                         help="pages per range of the BRIN index")
+    indexes.set_defaults(func=create_indexes)
+
+    partition = subparsers.add_parser("partition-measures",
+                                      help="move the measures to a table " +
+                                           "partitioned by month " +
+                                           "(PostgreSQL 11 or later), the " +
+                                           "ingest must be stopped")
+    partition.set_defaults(func=partition_measures)
+
+    subparsers.add_parser("import-tsstore",
+                          help="copy the measures of the database to the " +
+                               "time-series store").set_defaults(
+        func=import_tsstore)
+
+    rebuild = subparsers.add_parser("rebuild-rollups",
+                                    help="rebuild the energy rollups from " +
+                                         "the raw measures")
+    rebuild.add_argument("--sensor", type=int, default=None,
+                         help="only rebuild the rollups of this sensor")
+    rebuild.set_defaults(func=rebuild_rollups)
+
+    pipe = subparsers.add_parser("set-pipe",
+                                 help="set the nRF24L01+ pipe of the base " +
+                                      "on which a sensor sends, to receive " +
+                                      "several sensors with one base")
+    pipe.add_argument("sensor", type=int, help="id of the sensor")
+    pipe.add_argument("pipe", type=int, nargs="?", choices=range(6),
+                      help="pipe number, none if the sensor is the only " +
+                           "one of its base")
+    pipe.set_defaults(func=set_pipe)
+
+    args = parser.parse_args()
+
+    # Configuration
+    config = Config()
+
+    # DB initialization
+    engine = engines.create_engine(config, writer=True)
+    if args.func not in (upgrade, create_indexes):
+        migrations.upgrade_schema(engine)
+
+    args.func(engine, args)
+
+
+if __name__ == "__main__":
+    main()
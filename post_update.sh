@@ -1 +1,8 @@
 #!/bin/sh
+
+cd "$(dirname "$0")"
+
+# The daemons only upgrade the tables when they start, the indexes and the
+# data derived from the measures are built here
+echo "Upgrading the database…"
+python3 manage.py upgrade
@@ -1,117 +1,109 @@
 #!/usr/bin/env python3
 
-import datetime
-import json
-import os
-import stat
-import struct
 import sys
 import time
 
-from libcitizenwatt import database
+from libcitizenwatt import engines
+from libcitizenwatt import invalidation
+from libcitizenwatt import metrics
+from libcitizenwatt import migrations
 from libcitizenwatt import tools
-from Crypto.Cipher import AES
+from libcitizenwatt import transport
+from libcitizenwatt import tsstore
+from libcitizenwatt.packets import PacketDecoder
+from libcitizenwatt.pipeline import decode_frames
+from libcitizenwatt.registry import SensorRegistry
+from libcitizenwatt.retention import RetentionPolicy
+from libcitizenwatt.spool import Spool
+from libcitizenwatt.tariff import TariffSchedule
+from libcitizenwatt.writer import MeasuresWriter
 from libcitizenwatt.config import Config
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
 
-filename = "/tmp/sensor.log"
 
-
-def get_rate_type(db):
-    """Returns "day" or "night" according to current time
-    """
-    user = db.query(database.User).filter_by(is_admin=1).first()
-    now = datetime.datetime.now()
-    now = 3600 * now.hour + 60 * now.minute
-    if user is None:
-        return -1
-    elif user.end_night_rate > user.start_night_rate:
-        if now > user.start_night_rate and now < user.end_night_rate:
-            return 1
-        else:
-            return 0
+def flush(checkpoint=False):
+    """Writes the buffered measures, keeping them if the DB is unavailable"""
+    try:
+        writer.flush(checkpoint)
+    except Exception as e:
+        print("DB commit failed : " + str(e))
     else:
-        if now > user.start_night_rate or now < user.end_night_rate:
-            return 1
-        else:
-            return 0
+        print("Saved successfully.")
 
 
-def get_cw_sensor():
-    """Returns the citizenwatt sensor object or None"""
-    db = create_session()
-    sensor = (db.query(database.Sensor)
-              .filter_by(name="CitizenWatt")
-              .first())
-    db.close()
-    return sensor
+def maintain():
+    """Runs the periodic database maintenance, see migrations.maintain()"""
+    global next_maintenance
+    next_maintenance = time.monotonic() + config.get("maintenance_interval")
+    try:
+        migrations.maintain(engine, RetentionPolicy.from_config(config),
+                            store, publisher)
+    except Exception as e:
+        print("Maintenance failed : " + str(e))
 
 
 # Configuration
 config = Config()
 
 # DB initialization
-database_url = (config.get("database_type") + "://" + config.get("username") +
-                ":" + config.get("password") + "@" + config.get("host") + "/" +
-                config.get("database"))
-engine = create_engine(database_url, echo=config.get("debug"))
-create_session = sessionmaker(bind=engine)
-database.Base.metadata.create_all(engine)
-
-sensor = get_cw_sensor()
-while not sensor or not sensor.aes_key:
+# A single connection is shared by the session and the measures writer
+engine, create_session = engines.create_session_factory(config, writer=True)
+# If the database is unavailable, the ingest starts from the snapshots of the
+# sensors and of the night rate schedule, and spools the measures
+upgrade = migrations.upgrade_or_defer(engine)
+tariff_schedule = TariffSchedule(create_session)
+registry = SensorRegistry(create_session)
+store = None
+if config.get("storage_backend") == "tsstore":
+    store = tsstore.get_store(config.get("tsstore_directory"))
+# Cached results are invalidated once measures are written
+publisher = invalidation.get_publisher(config)
+writer = MeasuresWriter(engine,
+                        max_rows=config.get("ingest_batch_size"),
+                        max_latency=config.get("ingest_batch_latency"),
+                        checkpoint_interval=config.get("last_timer_checkpoint"),
+                        spool=Spool(config.get("spool_directory")),
+                        store=store,
+                        invalidation=publisher,
+                        upgrade=upgrade)
+decoder = PacketDecoder()
+next_maintenance = time.monotonic() + config.get("maintenance_interval")
+
+# Prometheus metrics, on http://localhost:<metrics_port>/metrics
+if config.get("metrics_port"):
+    metrics.serve(config.get("metrics_port"))
+
+while not registry.is_ready():
     tools.warning("Install is not complete ! " +
                   "Visit http://citizenwatt.local first.")
     time.sleep(1)
-    sensor = get_cw_sensor()
-
-key = json.loads(sensor.aes_key)
-key = struct.pack("<16B", *key)
 
+fifo = transport.FifoReader(config.get("named_fifo"))
 try:
-    with open(filename):
-        pass
-except FileNotFoundError:
-    sys.exit("Unable to open file " + filename + ".")
+    fifo.open()
+except OSError:
+    sys.exit("Unable to open FIFO " + config.get("named_fifo") + ".")
 
 try:
-    with open(config.get(filename), 'rb'):
+    with fifo:
         while True:
-            FileTemp = open(filename, 'rb')
-            measure = FileTemp.read(16)
-            print("New encrypted packet:" + str(measure))
-
-            decryptor = AES.new(key, AES.MODE_ECB)
-            measure = decryptor.decrypt(measure)
-            measure = struct.unpack("<HHHLlH", measure)
-            print("New incoming measure:" + str(measure))
-
-            power = measure[0]
-            voltage = measure[1]
-            battery = measure[2]
-            timer = measure[3]
-
-            if (sensor.last_timer and sensor.last_timer > 0 and
-                        sensor.last_timer < 4233600000 and
-                        timer < sensor.last_timer):
-                tools.warning("Invalid timer in the last packet, skipping it")
-            else:
-                try:
-                    db = create_session()
-                    measure_db = database.Measures(sensor_id=sensor.id,
-                                               value=power,
-                                               timestamp=datetime.datetime.now().timestamp(),
-                                               night_rate=get_rate_type(db))
-                    db.add(measure_db)
-                    sensor.last_timer = timer
-                    (db.query(database.Sensor)
-                     .filter_by(name="CitizenWatt")
-                     .update({"last_timer": sensor.last_timer}))
-                    db.commit()
-                except Exception as e:
-                    print("DB commit failed : " + e)
-                else:
-                    print("Saved successfully.")
+            if time.monotonic() >= next_maintenance:
+                maintain()
+            # Backlogs are read, decrypted and decoded in batches
+            frames = fifo.read_many(config.get("ingest_batch_size"),
+                                    writer.timeout())
+            if not frames:
+                # Latency limit reached, write the pending measures
+                flush()
+                continue
+            measures, rejected = decode_frames(frames, registry, decoder,
+                                               tariff_schedule)
+            print("%d new encrypted packets, %d rejected." % (len(frames),
+                                                             rejected))
+            for measure in measures:
+                writer.add(*measure)
+            if writer.is_due():
+                flush()
 except KeyboardInterrupt:
     pass
+finally:
+    flush(checkpoint=True)
@@ -1,28 +1,57 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
 
+import sys
+import threading
 import time
-import datetime
 
-import serial
+from libcitizenwatt import radio
+from libcitizenwatt import transport
+from libcitizenwatt.config import Config
+from libcitizenwatt.registry import BaseAddress
 
 print('==> starting receive.py')
 
-# file storing data
-filename = '/tmp/sensor.log'
+config = Config()
 
-serialArduino = serial.Serial('/dev/ttyACM0', 57600)
+# Interval between two reports of the link counters, in seconds
+stats_interval = 60
 
-while 1:
+# Packets are tagged with the address of this base (and the pipe on which
+# they were received), to be routed to the matching sensor by process.py.
+# The address is read again when it is changed from the settings.
+base_address = BaseAddress()
 
-    # verification if data are received from serial
-    while serialArduino.inWaiting() == 0:
-        pass
+# FIFO consumed by process.py
+fifo = transport.FifoWriter(config.get("named_fifo"))
 
-    valueRead = serialArduino.readline()
+receiver = radio.SerialReceiver(config.get("serial_port"),
+                                config.get("serial_baudrate"),
+                                config.get("serial_buffer_size"),
+                                pipe_header=config.get("serial_pipe_header"))
 
-    FileTemp = open(filename, 'wb')
-    FileTemp.write(valueRead)
-    FileTemp.close()
+# The serial port is read in its own thread, so that packets keep being
+# buffered while process.py is not reading the FIFO.
+thread = threading.Thread(target=receiver.run, daemon=True)
+thread.start()
 
-    time.sleep(2)
+last_stats = None
+last_report = time.monotonic()
+while 1:
+    if not thread.is_alive():
+        # Serial link lost, let supervisor restart us
+        sys.exit("Serial link to the Arduino lost.")
+
+    item = receiver.get(timeout=stats_interval)
+    if item is not None:
+        received, pipe, packet = item
+        fifo.write(packet, base_address.get(), received, pipe)
+
+    if time.monotonic() - last_report >= stats_interval:
+        stats = receiver.stats()
+        if stats != last_stats:
+            print("Serial link: %(received)d packets, " % stats +
+                  "%(framing_errors)d framing errors, " % stats +
+                  "%(overruns)d overruns, %(buffered)d buffered." % stats)
+        last_stats = stats
+        last_report = time.monotonic()
@@ -85,6 +85,8 @@ var App = function() {
 
 			switch (mode) {
 				case 'now':
+					// Align the window on the timestep, so that the server reuses its groups from a request to the next
+					date = new Date(Math.floor(date.getTime() / (Config.timestep * 1000)) * Config.timestep * 1000);
 					menu.timeWidth = Config.timestep * (graph.getWidth()+1) * 1000;
 					var start_date = new Date(date.getTime() - menu.timeWidth);
 					target
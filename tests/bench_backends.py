@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""Database backends benchmark: the SQLite profile against PostgreSQL.
+
+Writes the same synthetic measures (one every 8 s) of a sensor through the
+measures writer of the ingest, reporting the ingest rate, then times the
+month view (31 daily groups) as libcitizenwatt.cache computes it, from the
+day rollups and from the raw measures, while the ingest keeps writing.
+
+The SQLite profile (see libcitizenwatt.sqlite) uses a temporary database.
+Use --database-url to also run against PostgreSQL (the benchmark sensor and
+its measures are deleted at the end).
+"""
+
+import argparse
+import math
+import os
+import random
+import tempfile
+import threading
+import time
+
+from libcitizenwatt import database
+from libcitizenwatt import migrations
+from libcitizenwatt import rollups
+from libcitizenwatt import sqlite
+from libcitizenwatt.storage import SQLStorage
+from libcitizenwatt.writer import MeasuresWriter
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+
+def setup_database(engine):
+    """Creates the benchmark sensor, returns its id."""
+    migrations.upgrade(engine)
+    db = sessionmaker(bind=engine)()
+    measure_type = db.query(database.MeasureType).first()
+    if measure_type is None:
+        measure_type = database.MeasureType(name="Électricité")
+        db.add(measure_type)
+        db.flush()
+    sensor = database.Sensor(name="bench_backends_%d" % os.getpid(),
+                             type_id=measure_type.id)
+    db.add(sensor)
+    db.commit()
+    sensor_id = sensor.id
+    db.close()
+    return sensor_id
+
+
+def cleanup_database(engine, sensor_id):
+    db = sessionmaker(bind=engine)()
+    for model in (database.Measures, database.Rollup):
+        (db.query(model)
+         .filter(model.sensor_id == sensor_id)
+         .delete(synchronize_session=False))
+    (db.query(database.Sensor)
+     .filter(database.Sensor.id == sensor_id)
+     .delete(synchronize_session=False))
+    db.commit()
+    db.close()
+
+
+def load(engine, sensor_id, start, count, batch_size, seed=0):
+    """Writes <count> measures from <start>, in batches of <batch_size>.
+    Returns the number of measures written per second.
+    """
+    rng = random.Random(seed)
+    writer = MeasuresWriter(engine, max_rows=batch_size)
+    begin = time.perf_counter()
+    for i in range(count):
+        timestamp = start + i * 8
+        power = int(300 + 200 * math.sin(timestamp / 13751) +
+                    rng.expovariate(1 / 150))
+        night_rate = 1 if time.localtime(timestamp).tm_hour < 6 else 0
+        writer.add(sensor_id, power, timestamp, night_rate)
+        if writer.is_due():
+            writer.flush()
+    writer.flush()
+    return count / (time.perf_counter() - begin)
+
+
+def timed(function, repeat):
+    """Returns the median duration of <repeat> calls of <function>, in
+    ms.
+    """
+    durations = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    return sorted(durations)[len(durations) // 2] * 1000
+
+
+def run(name, writer_engine, reader_engine, args):
+    sensor_id = setup_database(writer_engine)
+    end = int(time.time()) // 86400 * 86400
+    start = end - args.days * 86400
+    month = [end - (31 - i) * 86400 for i in range(32)]
+    try:
+        rate = load(writer_engine, sensor_id, start, args.days * 86400 // 8,
+                    args.batch_size)
+
+        # Month views while the ingest goes on after <end>
+        ingest = threading.Thread(target=load,
+                                  args=(writer_engine, sensor_id, end,
+                                        args.concurrent, args.batch_size))
+        ingest.start()
+        db = sessionmaker(bind=reader_engine)()
+        rollup_view = timed(lambda: rollups.grouped_energy(
+            db, sensor_id, month, rollups.DAY), args.repeat)
+        db.expire_all()
+        raw_view = timed(lambda: SQLStorage(db).grouped_energy(
+            sensor_id, month), args.repeat)
+        db.close()
+        ingest.join()
+
+        print("%-10s ingest %8.0f measures/s, month view %8.2f ms " % (
+                  name, rate, rollup_view) +
+              "(rollups), %8.2f ms (raw)" % raw_view)
+    finally:
+        cleanup_database(writer_engine, sensor_id)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--days", type=int, default=31,
+                        help="days of measures")
+    parser.add_argument("--batch-size", type=int, default=100,
+                        help="measures per transaction, as ingest_batch_size")
+    parser.add_argument("--concurrent", type=int, default=2000,
+                        help="measures written during the month views")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--database-url", default=None,
+                        help="PostgreSQL database to compare with")
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), "citizenwatt.sqlite")
+    run("sqlite", sqlite.create_engine(path, writer=True),
+        sqlite.create_engine(path), args)
+    if args.database_url:
+        run("postgresql",
+            create_engine(args.database_url, pool_size=1, max_overflow=0),
+            create_engine(args.database_url), args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""Measures indexes benchmark (PostgreSQL only).
+
+Loads a multi-year synthetic dataset (several sensors, one measure every
+<interval> seconds each, appended in timestamp order as the ingest does) in a
+scratch bench_measures table, then for each indexing strategy reports the
+on-disk size of the indexes, and the plan, execution time and buffers of the
+queries issued by libcitizenwatt.cache.
+
+Strategies:
+    * timestamp: B-tree on timestamp, the schema before the composite index.
+    * composite: B-tree on (sensor_id, timestamp), see database.Measures.
+    * brin: BRIN on timestamp.
+    * composite+brin: both of the above.
+
+The bench_measures table is dropped at the end, unless --keep is given (to
+run again with --reuse).
+"""
+
+import argparse
+import datetime
+import json
+import statistics
+import time
+
+from sqlalchemy import create_engine
+
+
+TABLE = "bench_measures"
+
+STRATEGIES = {
+    "timestamp": ["CREATE INDEX bench_ix_timestamp ON " + TABLE +
+                  " (timestamp)"],
+    "composite": ["CREATE INDEX bench_ix_sensor_id_timestamp ON " + TABLE +
+                  " (sensor_id, timestamp)"],
+    "brin": ["CREATE INDEX bench_ix_timestamp_brin ON " + TABLE +
+             " USING brin (timestamp) WITH (pages_per_range = %(pages)d)"],
+    "composite+brin": ["CREATE INDEX bench_ix_sensor_id_timestamp ON " +
+                       TABLE + " (sensor_id, timestamp)",
+                       "CREATE INDEX bench_ix_timestamp_brin ON " + TABLE +
+                       " USING brin (timestamp) " +
+                       "WITH (pages_per_range = %(pages)d)"],
+}
+
+
+def queries(end):
+    """Returns the queries of libcitizenwatt.cache, for sensor 1 and
+    windows ending at <end>.
+    """
+    return {
+        "month (group by time)":
+            "SELECT * FROM " + TABLE + " WHERE sensor_id = 1 AND " +
+            "timestamp BETWEEN %d AND %d ORDER BY timestamp" % (
+                end - 31 * 86400, end),
+        "day (group by time)":
+            "SELECT * FROM " + TABLE + " WHERE sensor_id = 1 AND " +
+            "timestamp BETWEEN %d AND %d ORDER BY timestamp" % (
+                end - 86400, end),
+        "last year, first measure (range energy)":
+            "SELECT * FROM " + TABLE + " WHERE sensor_id = 1 AND " +
+            "timestamp >= %d AND timestamp < %d " % (end - 365 * 86400,
+                                                     end) +
+            "ORDER BY timestamp, id LIMIT 1",
+        "last 100 measures (by id)":
+            "SELECT * FROM " + TABLE + " WHERE sensor_id = 1 " +
+            "ORDER BY timestamp DESC LIMIT 100",
+    }
+
+
+def load(engine, sensors, years, interval):
+    """Fills bench_measures, one month per transaction. Returns the last
+    timestamp.
+    """
+    end = int(time.time()) // 86400 * 86400
+    start = end - int(years * 365 * 86400)
+    with engine.begin() as conn:
+        conn.execute("DROP TABLE IF EXISTS " + TABLE)
+        conn.execute("CREATE TABLE " + TABLE + " (" +
+                     "id bigint NOT NULL, " +
+                     "sensor_id integer NOT NULL, " +
+                     "value double precision, " +
+                     "timestamp integer, " +
+                     "night_rate integer)")
+    chunk = 30 * 86400
+    for chunk_start in range(start, end, chunk):
+        chunk_end = min(chunk_start + chunk, end)
+        with engine.begin() as conn:
+            conn.execute((
+                "INSERT INTO " + TABLE + " " +
+                "SELECT (t - %(start)d) / %(interval)d * %(sensors)d + s, " +
+                "s, " +
+                "300 + 200 * sin(t / 13751.0 + s) + random() * 150, " +
+                "t, " +
+                "CASE WHEN extract(hour FROM to_timestamp(t)) < 6 " +
+                "OR extract(hour FROM to_timestamp(t)) >= 22 " +
+                "THEN 1 ELSE 0 END " +
+                "FROM generate_series(%(chunk_start)d, %(chunk_end)d - 1, " +
+                "%(interval)d) t " +
+                "CROSS JOIN generate_series(1, %(sensors)d) s " +
+                "ORDER BY t, s") % {"start": start,
+                                    "interval": interval,
+                                    "sensors": sensors,
+                                    "chunk_start": chunk_start,
+                                    "chunk_end": chunk_end})
+        print("Loaded up to %s" %
+              datetime.datetime.fromtimestamp(chunk_end).date(),
+              end="\r", flush=True)
+    print()
+    return end
+
+
+def plan_nodes(plan):
+    """Returns the node types (and index names) of a JSON plan."""
+    node = plan["Node Type"]
+    if "Index Name" in plan:
+        node += " (" + plan["Index Name"] + ")"
+    nodes = [node]
+    for child in plan.get("Plans", []):
+        nodes.extend(plan_nodes(child))
+    return nodes
+
+
+def explain(conn, query, repeat):
+    """Runs <query> <repeat> times, returns the plan nodes, the median
+    execution time in ms and the buffers of the last run.
+    """
+    times = []
+    for i in range(repeat):
+        result = conn.execute("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " +
+                              query).scalar()
+        if isinstance(result, str):
+            result = json.loads(result)
+        plan = result[0]
+        times.append(plan["Execution Time"])
+    buffers = (plan["Plan"].get("Shared Hit Blocks", 0) +
+               plan["Plan"].get("Shared Read Blocks", 0))
+    return plan_nodes(plan["Plan"]), statistics.median(times), buffers
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--database-url", required=True,
+                        help="PostgreSQL database to run against")
+    parser.add_argument("--sensors", type=int, default=2)
+    parser.add_argument("--years", type=float, default=3)
+    parser.add_argument("--interval", type=int, default=8,
+                        help="seconds between two measures of a sensor")
+    parser.add_argument("--pages-per-range", type=int, default=32)
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="runs of each query, the median is reported")
+    parser.add_argument("--strategies", nargs="+",
+                        choices=sorted(STRATEGIES),
+                        default=["timestamp", "composite", "brin",
+                                 "composite+brin"])
+    parser.add_argument("--reuse", action="store_true",
+                        help="reuse the table of a previous --keep run")
+    parser.add_argument("--keep", action="store_true",
+                        help="do not drop the table at the end")
+    args = parser.parse_args()
+
+    engine = create_engine(args.database_url)
+    if engine.dialect.name != "postgresql":
+        parser.error("only PostgreSQL is supported")
+
+    if args.reuse:
+        with engine.begin() as conn:
+            end = conn.execute("SELECT max(timestamp) FROM " +
+                               TABLE).scalar() + 1
+    else:
+        end = load(engine, args.sensors, args.years, args.interval)
+
+    try:
+        with engine.begin() as conn:
+            rows = conn.execute("SELECT count(*) FROM " + TABLE).scalar()
+            size = conn.execute("SELECT pg_relation_size('" + TABLE +
+                                "')").scalar()
+        print("%d measures, table size %.1f MB" % (rows, size / 2**20))
+
+        for strategy in args.strategies:
+            with engine.begin() as conn:
+                for index in conn.execute(
+                        "SELECT indexname FROM pg_indexes " +
+                        "WHERE tablename = '" + TABLE + "'").fetchall():
+                    conn.execute("DROP INDEX " + index[0])
+                start = time.monotonic()
+                for statement in STRATEGIES[strategy]:
+                    conn.execute(statement % {"pages": args.pages_per_range})
+                build = time.monotonic() - start
+                conn.execute("ANALYZE " + TABLE)
+                size = conn.execute(
+                    "SELECT coalesce(sum(pg_relation_size(indexrelid)), 0) " +
+                    "FROM pg_index WHERE indrelid = '" + TABLE +
+                    "'::regclass").scalar()
+
+            print()
+            print("Strategy %s: indexes %.1f MB, built in %.1f s" % (
+                strategy, size / 2**20, build))
+            with engine.connect() as conn:
+                for name, query in queries(end).items():
+                    nodes, duration, buffers = explain(conn, query,
+                                                       args.repeat)
+                    print("  %-42s %8.2f ms %8d buffers  %s" % (
+                        name, duration, buffers, " > ".join(nodes)))
+    finally:
+        if not args.keep:
+            with engine.begin() as conn:
+                conn.execute("DROP TABLE IF EXISTS " + TABLE)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+"""Ingest throughput benchmark.
+
+Generates realistic AES-encrypted packets for several sensors, pushes them
+through the real ingest path, and reports the sustained packet rate, the
+latency between a packet being sent and its measure being committed, and the
+CPU time spent per packet.
+
+Two paths are available:
+    * fifo: the named FIFO and the decode-and-insert loop of process.py.
+    * pipeline: the asyncio IngestService of ingest.py.
+
+By default, a temporary SQLite database is used. Use --database-url to run
+against PostgreSQL (benchmark sensors are created, and their measures deleted
+at the end).
+"""
+
+import argparse
+import asyncio
+import collections
+import json
+import math
+import os
+import random
+import tempfile
+import threading
+import time
+
+from Crypto.Cipher import AES
+from libcitizenwatt import database
+from libcitizenwatt import transport
+from libcitizenwatt.packets import PACKET_FORMAT, PacketDecoder
+from libcitizenwatt.pipeline import IngestService, decode_frames
+from libcitizenwatt.registry import SensorRegistry
+from libcitizenwatt.tariff import TariffSchedule
+from libcitizenwatt.writer import MeasuresWriter
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+
+# Address of the benchmark base
+BASE_ADDRESS = 0xE7E7E7E7E7
+
+# Pipes of the nRF24L01+, one per sensor paired with the base
+PIPES = 6
+
+
+class PacketGenerator():
+    """Generates encrypted packets for <sensors> sensors paired with the same
+    base, each with its own AES key and pipe.
+    """
+    def __init__(self, sensors, seed=0):
+        self.random = random.Random(seed)
+        self.sensors = []
+        for i in range(sensors):
+            key = [self.random.randint(0, 255) for j in range(16)]
+            self.sensors.append({"name": "bench_%d" % i,
+                                 "pipe": i,
+                                 "key": key,
+                                 "cipher": AES.new(bytes(key), AES.MODE_ECB),
+                                 "timer": 0,
+                                 "phase": self.random.random() * 2 * math.pi})
+
+    def packet(self, sensor):
+        """Returns the next (pipe, packet) frame for <sensor>."""
+        sensor["timer"] += 8000
+        # Base load, daily-like oscillation and appliances noise
+        power = (300 +
+                 200 * math.sin(sensor["timer"] / 3.6e6 + sensor["phase"]) +
+                 self.random.expovariate(1 / 150))
+        power = min(int(power), 65535)
+        packet = PACKET_FORMAT.pack(power, 230, 3300, sensor["timer"], 0, 0)
+        return (sensor["pipe"], sensor["cipher"].encrypt(packet))
+
+    def frames(self, count):
+        """Returns <count> frames, interleaving the sensors."""
+        return [self.packet(self.sensors[i % len(self.sensors)])
+                for i in range(count)]
+
+
+class BenchWriter(MeasuresWriter):
+    """MeasuresWriter recording the latency between a packet being sent and
+    its measure being committed.
+
+    The send times are queued per sensor, as the ingest path keeps the order
+    of the packets of a given sensor.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.sent = collections.defaultdict(collections.deque)
+        self.latencies = []
+        self.lock = threading.Lock()
+
+    def record_sent(self, sensor_id):
+        with self.lock:
+            self.sent[sensor_id].append(time.monotonic())
+
+    def flush(self, checkpoint=False):
+        rows = [row["sensor_id"] for row in self.rows]
+        super().flush(checkpoint)
+        committed = time.monotonic()
+        with self.lock:
+            for sensor_id in rows:
+                self.latencies.append(committed -
+                                      self.sent[sensor_id].popleft())
+
+
+def setup_database(engine, generator):
+    """Creates the benchmark sensors, returns their ids by pipe."""
+    database.Base.metadata.create_all(engine)
+    db = sessionmaker(bind=engine)()
+    measure_type = db.query(database.MeasureType).first()
+    if measure_type is None:
+        measure_type = database.MeasureType(name="Électricité")
+        db.add(measure_type)
+        db.flush()
+    ids = {}
+    for sensor in generator.sensors:
+        row = (db.query(database.Sensor)
+               .filter_by(name=sensor["name"])
+               .first())
+        if row is None:
+            row = database.Sensor(name=sensor["name"],
+                                  type_id=measure_type.id)
+            db.add(row)
+        row.last_timer = 0
+        row.aes_key = json.dumps(sensor["key"])
+        row.base_address = hex(BASE_ADDRESS).upper() + "LL"
+        row.pipe = sensor["pipe"]
+        db.flush()
+        ids[sensor["pipe"]] = row.id
+    db.commit()
+    db.close()
+    return ids
+
+
+def cleanup_database(engine, ids):
+    db = sessionmaker(bind=engine)()
+    (db.query(database.Measures)
+     .filter(database.Measures.sensor_id.in_(list(ids.values())))
+     .delete(synchronize_session=False))
+    (db.query(database.Rollup)
+     .filter(database.Rollup.sensor_id.in_(list(ids.values())))
+     .delete(synchronize_session=False))
+    (db.query(database.Sensor)
+     .filter(database.Sensor.id.in_(list(ids.values())))
+     .delete(synchronize_session=False))
+    db.commit()
+    db.close()
+
+
+def paced(frames, rate, ids, writer):
+    """Yields <frames>, at <rate> packets per second (0 for no limit),
+    recording their send time.
+    """
+    start = time.monotonic()
+    for i, frame in enumerate(frames):
+        if rate:
+            delay = start + i / rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        writer.record_sent(ids[frame[0]])
+        yield frame
+
+
+def run_fifo(frames, rate, ids, engine, writer, batch_size):
+    """Feeds the frames through the named FIFO to the process.py loop."""
+    path = os.path.join(tempfile.mkdtemp(), "sensor")
+    create_session = sessionmaker(bind=engine)
+    registry = SensorRegistry(create_session)
+    tariff_schedule = TariffSchedule(create_session)
+    decoder = PacketDecoder()
+
+    reader = transport.FifoReader(path)
+    reader.open()
+
+    def send():
+        with transport.FifoWriter(path) as fifo:
+            for pipe, packet in paced(frames, rate, ids, writer):
+                fifo.write(packet, BASE_ADDRESS, pipe=pipe)
+
+    sender = threading.Thread(target=send, daemon=True)
+    sender.start()
+    received = 0
+    with reader:
+        while received < len(frames):
+            batch = reader.read_many(batch_size, writer.timeout())
+            if not batch:
+                writer.flush()
+                continue
+            received += len(batch)
+            measures, rejected = decode_frames(batch, registry, decoder,
+                                               tariff_schedule)
+            for measure in measures:
+                writer.add(*measure)
+            if writer.is_due():
+                writer.flush()
+    writer.flush(checkpoint=True)
+    os.remove(path)
+
+
+class BenchService(IngestService):
+    """IngestService reading the generated frames instead of the serial link.
+    """
+    def read_serial_forever(self, loop):
+        for pipe, packet in self.receiver:
+            item = (time.monotonic(), self.base_address, pipe, time.time(),
+                    packet)
+            asyncio.run_coroutine_threadsafe(self.packets.put(item),
+                                             loop).result()
+
+
+def run_pipeline(frames, rate, ids, engine, writer, batch_size):
+    """Feeds the frames to the asyncio ingest service of ingest.py."""
+    create_session = sessionmaker(bind=engine)
+    service = BenchService(paced(frames, rate, ids, writer),
+                           BASE_ADDRESS,
+                           SensorRegistry(create_session),
+                           PacketDecoder(),
+                           TariffSchedule(create_session),
+                           writer,
+                           batch_size=batch_size,
+                           stats_interval=3600)
+
+    async def main():
+        task = asyncio.ensure_future(service.run())
+        while len(writer.latencies) < len(frames):
+            if task.done():
+                task.result()
+            await asyncio.sleep(0.05)
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    asyncio.run(main())
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    if not values:
+        return float("nan")
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--path", choices=["fifo", "pipeline"],
+                        default="fifo")
+    parser.add_argument("--sensors", type=int, default=PIPES,
+                        help="number of sensors, at most %d" % PIPES)
+    parser.add_argument("--packets", type=int, default=10000,
+                        help="total number of packets")
+    parser.add_argument("--rate", type=float, default=0,
+                        help="packets per second and per sensor, " +
+                             "0 for as fast as possible")
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--batch-latency", type=float, default=1)
+    parser.add_argument("--database-url", default=None)
+    args = parser.parse_args()
+    if not 0 < args.sensors <= PIPES:
+        parser.error("a base receives from 1 to %d sensors" % PIPES)
+
+    if args.database_url:
+        engine = create_engine(args.database_url, pool_size=1,
+                               max_overflow=0)
+    else:
+        engine = create_engine("sqlite:///" +
+                               os.path.join(tempfile.mkdtemp(),
+                                            "bench.sqlite"))
+    generator = PacketGenerator(args.sensors)
+    ids = setup_database(engine, generator)
+    # Packets are encrypted beforehand, so that only the ingest is measured
+    frames = generator.frames(args.packets)
+    writer = BenchWriter(engine,
+                         max_rows=args.batch_size,
+                         max_latency=args.batch_latency)
+
+    run = run_fifo if args.path == "fifo" else run_pipeline
+    start = time.monotonic()
+    cpu_start = time.process_time()
+    try:
+        run(frames, args.rate * args.sensors, ids, engine, writer,
+            args.batch_size)
+        elapsed = time.monotonic() - start
+        cpu = time.process_time() - cpu_start
+    finally:
+        if args.database_url:
+            cleanup_database(engine, ids)
+
+    print("Path: %s, %d sensors, %d packets" % (args.path, args.sensors,
+                                                args.packets))
+    print("Sustained rate: %.0f packets/s" % (args.packets / elapsed))
+    print("Packet to committed row: p50 %.1f ms, p99 %.1f ms" % (
+        percentile(writer.latencies, 50) * 1000,
+        percentile(writer.latencies, 99) * 1000))
+    print("CPU: %.3f ms/packet" % (cpu / args.packets * 1000))
+
+
+if __name__ == "__main__":
+    main()
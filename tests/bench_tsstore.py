@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""Range scans benchmark: database (ORM) storage against the time-series
+store.
+
+Writes the same synthetic measures (one every 8 s) of a sensor to the
+database and to a temporary time-series store, then times the queries of
+libcitizenwatt.cache on both: the raw measures of a day, the month view
+(31 daily groups from the raw measures) and the energy of the whole range.
+
+By default, a temporary SQLite database is used. Use --database-url to run
+against PostgreSQL (the benchmark sensor and its measures are deleted at the
+end).
+"""
+
+import argparse
+import math
+import os
+import random
+import tempfile
+import time
+
+from libcitizenwatt import database
+from libcitizenwatt import tsstore
+from libcitizenwatt.storage import SQLStorage
+from libcitizenwatt.writer import MeasuresWriter
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+
+def setup_database(engine):
+    """Creates the benchmark sensor, returns its id."""
+    database.Base.metadata.create_all(engine)
+    db = sessionmaker(bind=engine)()
+    measure_type = db.query(database.MeasureType).first()
+    if measure_type is None:
+        measure_type = database.MeasureType(name="Électricité")
+        db.add(measure_type)
+        db.flush()
+    sensor = database.Sensor(name="bench_tsstore_%d" % os.getpid(),
+                             type_id=measure_type.id)
+    db.add(sensor)
+    db.commit()
+    sensor_id = sensor.id
+    db.close()
+    return sensor_id
+
+
+def cleanup_database(engine, sensor_id):
+    db = sessionmaker(bind=engine)()
+    for model in (database.Measures, database.Rollup):
+        (db.query(model)
+         .filter(model.sensor_id == sensor_id)
+         .delete(synchronize_session=False))
+    (db.query(database.Sensor)
+     .filter(database.Sensor.id == sensor_id)
+     .delete(synchronize_session=False))
+    db.commit()
+    db.close()
+
+
+def load(engine, store, sensor_id, start, days, seed=0):
+    """Writes <days> days of measures from <start>, to the database and to
+    <store>.
+    """
+    rng = random.Random(seed)
+    sql_writer = MeasuresWriter(engine, max_rows=1000)
+    store_writer = MeasuresWriter(engine, max_rows=1000, store=store)
+    # Rollups are written by both writers, keep them for a single one
+    store_writer.rollups.write = lambda conn, rows: {}
+    for i in range(int(days * 86400 / 8)):
+        timestamp = start + i * 8
+        power = int(300 + 200 * math.sin(timestamp / 13751) +
+                    rng.expovariate(1 / 150))
+        night_rate = 1 if time.localtime(timestamp).tm_hour < 6 else 0
+        for writer in (sql_writer, store_writer):
+            writer.add(sensor_id, power, timestamp, night_rate)
+            if writer.is_due():
+                writer.flush()
+    sql_writer.flush()
+    store_writer.flush()
+
+
+def timed(function, repeat):
+    """Returns the median duration of <repeat> calls of <function>, in
+    ms.
+    """
+    durations = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    return sorted(durations)[len(durations) // 2] * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--days", type=int, default=62,
+                        help="days of measures")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--database-url", default=None)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    if args.database_url:
+        engine = create_engine(args.database_url)
+    else:
+        engine = create_engine("sqlite:///" +
+                               os.path.join(directory, "bench.sqlite"))
+    store = tsstore.TimeSeriesStore(os.path.join(directory, "tsstore"))
+    sensor_id = setup_database(engine)
+    end = int(time.time()) // 86400 * 86400
+    start = end - args.days * 86400
+
+    try:
+        begin = time.monotonic()
+        load(engine, store, sensor_id, start, args.days)
+        print("Loaded %d days of measures in %.1f s" % (
+            args.days, time.monotonic() - begin))
+
+        db = sessionmaker(bind=engine)()
+        month = [end - (31 - i) * 86400 for i in range(32)]
+        queries = [
+            ("raw measures of a day",
+             lambda storage: storage.by_time(sensor_id, end - 86400, end)),
+            ("month view (31 groups)",
+             lambda storage: storage.grouped_energy(sensor_id, month)),
+            ("energy of the whole range",
+             lambda storage: storage.range_energy(sensor_id, start, end)),
+        ]
+        for name, query in queries:
+            sql = timed(lambda: query(SQLStorage(db)), args.repeat)
+            db.expire_all()
+            ts = timed(lambda: query(store), args.repeat)
+            print("%-28s database %9.2f ms, tsstore %9.2f ms (x%.0f)" % (
+                name, sql, ts, sql / ts if ts else float("inf")))
+        db.close()
+    finally:
+        if args.database_url:
+            cleanup_database(engine, sensor_id)
+
+
+if __name__ == "__main__":
+    main()
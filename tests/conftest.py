@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""Fixtures of the unit tests, run with python -m pytest tests.
+
+The libcitizenwatt modules read ~/.config/citizenwatt/config.json when they
+are imported, so HOME is set to a temporary directory holding a config of
+the SQLite profile, with results cached in memory, before any test module is
+imported.
+"""
+import os
+import tempfile
+
+import pytest
+
+
+# Simulator, run by hand
+collect_ignore = ["test_process.py"]
+
+os.environ["HOME"] = tempfile.mkdtemp(prefix="citizenwatt_tests_")
+
+from libcitizenwatt import database
+from libcitizenwatt import migrations
+from libcitizenwatt import sqlite
+from libcitizenwatt.config import Config
+from libcitizenwatt.writer import MeasuresWriter
+from sqlalchemy.orm import sessionmaker
+
+config = Config()
+config.set("database_type", "sqlite")
+config.set("cache_backend", "memory")
+config.set("metrics_port", 0)
+config.save()
+
+SENSOR = 1
+# Hour aligned, long closed
+START = 1500000000 - 1500000000 % 3600
+TIMESTEP = config.get("default_timestep")
+
+
+@pytest.fixture
+def engine(tmp_path):
+    """Engine on an empty SQLite database at the current schema."""
+    engine = sqlite.create_engine(str(tmp_path / "citizenwatt.sqlite"),
+                                  writer=True)
+    migrations.upgrade(engine)
+    with engine.begin() as conn:
+        conn.execute(database.MeasureType.__table__.insert(),
+                     [{"id": 1, "name": "Électricité"}])
+        conn.execute(database.Sensor.__table__.insert(),
+                     [{"id": SENSOR, "name": "CitizenWatt", "type_id": 1}])
+    yield engine
+    engine.dispose()
+
+
+def write_measures(engine, measures):
+    """Writes <measures> ((timestamp, value, night_rate) tuples) of SENSOR
+    as the ingest does, with their cumulative energies and rollups.
+    """
+    writer = MeasuresWriter(engine)
+    for timestamp, value, night_rate in measures:
+        writer.add(SENSOR, value, timestamp, night_rate)
+    writer.flush()
+
+
+@pytest.fixture
+def db(engine):
+    """Session on a database holding an hour of 1000 W measures from START,
+    every TIMESTEP seconds, on the day rate.
+    """
+    write_measures(engine, [(START + i * TIMESTEP, 1000, 0)
+                            for i in range(3600 // TIMESTEP + 1)])
+    session = sessionmaker(bind=engine)()
+    yield session
+    session.close()
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""Tests of the API results computed and cached by libcitizenwatt.cache, on
+the hour of 1000 W measures of the db fixture (see conftest.py).
+"""
+import pytest
+
+from conftest import SENSOR, START, TIMESTEP
+from libcitizenwatt import cache
+from libcitizenwatt.storage import SQLStorage, decode_cursor
+
+
+# Energy of n consecutive measures, in kWh
+def kwh(count):
+    return pytest.approx((count - 1) * TIMESTEP / 3600)
+
+
+@pytest.fixture(autouse=True)
+def empty_cache():
+    cache.backend.clear()
+
+
+def hits():
+    return cache.backend.stats()["hits"]
+
+
+def test_times(db):
+    # The range excludes the measure at time2
+    data = cache.do_cache_times(SENSOR, "kwatthours", START, START + 3600, db)
+    assert data["value"] == kwh(450)
+    assert data["day_rate"] == kwh(450)
+    assert data["night_rate"] == 0
+
+    data = cache.do_cache_times(SENSOR, "watts", START, START + 3600, db)
+    assert len(data) == 450
+    assert data[0]["timestamp"] == START
+    assert all(measure["value"] == 1000 for measure in data)
+
+
+def test_times_empty(db):
+    assert cache.do_cache_times(SENSOR, "kwatthours",
+                                START - 3600, START, db) is None
+
+
+def test_times_cached(db):
+    first = cache.do_cache_times(SENSOR, "kwatthours", START, START + 3600, db)
+    before = hits()
+    assert cache.do_cache_times(SENSOR, "kwatthours",
+                                START, START + 3600, db) == first
+    assert hits() == before + 1
+    cache.do_cache_times(SENSOR, "kwatthours", START, START + 3600, db,
+                         force_refresh=True)
+    assert hits() == before + 1
+
+
+def test_group_timestamp(db):
+    # Groups are [step, next step), without the trapezoids joining them
+    data = cache.do_cache_group_timestamp(SENSOR, "kwatthours",
+                                          START, START + 3600, 600, db)
+    assert [group["value"] for group in data] == [kwh(75)] * 6
+
+    data = cache.do_cache_group_timestamp(SENSOR, "watts",
+                                          START, START + 3600, 600, db)
+    assert [group["value"] for group in data] == (
+        [pytest.approx(1000 * 74 * TIMESTEP / 600)] * 6)
+
+
+def test_group_timestamp_rollups_match_raw(db):
+    # Whole minutes are answered from the rollups
+    steps = [START + i * 600 for i in range(7)]
+    data = cache.do_cache_group_timestamp(SENSOR, "kwatthours",
+                                          START, START + 3600, 600, db)
+    raw = SQLStorage(db).grouped_energy(SENSOR, steps, TIMESTEP)
+    assert [group["value"] for group in data] == [
+        pytest.approx(energy["value"]) for energy in raw]
+
+
+def test_group_timestamp_buckets_cached(db):
+    cache.do_cache_group_timestamp(SENSOR, "kwatthours",
+                                   START, START + 3600, 600, db)
+    before = hits()
+    # A window sliding by a step only computes its last bucket
+    data = cache.do_cache_group_timestamp(SENSOR, "kwatthours",
+                                          START + 600, START + 4200, 600, db)
+    assert hits() == before + 5
+    assert [group["value"] for group in data[:5]] == [kwh(75)] * 5
+    # A single measure lasts a timestep
+    assert data[5]["value"] == pytest.approx(TIMESTEP / 3600)
+
+
+def test_ids(db):
+    data = cache.do_cache_ids(SENSOR, "kwatthours", 1, 451, db)
+    assert data["value"] == kwh(450)
+
+    data = cache.do_cache_group_id(SENSOR, "kwatthours", 1, 451, 75, db)
+    assert [group["value"] for group in data] == [kwh(75)] * 6
+
+
+def test_ids_empty(db):
+    assert cache.do_cache_ids(SENSOR, "kwatthours", 10000, 10010, db) is None
+    assert cache.backend.stats()["entries"] == 0
+
+
+def test_cursor(db):
+    data, previous, next_ = cache.do_cache_cursor(SENSOR, "watts", 10, None,
+                                                  db)
+    assert [measure["id"] for measure in data] == list(range(442, 452))
+    assert decode_cursor(previous) == ("previous", START + 441 * TIMESTEP,
+                                       442)
+
+    data, older, newer = cache.do_cache_cursor(SENSOR, "watts", 10, previous,
+                                               db)
+    assert [measure["id"] for measure in data] == list(range(432, 442))
+
+    # No newer measure yet, the same page is polled again
+    assert cache.do_cache_cursor(SENSOR, "watts", 10, next_, db) == (
+        None, None, next_)
+
+
+def test_closed_ttl_without_invalidation():
+    # Measures written by the ingest do not reach the memory cache
+    assert not cache.backend.invalidated
+    assert cache.closed_ttl() == cache.config.get("uninvalidated_cache_ttl")
+    assert cache.range_ttl(START, TIMESTEP) == cache.closed_ttl()
+
+
+def test_memory_cache_lru():
+    backend = cache.MemoryCache(max_entries=2)
+    backend.set("a", 1, 60)
+    backend.set("b", 2, 60)
+    # "a" is now the most recently used
+    assert backend.get("a") == 1
+    backend.set("c", 3, 60)
+    assert backend.get_many(["a", "b", "c"]) == [1, cache.MISS, 3]
+    assert backend.stats()["evictions"] == 1
+
+
+def test_memory_cache_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, "monotonic", lambda: now[0])
+    backend = cache.MemoryCache()
+    backend.set_many({"a": 1, "b": 2}, 10)
+    backend.set("c", 3, 20)
+    now[0] += 10
+    assert backend.get_many(["a", "b", "c"]) == [cache.MISS, cache.MISS, 3]
+    assert backend.stats()["expirations"] == 2
+    assert backend.stats()["entries"] == 1
+
+
+def test_memory_cache_invalidate():
+    backend = cache.MemoryCache()
+    backend.set_many({"a": 1, "b": 2, "c": 3}, 60,
+                     {"a": (SENSOR, 0, 100), "b": (SENSOR, 100, 200)})
+    backend.set("d", 4, 60, (SENSOR + 1, 0, 100))
+    # Bounds included, other sensors and results without range are kept
+    backend.invalidate({SENSOR: (200, 300)})
+    assert backend.get_many(["a", "b", "c", "d"]) == [1, cache.MISS, 3, 4]
+    backend.invalidate({SENSOR: (50, 60), SENSOR + 1: (0, 0)})
+    assert backend.get_many(["a", "c", "d"]) == [cache.MISS, 3, cache.MISS]
+    assert backend.stats()["invalidations"] == 3
+    # Replaced results are no longer registered with their previous range
+    backend.set("c", 5, 60, (SENSOR, 0, 10))
+    backend.set("c", 6, 60)
+    backend.invalidate({SENSOR: (0, 10)})
+    assert backend.get("c") == 6
+
+
+def test_memory_cache_generation():
+    backend = cache.MemoryCache()
+    generation = backend.generation(SENSOR)
+    backend.invalidate({SENSOR: (0, 10)})
+    # Computed before the invalidation, not kept
+    backend.set("a", 1, 60, (SENSOR, 100, 200), generation)
+    backend.set("b", 2, 60, (SENSOR, 100, 200),
+                backend.generation(SENSOR))
+    assert backend.get_many(["a", "b"]) == [cache.MISS, 2]
+
+
+def test_times_written_while_computing(db, monkeypatch):
+    get_storage = cache.get_storage
+
+    def writing_storage(db, config):
+        cache.backend.invalidate({SENSOR: (START, START)})
+        return get_storage(db, config)
+
+    monkeypatch.setattr(cache, "get_storage", writing_storage)
+    assert len(cache.do_cache_times(SENSOR, "watts", START, START + 3600,
+                                    db)) == 450
+    assert cache.backend.get("watts_%d_by_time_%s_%s" % (
+        SENSOR, START, START + 3600)) is cache.MISS
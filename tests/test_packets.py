@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+"""Tests of the decryption of the packets, see libcitizenwatt.packets."""
+from Crypto.Cipher import AES
+from libcitizenwatt.packets import (PACKET_FORMAT, PacketDecoder,
+                                    key_from_json)
+
+
+KEY = bytes(range(16))
+MEASURES = [(1200, 230, 3300, 1, 0, 0), (60000, 231, 3290, 2, -1, 0)]
+
+
+def encrypt(measure):
+    return AES.new(KEY, AES.MODE_ECB).encrypt(PACKET_FORMAT.pack(*measure))
+
+
+def test_decode_one():
+    assert PacketDecoder().decode_one(KEY, encrypt(MEASURES[0])) == (
+        MEASURES[0])
+
+
+def test_decode():
+    decoded = PacketDecoder().decode(KEY, [encrypt(measure)
+                                           for measure in MEASURES])
+    assert [tuple(int(field) for field in packet)
+            for packet in decoded] == MEASURES
+    assert list(decoded["power"]) == [1200, 60000]
+
+
+def test_cipher_reused():
+    decoder = PacketDecoder()
+    assert decoder.cipher(KEY) is decoder.cipher(KEY)
+    assert decoder.cipher(KEY) is not decoder.cipher(bytes(16))
+
+
+def test_key_from_json():
+    assert key_from_json("[" + ", ".join(str(i) for i in KEY) + "]") == KEY
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""Tests of the framing of the serial stream, see libcitizenwatt.radio."""
+from libcitizenwatt.radio import SerialFramer
+from libcitizenwatt.transport import PACKET_SIZE
+
+
+PACKETS = [bytes([i]) * PACKET_SIZE for i in range(1, 4)]
+
+
+def test_frames():
+    framer = SerialFramer()
+    assert framer.feed(b"".join(packet + b"\r\n" for packet in PACKETS)) == [
+        (None, packet) for packet in PACKETS]
+    assert framer.framing_errors == 0
+
+
+def test_split_frames():
+    framer = SerialFramer()
+    stream = b"".join(packet + b"\r\n" for packet in PACKETS)
+    packets = []
+    for i in range(0, len(stream), 5):
+        packets.extend(framer.feed(stream[i:i + 5]))
+    assert packets == [(None, packet) for packet in PACKETS]
+
+
+def test_terminator_in_payload():
+    packet = b"\r\n" * (PACKET_SIZE // 2)
+    framer = SerialFramer()
+    assert framer.feed(packet + b"\r\n") == [(None, packet)]
+    assert framer.framing_errors == 0
+
+
+def test_resync():
+    framer = SerialFramer()
+    # Tail of a frame whose beginning was lost
+    packets = framer.feed(b"\x07" * 5 + b"\r\n" + PACKETS[0] + b"\r\n")
+    assert packets == [(None, PACKETS[0])]
+    assert framer.framing_errors == 1
+
+
+def test_resync_across_feeds():
+    framer = SerialFramer()
+    assert framer.feed(b"\x07" * (PACKET_SIZE + 3) + b"\r") == []
+    assert framer.framing_errors == 1
+    # The end of the terminator comes with the next read
+    assert framer.feed(b"\n" + PACKETS[1] + b"\r\n") == [(None, PACKETS[1])]
+
+
+def test_pipe_header():
+    framer = SerialFramer(pipe_header=True)
+    stream = b"".join(bytes([pipe]) + packet + b"\r\n"
+                      for pipe, packet in enumerate(PACKETS))
+    assert framer.feed(stream) == list(enumerate(PACKETS))
+    assert framer.framing_errors == 0
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""Tests of the energy rollups maintained by the measures writer, see
+libcitizenwatt.rollups.
+"""
+import random
+
+import pytest
+
+from conftest import SENSOR, START, TIMESTEP, write_measures
+from libcitizenwatt import database
+from libcitizenwatt import migrations
+from libcitizenwatt import rollups
+from libcitizenwatt.storage import SQLStorage
+from sqlalchemy.orm import sessionmaker
+
+
+def irregular_measures():
+    """Returns three hours of measures, at irregular intervals, with a gap
+    and day/night rate switches.
+    """
+    generator = random.Random(0)
+    measures = []
+    timestamp = START + 0.5
+    while timestamp < START + 3 * 3600:
+        if START + 3600 <= timestamp < START + 3600 + 1000:
+            # Sensor out of range
+            timestamp += 1000
+        night_rate = int((timestamp - START) // 1700 % 2)
+        measures.append((timestamp, generator.randint(0, 4000), night_rate))
+        timestamp += generator.uniform(1, 3 * TIMESTEP)
+    return measures
+
+
+@pytest.fixture
+def db(engine):
+    """Session on a database holding irregular_measures(), written in
+    batches ending anywhere in the buckets.
+    """
+    measures = irregular_measures()
+    for i in range(0, len(measures), 337):
+        write_measures(engine, measures[i:i + 337])
+    session = sessionmaker(bind=engine)()
+    yield session
+    session.close()
+
+
+def approx(energies):
+    return [pytest.approx(energy) if energy is not None else None
+            for energy in energies]
+
+
+@pytest.mark.parametrize("resolution, step", [
+    (rollups.MINUTE, 60),
+    (rollups.MINUTE, 300),
+    (rollups.HOUR, 3600),
+])
+def test_grouped_energy_matches_raw(db, resolution, step):
+    steps = [START + i * step for i in range(3 * 3600 // step + 1)]
+    assert rollups.coarsest_resolution(steps) == resolution
+    raw = SQLStorage(db).grouped_energy(SENSOR, steps, TIMESTEP)
+    assert rollups.grouped_energy(db, SENSOR, steps, resolution,
+                                  TIMESTEP) == approx(raw)
+
+
+def stored_rollups(engine):
+    table = database.Rollup.__table__
+    with engine.begin() as conn:
+        return [{column: row[column] for column in
+                 ("resolution", "start") + rollups.COLUMNS}
+                for row in conn.execute(table.select().order_by(
+                    table.c.resolution, table.c.start))]
+
+
+def test_rebuild_matches_incremental(engine, db):
+    incremental = stored_rollups(engine)
+    rollups.rebuild(engine, chunk_size=500)
+    assert stored_rollups(engine) == [pytest.approx(bucket)
+                                      for bucket in incremental]
+
+
+
+def test_upgrade_rebuilds_missing_rollups(engine, db):
+    assert rollups.needs_rebuild(engine) == []
+    # Measures written before the upgrade, without rollups, then by a daemon
+    # started before it
+    with engine.begin() as conn:
+        conn.execute(database.Rollup.__table__.delete())
+    write_measures(engine, [(START + 2 * rollups.DAY, 1000, 0)])
+    assert rollups.needs_rebuild(engine) == [SENSOR]
+    # The daemons only upgrade the schema
+    assert migrations.upgrade_or_defer(engine) is None
+    assert rollups.needs_rebuild(engine) == [SENSOR]
+
+    migrations.upgrade(engine)
+    assert rollups.needs_rebuild(engine) == []
+    upgraded = stored_rollups(engine)
+    rollups.rebuild(engine)
+    assert stored_rollups(engine) == upgraded
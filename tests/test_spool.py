@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""Tests of the on-disk queue of the measures, see libcitizenwatt.spool."""
+import os
+
+import pytest
+
+from libcitizenwatt.spool import RECORD, Spool
+
+
+ROWS = [{"sensor_id": 1 + i % 2,
+         "timestamp": 1500000000.5 + i,
+         "value": 100.0 * i,
+         "night_rate": i % 2}
+        for i in range(7)]
+
+
+def test_round_trip(tmp_path):
+    spool = Spool(str(tmp_path), segment_records=3)
+    assert not spool.pending()
+    spool.append(ROWS[:3])
+    spool.append(ROWS[3:5])
+    spool.append(ROWS[5:])
+    assert spool.pending()
+    # A segment is started once the last one is full
+    assert len(spool.segments()) == 2
+
+    replayed = []
+    spool.replay(replayed.append)
+    assert replayed == [ROWS[:3], ROWS[3:]]
+    assert spool.segments() == []
+    assert not spool.pending()
+
+
+def test_pending_on_restart(tmp_path):
+    Spool(str(tmp_path)).append(ROWS)
+    assert Spool(str(tmp_path)).pending()
+
+
+def test_truncated_record(tmp_path):
+    spool = Spool(str(tmp_path))
+    spool.append(ROWS)
+    path = spool.segments()[0]
+    os.truncate(path, os.path.getsize(path) - RECORD.size // 2)
+    assert spool.read(path) == ROWS[:-1]
+
+
+def test_failed_replay(tmp_path):
+    spool = Spool(str(tmp_path))
+    spool.append(ROWS)
+
+    def insert(rows):
+        raise IOError
+
+    with pytest.raises(IOError):
+        spool.replay(insert)
+    assert spool.pending()
+    replayed = []
+    spool.replay(replayed.append)
+    assert replayed == [ROWS]
+
+
+def test_append_after_truncated_record(tmp_path):
+    spool = Spool(str(tmp_path))
+    spool.append(ROWS[:3])
+    path = spool.segments()[0]
+    os.truncate(path, os.path.getsize(path) - RECORD.size // 2)
+    spool.append(ROWS[3:])
+    assert spool.read(path) == ROWS[:2] + ROWS[3:]
+
+
+def test_rejected_segment(tmp_path):
+    spool = Spool(str(tmp_path), segment_records=3)
+    spool.append(ROWS[:3])
+    spool.append(ROWS[3:])
+
+    def insert(rows):
+        if rows == ROWS[:3]:
+            raise ValueError
+        replayed.append(rows)
+
+    replayed = []
+    with pytest.raises(ValueError):
+        spool.replay(insert, lambda e: True)
+    assert len(spool.segments()) == 2
+
+    spool.replay(insert, lambda e: False)
+    assert replayed == [ROWS[3:]]
+    assert spool.segments() == []
+    failed, = os.listdir(str(tmp_path))
+    assert failed.endswith(".failed")
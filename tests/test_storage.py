@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+"""Tests of the cursors of the pages of measures, see
+libcitizenwatt.storage.
+"""
+import base64
+import collections
+import json
+
+import pytest
+
+from libcitizenwatt.storage import decode_cursor, encode_cursor
+
+
+Measure = collections.namedtuple("Measure", ["id", "timestamp"])
+
+
+def test_cursor_round_trip():
+    for direction in ("previous", "next"):
+        cursor = encode_cursor(Measure(42, 1500000000.5), direction)
+        assert decode_cursor(cursor) == (direction, 1500000000.5, 42)
+
+
+def test_cursor_url_safe():
+    cursor = encode_cursor(Measure(2 ** 40, 1500000000.123456), "next")
+    assert all(c.isalnum() or c in "-_=" for c in cursor)
+
+
+@pytest.mark.parametrize("position", [
+    ["last", 1500000000, 42],
+    ["next", "1500000000", 42],
+    ["next", 1500000000, 42.5],
+    ["next", 1500000000],
+    {"direction": "next"},
+])
+def test_invalid_cursor(position):
+    cursor = base64.urlsafe_b64encode(
+        json.dumps(position).encode("utf-8")).decode("ascii")
+    with pytest.raises(ValueError):
+        decode_cursor(cursor)
+
+
+@pytest.mark.parametrize("cursor", ["", "not a cursor", "é", "bnVsbA=="])
+def test_malformed_cursor(cursor):
+    with pytest.raises(ValueError):
+        decode_cursor(cursor)